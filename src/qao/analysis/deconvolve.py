@@ -8,25 +8,55 @@ The measured signals are affected by multiply charges. As the point spread
 function of this effect is known (ion time of flight spectrum), an estimate
 of the original signal can be calculated by deconvolution. This module provides
 the necessary implementations.
+
+The time of flight spectrum is described by gaussian peaks for the different
+ion species, given as list of [t0, amp, sig] with times in microseconds. The
+peaks default to :data:`TOF_GAUSS_PARS` and can be calibrated from a measured
+time of flight histogram by :func:`ion_tof_calibration`.
 """
 
 import numpy as np
 from scipy.special import erf
 
-def ion_tof_spectrum(dwell_time, n):
+# multipeak fit of the ion time of flight spectrum, [t0, amp, sig] for each peak,
+# the first peak being the rb+ peak
+TOF_GAUSS_PARS = [[17.31395979720519, 63112.69760492675, 0.03123937437419509],
+                  [12.290841184555568, 6701.023533805622, 0.040793741078493824],
+                  [10.060823913081139, 7150.302486228399, 0.04562454121523191],
+                  [8.727893992574595, 2282.387336822463, 0.0470714790645937],
+                  [7.829032989499102, 697.6137824761323, 0.04166911964137886]]
+
+def ion_tof_calibration(histogram, t_start, bin_width, peaks = 5):
+    """Fit the peaks of a measured ion time of flight histogram.
+    
+    The histogram is fitted by :class:`qao.fit.gauss.MultiGauss1D`. The resulting
+    peaks are converted to times and sorted by decreasing time of flight, so the
+    rb+ peak comes first as in :data:`TOF_GAUSS_PARS`.
+    
+    :param histogram: (ndarray) Ion counts for each time bin.
+    :param t_start: (float) Time of the center of the first bin in microseconds.
+    :param bin_width: (float) Width of the bins in microseconds.
+    :param peaks: (int) Number of peaks to fit.
+    :returns: (list) Peak parameters [t0, amp, sig] for use as `gauss_pars`.
+    """
+    from qao.fit.gauss import MultiGauss1D
+    fitter = MultiGauss1D(histogram, peaks)
+    pars = fitter.fit()[:-1].reshape(peaks, 3)
+    gauss_pars = [[t_start + x0 * bin_width, A / bin_width, s * bin_width] for A, x0, s in pars]
+    return sorted(gauss_pars, reverse = True)
+
+def ion_tof_spectrum(dwell_time, n, gauss_pars = None):
     """Calculate a pixel based spectrum based on the multipeak fit parameters
     of the ion time of flight measurement.
     
     :param dwell_time: (float) Dwell time of the pixels in microseconds.
     :param n: (int) Length of the spectrum in pixels.
+    :param gauss_pars: (list) Time of flight peaks or None for :data:`TOF_GAUSS_PARS`.
     :returns: (ndarray) Normalized time of flight spectrum for given parameters.
     """
     
-    gauss_pars = [[17.31395979720519, 63112.69760492675, 0.03123937437419509],
-             [12.290841184555568, 6701.023533805622, 0.040793741078493824],
-             [10.060823913081139, 7150.302486228399, 0.04562454121523191],
-             [8.727893992574595, 2282.387336822463, 0.0470714790645937],
-             [7.829032989499102, 697.6137824761323, 0.04166911964137886]]
+    if gauss_pars is None:
+        gauss_pars = TOF_GAUSS_PARS
 
     # gauss integral
     def gaussint(t1, t2, peaks):
@@ -44,7 +74,7 @@ def ion_tof_spectrum(dwell_time, n):
     spec *= 1./spec.sum()    
     return spec
 
-def ion_wien_deconvolve(data, dwell_time, f=.7, clip=False):
+def ion_wien_deconvolve(data, dwell_time, f=.7, clip=False, gauss_pars=None):
     """Deconvolve the time resolved ion signal given by data using the
     Wien deconvolution technique.
     
@@ -52,12 +82,13 @@ def ion_wien_deconvolve(data, dwell_time, f=.7, clip=False):
     :param dwell_time: (float) Dwell time of the pixels in microseconds.
     :param f: (float) Effectively smoothens the result for higher values.
     :param clip: (bool) Clip negative elements of the returned array.
+    :param gauss_pars: (list) Time of flight peaks or None for :data:`TOF_GAUSS_PARS`.
     :returns: (ndarray) Deconvolved ion signal.
     """
     
     data = np.asfarray(data)
     d_signal = np.concatenate([np.zeros(data.size/2), data.ravel(), np.zeros(data.size/2)])
-    d_psf = ion_tof_spectrum(dwell_time, d_signal.size)
+    d_psf = ion_tof_spectrum(dwell_time, d_signal.size, gauss_pars)
     
     # fourier transforms
     D_signal = np.fft.fft(d_signal)
@@ -75,24 +106,22 @@ def ion_wien_deconvolve(data, dwell_time, f=.7, clip=False):
     result = np.clip(result, 0, np.inf) if clip else result
     return result
 
-def ion_direct_unfold(data, dwell_time, clip=False):
+def ion_direct_unfold(data, dwell_time, clip=False, gauss_pars=None):
     """Deconvolve the time resolved ion signal given by data using a
     direct deconvolution method.
     
     :param data: (ndarray) Ion signal to be deconvolved.
     :param dwell_time: (float) Dwell time of the pixels in microseconds.
     :param clip: (bool) Clip negative elements of the returned array.
+    :param gauss_pars: (list) Time of flight peaks or None for :data:`TOF_GAUSS_PARS`.
     :returns: (ndarray) Deconvolved ion signal.
     """
 
     # calculate a pixel based spectrum from the tof-multipeak fit
     
     # gaussint fit
-    gauss_pars = [[17.31395979720519, 63112.69760492675, 0.03123937437419509],
-             [12.290841184555568, 6701.023533805622, 0.040793741078493824],
-             [10.060823913081139, 7150.302486228399, 0.04562454121523191],
-             [8.727893992574595, 2282.387336822463, 0.0470714790645937],
-             [7.829032989499102, 697.6137824761323, 0.04166911964137886]]
+    if gauss_pars is None:
+        gauss_pars = TOF_GAUSS_PARS
 
     # gauss integral
     def gaussint(t1, t2, peaks):
@@ -7,51 +7,47 @@ images to binary images.
 """
 
 import numpy as np
-from scipy import weave
 
-code_floyd_steinberg = """
-const int nx = Ndata_src[1];
-const int ny = Ndata_src[0];
+try:
+    from numba import njit as _jit
+except ImportError:
+    _jit = lambda func: func
 
-for (int iy=0; iy < ny-1; ++iy) {
-    for (int ix=1; ix < nx-1; ++ix) {
-        int i = iy * nx + ix;                 // index
-        data_dst[i] = data_src[i] > .5;       // binary
-        double e = data_dst[i] - data_src[i]; // error
-        // diffuse error to pixel neighbours
-        data_src[i+1]    += (-7./16.) * e;
-        data_src[i+nx+1] += (-1./16.) * e;
-        data_src[i+nx]   += (-5./16.) * e;
-        data_src[i+nx-1] += (-3./16.) * e;
-    }
-}
-"""
+def _floyd_steinberg(data_src, data_dst):
+    ny, nx = data_src.shape
+    for iy in range(ny-1):
+        for ix in range(1, nx-1):
+            data_dst[iy, ix] = data_src[iy, ix] > .5     # binary
+            e = data_dst[iy, ix] - data_src[iy, ix]     # error
+            # diffuse error to pixel neighbours
+            data_src[iy,   ix+1] += (-7./16.) * e
+            data_src[iy+1, ix+1] += (-1./16.) * e
+            data_src[iy+1, ix  ] += (-5./16.) * e
+            data_src[iy+1, ix-1] += (-3./16.) * e
 
-code_stucki = """
-const int nx = Ndata_src[1];
-const int ny = Ndata_src[0];
+def _stucki(data_src, data_dst):
+    ny, nx = data_src.shape
+    for iy in range(ny-2):
+        for ix in range(2, nx-2):
+            data_dst[iy, ix] = data_src[iy, ix] > .5     # binary
+            e = data_dst[iy, ix] - data_src[iy, ix]     # error
+            # diffuse error to pixel neighbours
+            data_src[iy,   ix+1] += (-7./48.) * e
+            data_src[iy,   ix+2] += (-5./48.) * e
+            data_src[iy+1, ix-2] += (-3./48.) * e
+            data_src[iy+1, ix-1] += (-5./48.) * e
+            data_src[iy+1, ix  ] += (-7./48.) * e
+            data_src[iy+1, ix+1] += (-5./48.) * e
+            data_src[iy+1, ix+2] += (-3./48.) * e
+            data_src[iy+2, ix-2] += (-1./48.) * e
+            data_src[iy+2, ix-1] += (-3./48.) * e
+            data_src[iy+2, ix  ] += (-5./48.) * e
+            data_src[iy+2, ix+1] += (-3./48.) * e
+            data_src[iy+2, ix+2] += (-1./48.) * e
 
-for (int iy=0; iy < ny-2; ++iy) {
-    for (int ix=2; ix < nx-2; ++ix) {
-        int i = iy * nx + ix;                 // index
-        data_dst[i] = data_src[i] > .5;       // binary
-        double e = data_dst[i] - data_src[i]; // error
-        // diffuse error to pixel neighbours
-        data_src[i+1]    += (-7./48.) * e;
-        data_src[i+2]    += (-5./48.) * e;
-        data_src[i+nx-2] += (-3./48.) * e;
-        data_src[i+nx-1] += (-5./48.) * e;
-        data_src[i+nx  ] += (-7./48.) * e;
-        data_src[i+nx+1] += (-5./48.) * e;
-        data_src[i+nx+2] += (-3./48.) * e;
-        data_src[i+nx+nx-2] += (-1./48.) * e;
-        data_src[i+nx+nx-1] += (-3./48.) * e;
-        data_src[i+nx+nx  ] += (-5./48.) * e;
-        data_src[i+nx+nx+1] += (-3./48.) * e;
-        data_src[i+nx+nx+2] += (-1./48.) * e;
-    }
-}
-"""
+# the error diffusion is inherently sequential, compile the loops if possible
+_floyd_steinberg = _jit(_floyd_steinberg)
+_stucki = _jit(_stucki)
 
 def floyd_steinberg(data):
     """
@@ -60,7 +56,7 @@ def floyd_steinberg(data):
     """
     data_src = np.asfarray(data).copy()
     data_dst = np.zeros(data_src.shape, dtype="uint8")
-    weave.inline(code_floyd_steinberg, ["data_src", "data_dst"])
+    _floyd_steinberg(data_src, data_dst)
     return data_dst
 
 def stucki(data):
@@ -70,7 +66,7 @@ def stucki(data):
     """
     data_src = np.asfarray(data).copy()
     data_dst = np.zeros(data_src.shape, dtype="uint8")
-    weave.inline(code_stucki, ["data_src", "data_dst"])
+    _stucki(data_src, data_dst)
     return data_dst
 
 # Floyd Steinberg is the default algorithm
@@ -1,7 +1,34 @@
 import numpy as np
 import scipy.optimize
 import scipy.interpolate
-import math, h5py
+import os, math, h5py
+import multiprocessing
+from collections import OrderedDict
+
+# theory data and interpolators shared by all RNFitter instances. The theory
+# is keyed by (path, mtime) of the file, the interpolators additionally by
+# the window of the grid, so a modified theory file is loaded again. Entries
+# of an outdated file are dropped, otherwise the least recently used ones.
+THEORY_CACHE_SIZE = 4
+SPLINE_CACHE_SIZE = 32
+_theory_cache = OrderedDict()
+_spline_cache = OrderedDict()
+
+def _cacheGet_(cache, key):
+    # move a cached entry to the end, the front holds the least recently used
+    value = cache.pop(key, None)
+    if value is not None:
+        cache[key] = value
+    return value
+
+def _cachePut_(cache, key, value, maxsize):
+    # drop entries of the same file with a different mtime and the oldest entries
+    for k in [k for k in cache if k[0] == key[0] and k[1] != key[1]]:
+        del cache[k]
+    cache[key] = value
+    while len(cache) > maxsize:
+        cache.popitem(last = False)
+    return value
 
 
 class RNFitter():
@@ -24,8 +51,8 @@ class RNFitter():
         self._createInterpolationGrid_()
         
         self.fitFunctions ={
-            0: lambda t, s, A: A*scipy.interpolate.griddata((self.grid['pos_points'],self.grid['t_points']), self.grid['zero_order'], (self._s_to_pos_(s), t), method="cubic"),
-            1: lambda t, s, A: A*scipy.interpolate.griddata((self.grid['pos_points'],self.grid['t_points']), self.grid['first_order'], (self._s_to_pos_(s), t), method="cubic")
+            0: lambda t, s, A: A*self._interpolate_(0, s, t),
+            1: lambda t, s, A: A*self._interpolate_(1, s, t)
         }
         
         #chopping data - simulation was only done up to 60us-pulses
@@ -35,13 +62,18 @@ class RNFitter():
     
     
     def _loadTheory_(self, filename):
-        f = h5py.File(filename)
-        self.sMax = f.attrs['sMax']
-        self.sStep = f.attrs['sStep']
-        self.tMax = f.attrs['tMax']
-        self.zero_order_theory  = np.array(f['zero'])
-        self.first_order_theory = np.array(f['first'])
-        f.close()
+        path = os.path.abspath(filename)
+        self.theoryKey = (path, os.path.getmtime(path))
+        theory = _cacheGet_(_theory_cache, self.theoryKey)
+        if theory is None:
+            f = h5py.File(path, "r")
+            try:
+                theory = (f.attrs['sMax'], f.attrs['sStep'], f.attrs['tMax'],
+                          np.array(f['zero']), np.array(f['first']))
+            finally:
+                f.close()
+            _cachePut_(_theory_cache, self.theoryKey, theory, THEORY_CACHE_SIZE)
+        self.sMax, self.sStep, self.tMax, self.zero_order_theory, self.first_order_theory = theory
     
     def _s_to_pos_(self, s):
         """
@@ -60,16 +92,31 @@ class RNFitter():
         else:
             end_pos   = int(math.floor(self._s_to_pos_(self.guess[0]+self.gridWidth)))
         
-        #creating interpolation grid
-        steps            = (end_pos-start_pos+1)*1j
-        grid_pos, grid_t = np.mgrid[start_pos:end_pos:steps, 0:self.tMax:(self.tMax+1)*1j]
+        #creating interpolation grid, the simulation is a structured (s, t) grid
+        start_pos, end_pos = int(round(start_pos)), int(round(end_pos))
+        grid_pos = np.arange(start_pos, end_pos+1, dtype=float)
+        grid_t   = np.linspace(0, self.tMax, int(round(self.tMax))+1)
+        key = self.theoryKey + (start_pos, end_pos)
+        splines = _cacheGet_(_spline_cache, key)
+        if splines is None:
+            kx, ky = min(3, grid_pos.size-1), min(3, grid_t.size-1)
+            splines = _cachePut_(_spline_cache, key, {
+                0: scipy.interpolate.RectBivariateSpline(grid_pos, grid_t, self.zero_order_theory[start_pos:end_pos+1], kx=kx, ky=ky),
+                1: scipy.interpolate.RectBivariateSpline(grid_pos, grid_t, self.first_order_theory[start_pos:end_pos+1], kx=kx, ky=ky)
+            }, SPLINE_CACHE_SIZE)
         self.grid.update({
-        'pos_points'  : np.ravel(grid_pos),
-        't_points'    : np.ravel(grid_t),
-        'zero_order'  : np.ravel(self.zero_order_theory[start_pos:end_pos+1]),
-        'first_order' : np.ravel(self.first_order_theory[start_pos:end_pos+1])
+        'pos_points'  : grid_pos,
+        't_points'    : grid_t,
+        'splines'     : splines
         })
 
+    def _interpolate_(self, order, s, t):
+        """
+            evaluates the interpolated theory of given order for all times t
+        """
+        pos, t = np.broadcast_arrays(self._s_to_pos_(np.asfarray(s)), np.asfarray(t))
+        return self.grid['splines'][order].ev(pos, t)
+
     def fitFunction(self, t, s, A, order=0):
         return self.fitFunctions[order](t,s,A)
 
@@ -79,7 +126,54 @@ class RNFitter():
         popt_first, pcov_first = scipy.optimize.curve_fit(f=self.fitFunctions[1], xdata=self.time, ydata=self.first_order, p0=self.guess)
         err_first = np.sqrt(np.diagonal(pcov_first))
         return {0:(popt_zero, err_zero), 1:(popt_first, err_first)}
+
+    def fitJoint(self):
+        '''
+        fits both orders at once with a common s and individual amplitudes,
+        returns ([s, A_zero, A_first], errors)
+        '''
+        n = self.time.size
+        def fitFunction(t, s, A_zero, A_first):
+            return np.concatenate([A_zero*self._interpolate_(0, s, t[:n]), A_first*self._interpolate_(1, s, t[n:])])
         
+        p0 = [self.guess[0], self.guess[1], self.guess[1]]
+        popt, pcov = scipy.optimize.curve_fit(f=fitFunction, xdata=np.concatenate([self.time, self.time]),
+                                              ydata=np.concatenate([self.zero_order, self.first_order]), p0=p0)
+        return popt, np.sqrt(np.diagonal(pcov))
+
+
+def _fitWorker_(task):
+    time, zero_order, first_order, theoryFile, p0, gridWidth, joint = task
+    try:
+        fitter = RNFitter(time, zero_order, first_order, theoryFile, p0, gridWidth)
+        return fitter.fitJoint() if joint else fitter.fit()
+    except (RuntimeError, ValueError):
+        # no convergence, a single dataset must not abort the batch
+        return None
+
+def fitBatch(datasets, theoryFile, p0=[1, 1], gridWidth=4, joint=True, processes=None):
+    '''
+    datasets:      list of (time, zero_order, first_order) tuples, e.g. per axis or per day
+    theoryFile:    theory shared by all datasets, loaded once per worker process
+    p0, gridWidth: see RNFitter
+    joint:         fit both orders with common s (fitJoint) or independently (fit)
+    processes:     number of worker processes, None for all cpus, 1 for no pool
+    
+    returns the results of fitJoint or fit for each dataset, None if the fit failed
+    '''
+    tasks = [(np.asarray(time), np.asarray(zero_order), np.asarray(first_order), theoryFile, p0, gridWidth, joint)
+             for time, zero_order, first_order in datasets]
+    if processes == 1 or len(tasks) < 2:
+        return [_fitWorker_(task) for task in tasks]
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunksize = max(1, len(tasks) // (4 * processes))
+        return pool.map(_fitWorker_, tasks, chunksize)
+    finally:
+        pool.terminate()
+        pool.join()
+
 if __name__ == "__main__":
     from qao.io import CSVReader
     import pylab as pl
@@ -10,6 +10,7 @@ There is a small collection of fitters already available in :mod:`qao.fit.gauss`
 which can be also imported from :mod:`qao.fit`.
 
 * :class:`qao.fit.gauss.Gauss1D`
+* :class:`qao.fit.gauss.MultiGauss1D`
 * :class:`qao.fit.gauss.Gauss2D`
 * :class:`qao.fit.gauss.Gauss2DRot`
 * :class:`qao.fit.coldatoms.ThomasFermi2D`
@@ -51,16 +52,66 @@ are printed and plotted afterwards::
     p.plot(x, y_fit, "r-")
     p.show()
 
-A small class for multiprocessing application of fitters is implemented in :class:`FitJob`.
+Each fitter computes in double precision by default. For large datasets, a fitter may
+be created with `dtype=numpy.float32`, which stores the data, the model function and the
+jacobian in single precision while the normal equations and the error estimates are still
+solved in double precision. The table lists the fit times of noisy test images with
+2**20 data points on a single core (numba backend) and the deviation of the single
+precision results relative to the estimated errors of the double precision fit.
+
+=============  ==============  ==============  ========================
+Model          float64 [ms]    float32 [ms]    max. deviation / error
+=============  ==============  ==============  ========================
+Gauss1D        30              25              2e-4
+Gauss1DAsym    30              36              4e-5
+Gauss2D        4               5               3e-4
+Gauss2DRot     720             1640            1e-2
+ThomasFermi2D  480             290             3e-5
+Bimodal2D      580             530             4e-6
+=============  ==============  ==============  ========================
+
+The results agree well within the fit errors. Whether single precision is faster depends
+on the BLAS library used for accumulating the normal equations, which may be slower for
+single precision as seen for :class:`qao.fit.gauss.Gauss2DRot`. Gauss2D and Bimodal2D do
+not store the jacobian and benefit the least.
+
+The Levenberg-Marquardt iteration can be tuned by :func:`qao.fit.fitter.LevmarFitter.setSolver`.
+The table lists the mean number of iterations and model evaluations for eight noisy
+240x200 images each, starting from the default guess.
+
+==========================  ===================  ====================
+Solver                      Bimodal2D            Gauss2DRot
+==========================  ===================  ====================
+identity damping            19 iter, 19 evals    12 iter, 12 evals
+marquardt damping           12 iter, 12 evals    10 iter, 10 evals
+identity + geodesic         21 iter, 58 evals    12 iter, 45 evals
+marquardt + geodesic        16 iter, 42 evals    15 iter, 46 evals
+==========================  ===================  ====================
+
+The Marquardt damping also reached lower residuals for Bimodal2D, where the identity
+damping stopped in a local minimum for some images. Geodesic acceleration did not pay
+off for these models.
+
+A small class for multiprocessing application of fitters is implemented in
+:class:`qao.fit.fitjob.FitJob`, which can be also imported from :mod:`qao.fit`.
+Series of datasets sharing some of the fit parameters are fitted at once by
+:class:`qao.fit.globalfit.GlobalFit`. Results of repeated fits are kept by a
+:class:`qao.fit.cache.FitCache`.
 
 .. automodule:: qao.fit.fitter
 .. automodule:: qao.fit.gauss
 .. automodule:: qao.fit.coldatoms
+.. automodule:: qao.fit.fitjob
+.. automodule:: qao.fit.globalfit
+.. automodule:: qao.fit.cache
 
 """
 
-from gauss import Gauss1D, Gauss2D, Gauss2DRot
+from gauss import Gauss1D, MultiGauss1D, Gauss2D, Gauss2DRot
 from coldatoms import ThomasFermi2D, Bimodal2D
+from fitjob import FitJob
+from globalfit import GlobalFit
+from cache import FitCache
 
 if __name__ == '__main__':
     import pylab as p
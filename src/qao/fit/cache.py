@@ -0,0 +1,155 @@
+"""
+Result cache
+------------
+
+Interactive applications often fit the same data again, e.g. when a display
+setting changes or a measurement run is reopened. A :class:`FitCache` assigned to
+a fitter by :func:`LevmarFitter.setCache` stores the results of :func:`LevmarFitter.fit`,
+so the same fit request is answered without iterating. The results are keyed by a
+hash of the data buffer together with the fitter class, the standard deviations,
+the mask and the fit options. The most recently used results are kept in memory,
+optionally all results are also stored in a directory for reuse after a restart.
+
+Example::
+
+    from qao.fit import Gauss2D, FitCache
+
+    cache = FitCache(maxsize = 256, path = "~/.cache/qao-fit")
+    fitter = Gauss2D(image)
+    fitter.setCache(cache)
+    pars = fitter.fit()     # fitted
+    pars = fitter.fit()     # from cache
+
+"""
+
+import os
+import cPickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def _update(h, array):
+    # hash the buffer of an array including its type and shape
+    if array is None:
+        h.update("none")
+        return
+    array = np.ascontiguousarray(array)
+    h.update("%s%s" % (array.dtype.str, array.shape))
+    h.update(array.data)
+
+class FitCache(object):
+    """
+    Bounded cache for fit results.
+
+    At most `maxsize` results are kept in memory, the least recently used result
+    is discarded first. If `path` is given, the results are also written to this
+    directory and loaded from there if missing in memory. Fit cache instances
+    may be shared by several fitters and threads.
+
+    :param maxsize: (int) Maximum number of results kept in memory.
+    :param path: (str) Directory for persistent results or None.
+    """
+
+    def __init__(self, maxsize = 128, path = None):
+        if maxsize < 1:
+            raise ValueError("Cache size must be positive.")
+        self.maxsize = int(maxsize)
+        self.path = None
+        if path is not None:
+            self.path = os.path.abspath(os.path.expanduser(path))
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def key(self, fitter, pars_guess, options):
+        """
+        Calculate the cache key of a fit request.
+
+        :param fitter: (LevmarFitter) Fitter with the data assigned.
+        :param pars_guess: (ndarray) Start parameters or None.
+        :param options: (tuple) Additional fit options.
+        :returns: (str) Hex digest identifying the fit request.
+        """
+        cls = type(fitter)
+        h = hashlib.md5()
+        h.update("%s.%s %r %r" % (cls.__module__, cls.__name__, tuple(fitter.pars_name), options))
+        _update(h, fitter.data)
+        _update(h, fitter._invsigma)
+        _update(h, fitter.getMask())
+        _update(h, None if pars_guess is None else np.asfarray(pars_guess))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the fit result stored for `key`.
+
+        :param key: (str) Cache key from :func:`key`.
+        :returns: (ndarray, dict) Fit parameters and fit dictionary or None.
+        """
+        with self.__lock:
+            result = self.__items.pop(key, None)
+            if result is None and self.path is not None:
+                result = self.__load(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__insert(key, result)
+        pars, fit_log = result
+        return pars.copy(), dict(fit_log)
+
+    def put(self, key, pars, fit_log):
+        """
+        Store a fit result for `key`.
+
+        :param key: (str) Cache key from :func:`key`.
+        :param pars: (ndarray) Fit parameters.
+        :param fit_log: (dict) Fit dictionary.
+        """
+        result = (np.array(pars), dict(fit_log))
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__insert(key, result)
+            if self.path is not None:
+                self.__store(key, result)
+
+    def clear(self, disk = False):
+        """
+        Remove all results from memory, and from the cache directory if `disk` is set.
+
+        :param disk: (bool) Also remove the persistent results.
+        """
+        with self.__lock:
+            self.__items.clear()
+            if disk and self.path is not None:
+                for name in os.listdir(self.path):
+                    if name.endswith(".pkl"):
+                        os.remove(os.path.join(self.path, name))
+
+    def __insert(self, key, result):
+        self.__items[key] = result
+        while len(self.__items) > self.maxsize:
+            self.__items.popitem(last = False)
+
+    def __load(self, key):
+        try:
+            with open(os.path.join(self.path, key + ".pkl"), "rb") as fh:
+                return cPickle.load(fh)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def __store(self, key, result):
+        # write to a temporary file first, readers never see partial results
+        fd, name = tempfile.mkstemp(dir = self.path, suffix = ".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            cPickle.dump(result, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(name, os.path.join(self.path, key + ".pkl"))
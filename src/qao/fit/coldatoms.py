@@ -1,16 +1,9 @@
 import numpy as np
-import scipy.weave as weave
 from scipy.special import erf
 from scipy.ndimage import rotate
-from fitter import LevmarFitter, DEFAULT_TYPE_C, DEFAULT_TYPE_NPY
-from gauss import Gauss1D
-
-__compiler_args = ["-O3", "-march=native", "-ffast-math", "-fno-openmp"]
-__linker_args   = ["-fno-openmp"]
-opt_args = {"extra_compile_args": __compiler_args,
-            "extra_link_args": __linker_args}
-
-DEFAULT_TYPEDEFC = "typedef {0} float_type;\n".format(DEFAULT_TYPE_C)
+from fitter import LevmarFitter, DEFAULT_TYPE_NPY
+from gauss import Gauss1D, momentGuess2D, poorGuess
+import kernels
 
 
 class ThomasFermi2D(LevmarFitter):
@@ -25,13 +18,17 @@ class ThomasFermi2D(LevmarFitter):
     The order of the fit parameters is (A_t, x_0, r_x, y_0, r_y, off). 
     
     :param data: (ndarray) Image to be fitted.
+    :param dtype: (dtype) Floating point type for computations or None.
     """
+    
+    pars_kind = (None, "x", "size", "y", "size", None)
+    supports_mask = True
         
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A_t", "x_0", "r_x", "y_0", "r_y", "off"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A_t", "x_0", "r_x", "y_0", "r_y", "off"], data, dtype)
         
-        cache_x = np.empty(data.shape[1], dtype=float)
-        cache_y = np.empty(data.shape[0], dtype=float)
+        cache_x = np.empty(data.shape[1], dtype = self.dtype)
+        cache_y = np.empty(data.shape[0], dtype = self.dtype)
         self.cache = (cache_x, cache_y)
     
     def guess(self):
@@ -60,79 +57,46 @@ class ThomasFermi2D(LevmarFitter):
         off = 0.5 * (pars_x[3]/(ny-1) + pars_y[3]/(nx-1))
         return np.asfarray((amp, x_0, r_x, y_0, r_y, off))
     
-    f_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ncache_x[0];
-    const int ny = Ncache_y[0];
-    const float_type inv_rx_2 = 1. / p[2] / p[2];
-    const float_type inv_ry_2 = 1. / p[4] / p[4];
-
-    // cache values
-    for (int ix = 0; ix < nx; ++ix) {
-        float_type dist = ix-p[1];
-        cache_x[ix] = inv_rx_2*dist*dist;
-    }
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type dist = iy-p[3];
-        cache_y[iy] = inv_ry_2*dist*dist;
-    }
-    // calc f
-    for (int iy = 0; iy < ny; ++iy) {
-        for (int ix = 0; ix < nx; ++ix) {
-            f[nx*iy+ix] = p[0]*pow(fmax(1. - cache_x[ix] - cache_y[iy], 0.0), 3./2.) + p[5];
-        }
-    }
-    """
-    
     def f(self, pars):
-        f = self._f
         cache_x, cache_y = self.cache
-        p = pars
-        weave.inline(self.f_code, ["f", "cache_x", "cache_y", "p"], **opt_args)
-    
-    fJ_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ncache_x[0];
-    const int ny = Ncache_y[0];
-    const int n = nx * ny;
-    const float_type invrx = 1. / p[2];
-    const float_type invry = 1. / p[4];
-
-    // cache values
-    for (int ix = 0; ix < nx; ++ix) {
-        float_type distx = ix-p[1];
-        cache_x[ix] = distx*invrx*invrx;
-    }
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type disty = iy-p[3];
-        cache_y[iy] = disty*invry*invry;
-    }
-    // calc f and jacobian
-    #pragma omp parallel for
-    for (int iy = 0; iy < ny; ++iy) {
-        const float_type disty = iy-p[3];
-        
-        for (int ix = 0; ix < nx; ++ix) {
-            const float_type distx = ix-p[1];
-            const int ind = nx*iy+ix;
-            
-            const float_type is_inside_p = (float_type) ((distx*cache_x[ix] + disty*cache_y[iy]) < 1.);
-            const float_type parab_sqrt = (is_inside_p) ? sqrt(1. - distx*cache_x[ix] - disty*cache_y[iy]) : 0.;
-            
-            f[ind] = p[0]*parab_sqrt*parab_sqrt*parab_sqrt + p[5];
-            J[ind] = parab_sqrt*parab_sqrt*parab_sqrt;
-            J[ind+1*n] = p[0]*3.*cache_x[ix] * parab_sqrt;
-            J[ind+2*n] = p[0]*3.*distx*cache_x[ix]*invrx * parab_sqrt;
-            J[ind+3*n] = p[0]*3.*cache_y[iy] * parab_sqrt;
-            J[ind+4*n] = p[0]*3.*disty*cache_y[iy]*invry * parab_sqrt;
-            J[ind+5*n] = 1.0;
-        }
-    }
-    """
+        if self._mask_coords is None:
+            kernels.thomasfermi2d_f(pars, self._f, cache_x, cache_y)
+        else:
+            iy, ix = self._mask_coords
+            kernels.thomasfermi2d_f_masked(pars, self._f, cache_x, cache_y, ix, iy)
     
     def fJ(self, pars):
-        f, J = self._f, self._J
         cache_x, cache_y = self.cache
-        p = pars
-        weave.inline(self.fJ_code, ["f", "J", "cache_x", "cache_y", "p"], **opt_args)
+        if self._mask_coords is None:
+            kernels.thomasfermi2d_fJ(pars, self._f, self._J, cache_x, cache_y)
+        else:
+            iy, ix = self._mask_coords
+            kernels.thomasfermi2d_fJ_masked(pars, self._f, self._J, cache_x, cache_y, ix, iy)
+
+    def fJBatch(self, pars, f, J):
+        m = len(pars)
+        ny, nx = self.data.shape
+        A, x_0, r_x, y_0, r_y, off = [pars[:, i, np.newaxis] for i in range(6)]
+
+        # scaled distances along x and y, shape (m, nx) and (m, ny)
+        dx = np.arange(nx, dtype = DEFAULT_TYPE_NPY) - x_0
+        dy = np.arange(ny, dtype = DEFAULT_TYPE_NPY) - y_0
+        cx = dx * (1. / r_x**2)
+        cy = dy * (1. / r_y**2)
+
+        # calc f and jacobian
+        f, J = f.reshape(m, ny, nx), J.reshape(m, 6, ny, nx)
+        parab_sqrt = 1. - (dx * cx)[:, np.newaxis, :] - (dy * cy)[:, :, np.newaxis]
+        np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+        np.sqrt(parab_sqrt, out = parab_sqrt)
+        np.multiply(parab_sqrt**2, parab_sqrt, out = J[:, 0])
+        np.multiply(J[:, 0], A[:, :, np.newaxis], out = f)
+        f += off[:, :, np.newaxis]
+        np.multiply(parab_sqrt, (3. * A * cx)[:, np.newaxis, :], out = J[:, 1])
+        np.multiply(parab_sqrt, (3. * A * cx * dx / r_x)[:, np.newaxis, :], out = J[:, 2])
+        np.multiply(parab_sqrt, (3. * A * cy)[:, :, np.newaxis], out = J[:, 3])
+        np.multiply(parab_sqrt, (3. * A * cy * dy / r_y)[:, :, np.newaxis], out = J[:, 4])
+        J[:, 5] = 1.0
 
     def sanitizePars(self, pars):
         pars[2] = abs(pars[2])
@@ -170,16 +134,42 @@ class Bimodal2D(LevmarFitter):
     The order of the fit parameters is (A_t, A_g, x_0, r_x, s_x, y_0, r_y, s_y, off). 
     
     :param data: (ndarray) Image to be fitted.
+    :param dtype: (dtype) Floating point type for computations or None.
     """
+    
+    pars_kind = (None, None, "x", "size", "size", "y", "size", "size", None)
+    supports_mask = True
+    
+    # parameter of each row of the normal equations accumulated by JTJ, gaussian rows first
+    JTJ_rows = (1, 2, 4, 5, 7, 8, 0, 2, 3, 5, 6)
+    
+    # fraction of the signal missed by the moment guess before falling back to projection fits
+    guess_tolerance = .5
         
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A_t", "A_g", "x_0", "r_x", "s_x", "y_0", "r_y", "s_y", "off"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A_t", "A_g", "x_0", "r_x", "s_x", "y_0", "r_y", "s_y", "off"], data, dtype)
         
-        cache_ex = np.empty(data.shape[1], dtype=float)
-        cache_ey = np.empty(data.shape[0], dtype=float)
+        cache_ex = np.empty(data.shape[1], dtype = self.dtype)
+        cache_ey = np.empty(data.shape[0], dtype = self.dtype)
         self.cache = (cache_ex, cache_ey)
     
     def guess(self):
+        """
+        Guess the parameters from the moments of the x and y projections, see
+        :func:`qao.fit.gauss.momentGuess2D`, with equal amplitudes and sizes of the
+        thermal and condensed fraction. If this guess misses more than `guess_tolerance`
+        of the signal, the parameters are guessed by :func:`guessProjectionFit`.
+        """
+        amp, x_0, s_x, y_0, s_y, off = momentGuess2D(self.data)
+        pars = np.asfarray((amp/2, amp/2, x_0, s_x, s_x, y_0, s_y, s_y, off))
+        if poorGuess(self, pars, self.guess_tolerance):
+            return self.guessProjectionFit()
+        return pars
+    
+    def guessProjectionFit(self):
+        """
+        Guess the parameters by fitting the x and y projections with :class:`Gauss1D`.
+        """
         # fit projection to x and y direction
         projection_fitter = Gauss1D(self.data.sum(axis=0))
         pars_x = projection_fitter.fit()
@@ -202,59 +192,110 @@ class Bimodal2D(LevmarFitter):
         off = 0.5 * (pars_x[3]/(ny-1) + pars_y[3]/(nx-1))
         return np.asfarray((amp/2, amp/2, x_0, s_x, s_x, y_0, s_y, s_y, off))
     
-    fJ_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ncache_ex[0];
-    const int ny = Ncache_ey[0];
-    const int n = nx * ny;
-    const float_type amp_t = fabs(p[0]);
-    const float_type amp_g = fabs(p[1]);
-    const float_type invrx = 1. / p[3];
-    const float_type invsx = 1. / p[4];
-    const float_type invry = 1. / p[6];
-    const float_type invsy = 1. / p[7];
-
-    // cache exp values
-    for (int ix = 0; ix < nx; ++ix) {
-        float_type dist = ix-p[2];
-        cache_ex[ix] = exp(-.5*invsx*invsx*dist*dist);
-    }
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type dist = iy-p[5];
-        cache_ey[iy] = exp(-.5*invsy*invsy*dist*dist);
-    }
-    // calc f and jacobian
-    #pragma omp parallel for
-    for (int iy = 0; iy < ny; ++iy) {
-        const float_type disty = iy-p[5];
-        
-        for (int ix = 0; ix < nx; ++ix) {
-            const int ind = nx*iy+ix;
-            const float_type distx = ix-p[2];
-            
-            const float_type gauss = amp_g * cache_ex[ix] * cache_ey[iy];
-            
-            const float_type is_inside_p = (float_type) ((distx*distx*invrx*invrx + disty*disty*invry*invry) < 1.);
-            const float_type parab_sqrt = (is_inside_p) ? sqrt(1. - distx*distx*invrx*invrx - disty*disty*invry*invry) : 0.;
-            
-            f[ind] = gauss + amp_t*parab_sqrt*parab_sqrt*parab_sqrt + p[8];
-            J[ind] = parab_sqrt*parab_sqrt*parab_sqrt;
-            J[ind+1*n] = cache_ex[ix] * cache_ey[iy];
-            J[ind+2*n] = amp_t*3.*distx*invrx*invrx*parab_sqrt + distx*invsx*invsx*gauss;
-            J[ind+3*n] = amp_t*3.*distx*distx*invrx*invrx*invrx * parab_sqrt;
-            J[ind+4*n] = distx*distx*invsx*invsx*invsx * gauss;
-            J[ind+5*n] = amp_t*3.*disty*invry*invry*parab_sqrt + disty*invsy*invsy*gauss;
-            J[ind+6*n] = amp_t*3.*disty*disty*invry*invry*invry * parab_sqrt;
-            J[ind+7*n] = disty*disty*invsy*invsy*invsy * gauss;
-            J[ind+8*n] = 1.0;
-        }
-    }
-    """
+    def f(self, pars):
+        cache_ex, cache_ey = self.cache
+        if self._mask_coords is None:
+            kernels.bimodal2d_f(pars, self._f, cache_ex, cache_ey)
+        else:
+            iy, ix = self._mask_coords
+            kernels.bimodal2d_f_masked(pars, self._f, cache_ex, cache_ey, ix, iy)
     
     def fJ(self, pars):
-        f, J = self._f, self._J
         cache_ex, cache_ey = self.cache
-        p = pars
-        weave.inline(self.fJ_code, ["f", "J", "cache_ex", "cache_ey", "p"], **opt_args)
+        if self._mask_coords is None:
+            kernels.bimodal2d_fJ(pars, self._f, self._J, cache_ex, cache_ey)
+        else:
+            iy, ix = self._mask_coords
+            kernels.bimodal2d_fJ_masked(pars, self._f, self._J, cache_ex, cache_ey, ix, iy)
+
+    def JTJ(self, pars, r):
+        A_t, A_g, x_0, r_x, s_x, y_0, r_y, s_y, off = np.asarray(pars, dtype = DEFAULT_TYPE_NPY)
+        amp_t, amp_g = abs(A_t), abs(A_g)
+        ny, nx = self.data.shape
+        r = r.reshape(ny, nx)
+        dx = np.arange(nx, dtype = DEFAULT_TYPE_NPY) - x_0
+        dy = np.arange(ny, dtype = DEFAULT_TYPE_NPY) - y_0
+        ex = np.exp(-.5 * dx**2 / s_x**2)
+        ey = np.exp(-.5 * dy**2 / s_y**2)
+
+        # the gaussian rows are outer products G_k(y, x) = V_k(y) * U_k(x), see Gauss2D.JTJ
+        U = np.empty([6, nx], dtype = DEFAULT_TYPE_NPY)
+        V = np.empty([6, ny], dtype = DEFAULT_TYPE_NPY)
+        U[0] = ex;                         V[0] = ey
+        U[1] = amp_g * dx / s_x**2 * ex;   V[1] = ey
+        U[2] = U[1] * dx / s_x;            V[2] = ey
+        U[3] = ex;                         V[3] = amp_g * dy / s_y**2 * ey
+        U[4] = ex;                         V[4] = V[3] * dy / s_y
+        U[5] = 1.;                         V[5] = 1.
+
+        # normal equations of the gaussian rows (A_g, x_0, s_x, y_0, s_y, off) and the
+        # thomas fermi rows (A_t, x_0, r_x, y_0, r_y), the latter vanish outside the ellipse
+        E = np.zeros([11, 11])
+        e = np.zeros(11)
+        E[:6, :6] = np.inner(U, U) * np.inner(V, V)
+        e[:6] = (np.dot(V.astype(self.dtype), r) * U).sum(axis = 1)
+        x1, x2 = max(0, int(np.floor(x_0 - abs(r_x)))), min(nx, int(np.ceil(x_0 + abs(r_x))) + 1)
+        y1, y2 = max(0, int(np.floor(y_0 - abs(r_y)))), min(ny, int(np.ceil(y_0 + abs(r_y))) + 1)
+        if x1 < x2 and y1 < y2:
+            bx, by = dx[x1:x2], dy[y1:y2, np.newaxis]
+            parab_sqrt = 1. - bx**2 / r_x**2 - by**2 / r_y**2
+            np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+            np.sqrt(parab_sqrt, out = parab_sqrt)
+            T = np.empty((5, ) + parab_sqrt.shape, dtype = DEFAULT_TYPE_NPY)
+            T[0] = parab_sqrt**3
+            T[1] = parab_sqrt * (3. * amp_t * bx / r_x**2)
+            T[2] = parab_sqrt * (3. * amp_t * bx**2 / r_x**3)
+            T[3] = parab_sqrt * (3. * amp_t * by / r_y**2)
+            T[4] = parab_sqrt * (3. * amp_t * by**2 / r_y**3)
+            G = V[:, y1:y2, np.newaxis] * U[:, np.newaxis, x1:x2]
+            T, G = T.reshape(5, -1), G.reshape(6, -1)
+            E[6:, 6:] = np.inner(T, T)
+            E[6:, :6] = np.inner(T, G)
+            E[:6, 6:] = E[6:, :6].T
+            e[6:] = np.dot(T, r[y1:y2, x1:x2].ravel())
+
+        # x_0 and y_0 enter both parts, their rows of the jacobian are the sums
+        M = np.zeros([9, 11])
+        M[self.JTJ_rows, range(11)] = 1.
+        return np.dot(M, np.dot(E, M.T)), np.dot(M, e)
+
+    def fJBatch(self, pars, f, J):
+        m = len(pars)
+        ny, nx = self.data.shape
+        amp_t, amp_g = np.abs(pars[:, 0, np.newaxis]), np.abs(pars[:, 1, np.newaxis])
+        x_0, r_x, s_x, y_0, r_y, s_y, off = [pars[:, i, np.newaxis] for i in range(2, 9)]
+
+        # distances and exp values along x and y, shape (m, nx) and (m, ny)
+        dx = np.arange(nx, dtype = DEFAULT_TYPE_NPY) - x_0
+        dy = np.arange(ny, dtype = DEFAULT_TYPE_NPY) - y_0
+        ex = np.exp(-.5 * dx**2 / s_x**2)
+        ey = np.exp(-.5 * dy**2 / s_y**2)
+
+        # calc f and jacobian
+        f, J = f.reshape(m, ny, nx), J.reshape(m, 9, ny, nx)
+        gauss = J[:, 1]
+        np.multiply(ey[:, :, np.newaxis], ex[:, np.newaxis, :], out = gauss)
+        parab_sqrt = 1. - (dx**2 / r_x**2)[:, np.newaxis, :] - (dy**2 / r_y**2)[:, :, np.newaxis]
+        np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+        np.sqrt(parab_sqrt, out = parab_sqrt)
+        np.multiply(parab_sqrt**2, parab_sqrt, out = J[:, 0])
+
+        np.multiply(J[:, 0], amp_t[:, :, np.newaxis], out = f)
+        f += off[:, :, np.newaxis]
+        J[:, 8] = gauss
+        J[:, 8] *= amp_g[:, :, np.newaxis]
+        f += J[:, 8]
+        gauss = J[:, 8]
+
+        np.multiply(parab_sqrt, (3. * amp_t * dx / r_x**2)[:, np.newaxis, :], out = J[:, 2])
+        J[:, 2] += gauss * (dx / s_x**2)[:, np.newaxis, :]
+        np.multiply(parab_sqrt, (3. * amp_t * dx**2 / r_x**3)[:, np.newaxis, :], out = J[:, 3])
+        np.multiply(gauss, (dx**2 / s_x**3)[:, np.newaxis, :], out = J[:, 4])
+        np.multiply(parab_sqrt, (3. * amp_t * dy / r_y**2)[:, :, np.newaxis], out = J[:, 5])
+        J[:, 5] += gauss * (dy / s_y**2)[:, :, np.newaxis]
+        np.multiply(parab_sqrt, (3. * amp_t * dy**2 / r_y**3)[:, :, np.newaxis], out = J[:, 6])
+        np.multiply(gauss, (dy**2 / s_y**3)[:, :, np.newaxis], out = J[:, 7])
+        J[:, 8] = 1.0
 
     def sanitizePars(self, pars):
         pars[[0,1,3,4,6,7]] = np.abs(pars[[0,1,3,4,6,7]])
@@ -0,0 +1,191 @@
+"""
+Multiprocessing
+---------------
+
+Fitting a long series of images, e.g. all shots of a scan, is easily distributed
+over several processes. The :class:`FitJob` keeps a pool of worker processes, each
+owning a single fitter instance that is reused for every dataset by
+:func:`LevmarFitter.setData`. The datasets are placed in shared memory once, so the
+workers only receive an index instead of a pickled copy of the image.
+
+Example::
+
+    import numpy as np
+    from qao.fit import Gauss2D, FitJob
+
+    images = np.random.rand(2000, 100, 100)
+    with FitJob(Gauss2D, images) as job:
+        pars, errs, logs = job.run(callback = lambda done, total: True)
+
+"""
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from fitter import DEFAULT_TYPE_NPY
+
+# ctypes typecode matching DEFAULT_TYPE_NPY
+_shared_typecode = np.dtype(DEFAULT_TYPE_NPY).char
+
+# state of a worker process, set by _workerInit
+_worker = {}
+
+def _workerInit(fitter_class, fitter_args, fitter_kwargs, shared, shape, mask, sigma):
+    data = np.frombuffer(shared, dtype = DEFAULT_TYPE_NPY).reshape(shape)
+    _worker["data"] = data
+    _worker["fitter"] = fitter = fitter_class(data[0], *fitter_args, **fitter_kwargs)
+    if mask is not None: fitter.setMask(mask)
+    if sigma is not None: fitter.setSigma(sigma)
+
+def _workerFit(task):
+    i, pars_guess, errors, fit_kwargs = task
+    fitter = _worker["fitter"]
+    fitter.setData(_worker["data"][i])
+    try:
+        pars, fit_log = fitter.fit(pars_guess, return_dict = True, **fit_kwargs)
+        pars_err = fitter.getFitErr() if errors else None
+    except (ValueError, ArithmeticError, np.linalg.LinAlgError) as e:
+        # a single broken dataset must not abort the whole job
+        pars = np.nan * np.empty(len(fitter.pars_name))
+        pars_err = pars.copy() if errors else None
+        fit_log = {"iter": 0, "reason": "error: %s" % e, "success": False}
+    return i, pars, pars_err, fit_log
+
+class FitJob(object):
+    """
+    Fit a stack of datasets on a pool of worker processes.
+
+    The first axis of `data` enumerates the datasets, the remaining axes are passed
+    to the fitter. All datasets must share the same shape. Additional arguments
+    for constructing the fitters can be given by `fitter_args` and `fitter_kwargs`.
+    A common mask and standard deviations for all datasets are passed to the fitters
+    by :func:`LevmarFitter.setMask` and :func:`LevmarFitter.setSigma`.
+    The pool is started on the first call to :func:`run` and kept alive until
+    :func:`close` is called, so a job can be rerun on new data of the same shape
+    using :func:`setData`. A fitter is constructed for the first dataset beforehand,
+    so invalid fitter arguments raise here instead of failing within the workers.
+
+    :param fitter_class: (class) Fitter class derived from :class:`LevmarFitter`.
+    :param data: (ndarray) Stack of datasets to be fitted.
+    :param processes: (int) Number of worker processes, None for all cpus.
+    :param mask: (ndarray) Points excluded from fitting or None.
+    :param sigma: (ndarray) Standard deviations of the data points or None.
+    """
+
+    def __init__(self, fitter_class, data, processes = None, fitter_args = (), fitter_kwargs = None,
+                 mask = None, sigma = None):
+        data = np.asarray(data)
+        if data.ndim < 2:
+            raise ValueError("Expected a stack of datasets.")
+        self.fitter_class = fitter_class
+        self.fitter_args = tuple(fitter_args)
+        self.fitter_kwargs = dict(fitter_kwargs or {})
+        self.mask = mask
+        self.sigma = sigma
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shape = data.shape
+        self._shared = RawArray(_shared_typecode, int(np.prod(self.shape)))
+        self.data = np.frombuffer(self._shared, dtype = DEFAULT_TYPE_NPY).reshape(self.shape)
+        self.data[:] = data
+        self._pool = None
+
+        # workers failing to construct their fitter are restarted by the pool forever
+        fitter = fitter_class(self.data[0], *self.fitter_args, **self.fitter_kwargs)
+        if mask is not None: fitter.setMask(mask)
+        if sigma is not None: fitter.setSigma(sigma)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def setData(self, data):
+        """
+        Replace the datasets to be fitted. The shape of the stack must not change.
+
+        :param data: (ndarray) New stack of datasets.
+        """
+        data = np.asarray(data)
+        if data.shape != self.shape:
+            raise ValueError("Shape mismatch. Expected dimensions %s." % (self.shape, ))
+        self.data[:] = data
+
+    def start(self):
+        """
+        Start the worker processes. This is done automatically by :func:`run`.
+        """
+        if self._pool is None:
+            initargs = (self.fitter_class, self.fitter_args, self.fitter_kwargs, self._shared, self.shape,
+                        self.mask, self.sigma)
+            self._pool = multiprocessing.Pool(self.processes, _workerInit, initargs)
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def run(self, pars_guess = None, errors = True, callback = None, chunksize = None, **fit_kwargs):
+        """
+        Fit all datasets and return the results in the order of the datasets.
+
+        Initial parameters can be given for all datasets at once or individually
+        as (N, p) array. If `pars_guess` is None, each dataset is guessed by its
+        fitter. Further keyword arguments are passed to :func:`LevmarFitter.fit`.
+
+        A callback function can be provided to monitor or cancel the job. It takes
+        the number of finished fits and the total number of fits as arguments and
+        must return a bool indicating if the job should continue. If the job is
+        cancelled, the remaining results are NaN and marked as not successful.
+
+        :param pars_guess: (ndarray) Start parameters for fitting or None.
+        :param errors: (bool) Estimate the fit parameter errors.
+        :param callback: (callable) Progress callback function.
+        :param chunksize: (int) Number of datasets sent to a worker at once.
+        :returns: (ndarray, ndarray, list) Fit parameters, errors and fit logs.
+        """
+        n = self.shape[0]
+        if pars_guess is not None:
+            pars_guess = np.asfarray(pars_guess, dtype = DEFAULT_TYPE_NPY)
+            pars_guess = np.broadcast_to(pars_guess, (n, pars_guess.shape[-1]))
+        if chunksize is None:
+            chunksize = max(1, n // (4 * self.processes))
+
+        self.start()
+        tasks = ((i, None if pars_guess is None else pars_guess[i], errors, fit_kwargs) for i in range(n))
+        results = [None] * n
+        try:
+            for done, result in enumerate(self._pool.imap(_workerFit, tasks, chunksize), 1):
+                results[result[0]] = result
+                if callback is not None and not callback(done, n):
+                    # workers are busy with cancelled tasks, restart the pool next time
+                    self.close()
+                    break
+        except:
+            self.close()
+            raise
+
+        n_pars = None
+        for result in results:
+            if result is not None:
+                n_pars = len(result[1])
+                break
+        pars_fit = np.nan * np.empty([n, n_pars or 0])
+        pars_err = np.nan * np.empty([n, n_pars or 0]) if errors else None
+        fit_logs = []
+        for i, result in enumerate(results):
+            if result is None:
+                fit_logs.append({"iter": 0, "reason": "cancelled", "success": False})
+                continue
+            pars_fit[i] = result[1]
+            if errors: pars_err[i] = result[2]
+            fit_logs.append(result[3])
+        return pars_fit, pars_err, fit_logs
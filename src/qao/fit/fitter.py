@@ -1,3 +1,5 @@
+import multiprocessing
+import time
 import numpy as np
 import scipy.stats
 
@@ -10,6 +12,10 @@ DELTA_ABS = 1.5e-8
 DEFAULT_TYPE_NPY = np.double
 DEFAULT_TYPE_C = "double"
 
+# timings and counters recorded by profiling fitters
+PROFILE_TIMES = ("guess", "fJ", "normal", "solve", "error")
+PROFILE_COUNTS = ("fJ_calls", "rejected")
+
 class LevmarFitter(object):
     """
     Base fitter class implementing the Levenberg-Marquardt non-linear least squares algorithm.
@@ -21,8 +27,9 @@ class LevmarFitter(object):
     the results using :func:`getFitPars`, :func:`getFitErr` and :func:`getFitData`.
     
     When processing multiple datasets, each having the same dimensions, you can reuse a fitter
-    by setting new data using the :func:`setData` method.
-    
+    by setting new data using the :func:`setData` method. A whole stack of such datasets can
+    also be fitted at once using :func:`fitBatch`.
+
     **Writing new fitters**
     
     The :class:`LevmarFitter` class must be subclassed for new fit model functions. For each
@@ -37,7 +44,9 @@ class LevmarFitter(object):
     First, you reimplement the :func:`__init__` method and provide the names for the fit parameters
     as simple list of strings when calling the parent constructor. This also determines the
     number of parameters at this point. The data argument is normally passed on to the parent
-    constructor and determines the space to be allocated for computations.
+    constructor and determines the space to be allocated for computations. The optional `dtype`
+    argument selects the floating point precision and should be passed on as well. Any cache
+    used by your model should be allocated with `self.dtype`.
     
     Second, you implement the methods :func:`f` and/or :func:`fJ`.
     The first function computes your function values for a given set of fit parameters,
@@ -47,16 +56,43 @@ class LevmarFitter(object):
     expect a significant increase in performance, as you can optimize simultaneous calculation
     of f and J. Please refer to the method documentation for further implementation details.
     
+    If you implement :func:`f` only, you may also implement :func:`fBatch` for evaluating
+    many parameter sets within one vectorized call, which speeds up the approximation of
+    the jacobian.
+    
     Third, you implement the :func:`guess` method. For implementation details, see method
     documentation.
 
+    Optionally, you implement :func:`fJBatch` for calculating the function values and jacobians
+    of many parameter sets within one vectorized call. This is used by :func:`fitBatch` and
+    defaults to calling :func:`fJ` for each parameter set.
+
+    Two-dimensional models may define the class attribute `pars_kind`, a tuple describing
+    how each fit parameter transforms when the image is binned or cropped. Use "x" and "y"
+    for positions along the x and y axis, "size" for lengths like widths or radii and None
+    for parameters not depending on the pixel grid. This enables :func:`fitPyramid`.
+
+    For large datasets, you may implement :func:`JTJ` in addition to :func:`f`. This method
+    accumulates the normal equations of the fit problem directly, so the fitter does not need
+    to store the jacobian when fitting unweighted data. The memory used per fitter is then
+    independent of the number of data points, apart from `self._f`.
+
+    Models may set the class attribute `supports_mask` to evaluate only the pixels selected
+    by :func:`setMask`. If a mask is set, `self._f` and `self._J` hold the selected pixels
+    only, in the order of `self._mask_index`, and the models find the coordinates of these
+    pixels in `self._mask_coords`, as returned by :func:`numpy.unravel_index`. Otherwise
+    the model is evaluated for all data points and the masked points are discarded.
+
     .. note::
     
-        The constants `DEFAULT_TYPE_NPY` and `DEFAULT_TYPE_C` from :mod:`qao.fit.fitter` should be
-        used to abstract the floating type for changing the precision if desired.
+        The constant `DEFAULT_TYPE_NPY` from :mod:`qao.fit.fitter` is the default
+        floating type. The precision of a fitter instance is given by `self.dtype`.
+        The fitters shipped with this package compute their models using the
+        kernels from :mod:`qao.fit.kernels`.
     
     :param par_names: (list) List of fit parameter names.
     :param data: (ndarray) Data to be fitted.
+    :param dtype: (dtype) Floating point type for computations or None.
     
     This is a simple example subclass that implements a 1d gaussian
     fitter including a guess method::
@@ -64,8 +100,8 @@ class LevmarFitter(object):
         from qao.fit.fitter import LevmarFitter, DEFAULT_TYPE_NPY
         
         class GaussFitter(LevmarFitter):
-            def __init__(self, data):
-                LevmarFitter.__init__(self, ["A", "x0", "sigma"], data)
+            def __init__(self, data, dtype = None):
+                LevmarFitter.__init__(self, ["A", "x0", "sigma"], data, dtype)
             
             def guess(self):
                 # determine maximum value
@@ -95,22 +131,114 @@ class LevmarFitter(object):
                 self._J[1, :] = (x-x0)/sig**2 * self._f[:]
                 self._J[2, :] = (x-x0)**2/sig**3 * self._f[:]                
     """
-    def __init__(self, pars_name, data):
+    
+    # kind of each fit parameter with respect to the pixel grid, see fitPyramid
+    pars_kind = None
+    
+    # model evaluates the unmasked pixels only, see setMask
+    supports_mask = False
+    
+    # step size limit relative to the norm of the parameters, used if eps2 is None
+    eps2_default = 1e-6
+    
+    def __init__(self, pars_name, data, dtype = None):
         """
         Provide parameter names and data for fitting. This will determine the
         amount of space allocated for computations and is not to be changed later.
         
+        The floating point type of the data, the model function and the jacobian
+        is given by `dtype`, defaulting to `DEFAULT_TYPE_NPY`. The fit parameters,
+        the normal equations and the error estimates are always calculated in
+        double precision.
+        
         :param par_names: (list) List of fit parameter names.
         :param data: (ndarray) Data to be fitted.
+        :param dtype: (dtype) Floating point type for computations or None.
         """
         self.pars_name = pars_name
+        self.dtype = np.dtype(DEFAULT_TYPE_NPY if dtype is None else dtype)
         self.pars_fit = np.zeros(len(pars_name), dtype = DEFAULT_TYPE_NPY)
-        self.data = np.asfarray(data, dtype = DEFAULT_TYPE_NPY)
+        self._mask = None
+        self._mask_index = None
+        self._mask_coords = None
+        self.__buffer = None
+        self.data = self.__convert(data)
         self._invsigma = None
-        self._f = np.empty(self.data.size, dtype = DEFAULT_TYPE_NPY)
-        self._J = np.empty([self.pars_fit.size, self._f.size], dtype = DEFAULT_TYPE_NPY)
+        self._f = np.empty(self.data.size, dtype = self.dtype)
+        self.__J = None
+        self.__Jstep = None
+        self.__normal = None
+        self._pyramid = {}
+        self._cache = None
+        self.__profile = None
+        self._profile_totals = {}
+        
+        # models implementing JTJ do not need the full jacobian
+        self._has_JTJ = self.__implements("JTJ")
+        self._has_f = self.__implements("f")
+        self._has_fBatch = self.__implements("fBatch")
+        self._jacobian_approx = "central"
+        self._damping = "identity"
+        self._geodesic = False
+        self._geodesic_h = .1
+        self._geodesic_alpha = .75
         
         self.verbose = False
+        self.profiling = False
+        self.fit_log = None
+    
+    @property
+    def data(self):
+        """
+        Data to be fitted, see :func:`setData`.
+        """
+        return self.__data
+    
+    @data.setter
+    def data(self, data):
+        # the flat view is derived from the data on first use
+        self.__data = data
+        self.__data_flat = None
+    
+    @property
+    def _data_flat(self):
+        # flat data, or the masked data points only, gathered on every call
+        data_flat = self.__data_flat
+        if data_flat is None:
+            data_flat = self.__data.reshape(-1)
+            # cache views only, a copy of non-contiguous data misses in-place updates
+            if np.may_share_memory(data_flat, self.__data):
+                self.__data_flat = data_flat
+        if self._mask_index is not None:
+            data_flat = data_flat[self._mask_index]
+        return data_flat
+    
+    def __convert(self, data):
+        """
+        Return data of the fitter dtype. Data of a different type, like integer
+        camera frames, is converted into a buffer allocated once per fitter.
+        """
+        data = np.asarray(data)
+        if data.dtype == self.dtype:
+            return data
+        if self.__buffer is None or self.__buffer.shape != data.shape:
+            self.__buffer = np.empty(data.shape, dtype = self.dtype)
+        np.copyto(self.__buffer, data, casting = "unsafe")
+        return self.__buffer
+    
+    @property
+    def _J(self):
+        # the jacobian is allocated on first use
+        if self.__J is None:
+            self.__J = np.empty([self.pars_fit.size, self._f.size], dtype = self.dtype)
+        return self.__J
+    
+    def __implements(self, name):
+        """
+        Check if an optional method is reimplemented by a subclass.
+        """
+        mro = type(self).__mro__
+        return any(name in vars(cls) for cls in mro[:mro.index(LevmarFitter)])
     
     def setVerbose(self, verbose):
         """
@@ -121,18 +249,128 @@ class LevmarFitter(object):
         """
         self.verbose = bool(verbose)
     
+    def setProfiling(self, profiling):
+        """
+        Enable recording where the time of each fit is spent. The fit dictionary
+        then includes a "profile" dictionary with the times in seconds spent in
+        :func:`guess`, evaluating the model and jacobian ("fJ"), accumulating the
+        normal equations ("normal"), solving the linear systems ("solve") and
+        estimating the errors ("error"), together with the number of model
+        evaluations ("fJ_calls") and rejected steps ("rejected"). The sums over
+        all fits since profiling was enabled are returned by :func:`getProfile`.
+        
+        :param profiling: (bool) Enable/disable profiling.
+        """
+        self.profiling = bool(profiling)
+        self.resetProfile()
+    
+    def getProfile(self):
+        """
+        Return the profile summed over all fits since the last :func:`resetProfile`,
+        see :func:`setProfiling`. The number of fits is given as "fits".
+        
+        :returns: (dict) Aggregated fit profile.
+        """
+        return dict(self._profile_totals)
+    
+    def resetProfile(self):
+        """
+        Reset the aggregated fit profile.
+        """
+        self._profile_totals.clear()
+        self._profile_totals.update(dict.fromkeys(PROFILE_TIMES, 0.))
+        self._profile_totals.update(dict.fromkeys(PROFILE_COUNTS + ("fits", ), 0))
+    
+    def __timed(self, key, func, *args):
+        """
+        Call func, adding its run time to the profile of the current fit.
+        """
+        if self.__profile is None:
+            return func(*args)
+        t0 = time.time()
+        result = func(*args)
+        self.__profile[key] += time.time() - t0
+        return result
+    
+    def __profileEnd(self, profile):
+        """
+        Add the profile of a finished fit or error estimate to the totals.
+        """
+        self.__profile = None
+        if not self._profile_totals:
+            self.resetProfile()
+        for key, value in profile.items():
+            self._profile_totals[key] += value
+    
     def setData(self, data):
         """
         Change the data to be fitted. The shape of the data must not change. For
         fitting a dataset with different shape you need to create a new fitter
         instance.
         
+        Data matching the dtype of the fitter is referenced without copying.
+        Other data, like integer camera frames, is converted into a buffer that
+        is reused by every call, so the previous data is overwritten.
+        
         :param data: (ndarray) New data to be fitted.
         """
-        data = np.asfarray(data, dtype = DEFAULT_TYPE_NPY)
+        data = np.asarray(data)
         if self.data.shape != data.shape:
-            raise ValueError("Shape mismatch. Expected dimensions %s." % self.data.shape) 
-        self.data = data
+            raise ValueError("Shape mismatch. Expected dimensions %s." % (self.data.shape, ))
+        self.data = self.__convert(data)
+        self.__normal = None
+    
+    def setJacobianApprox(self, method):
+        """
+        Select the finite difference scheme for approximating the jacobian of
+        models implementing :func:`f` only.
+        
+        The "central" differences need two evaluations of the model per fit
+        parameter. The "forward" differences reuse the unperturbed function
+        values and need only one evaluation per fit parameter, at the cost of
+        a less accurate jacobian.
+        
+        :param method: (str) Either "central" or "forward".
+        """
+        if method not in ("central", "forward"):
+            raise ValueError("Unknown jacobian approximation %s." % method)
+        self._jacobian_approx = method
+    
+    def setSolver(self, damping = "identity", geodesic = False, geodesic_h = .1, geodesic_alpha = .75):
+        """
+        Select the variant of the Levenberg-Marquardt iteration used by :func:`fit`.
+        
+        The "identity" damping adds the same damping to every parameter. With
+        "marquardt" damping, the damping of each parameter is scaled by the largest
+        diagonal element of the normal equations seen so far, which makes the
+        iteration independent of the very different scales of amplitudes and
+        widths. In both cases the eigensystem of the normal equations is reused
+        for all damping values tried until a step is accepted.
+        
+        With `geodesic` acceleration, each step is corrected by the second
+        derivative of the model along the step, estimated by finite differences
+        with the relative step `geodesic_h`. Steps with an acceleration larger than
+        `geodesic_alpha` times the velocity are rejected. This costs two model
+        evaluations and one gradient per iteration. It may reduce the number of
+        iterations along curved valleys of the residuals, but for the models of
+        this package it usually does not and adds model evaluations instead. The
+        jacobian is then only evaluated for accepted steps, unless the model
+        implements :func:`fJ` only.
+        
+        The solver settings are passed on to the fitters used by :func:`fitPyramid`.
+        :func:`fitBatch` honors the damping, but does not use geodesic acceleration.
+        
+        :param damping: (str) Either "identity" or "marquardt".
+        :param geodesic: (bool) Enable geodesic acceleration.
+        :param geodesic_h: (float) Finite difference step for the second derivative.
+        :param geodesic_alpha: (float) Maximum ratio of acceleration and velocity.
+        """
+        if damping not in ("identity", "marquardt"):
+            raise ValueError("Unknown damping %s." % damping)
+        self._damping = damping
+        self._geodesic = bool(geodesic)
+        self._geodesic_h = float(geodesic_h)
+        self._geodesic_alpha = float(geodesic_alpha)
     
     def setSigma(self, sigma):
         """
@@ -144,12 +382,79 @@ class LevmarFitter(object):
         """
         if sigma is not None:
             # TODO: allow sigma to be scalar
-            sigma = np.asfarray(sigma, dtype = DEFAULT_TYPE_NPY) 
+            sigma = np.asarray(sigma, dtype = self.dtype)
             self._invsigma = 1. / sigma
         else:
             self._invsigma = None
+        self.__normal = None
+    
+    def setCache(self, cache):
+        """
+        Assign a :class:`qao.fit.cache.FitCache` storing the results of :func:`fit`.
+        Repeated fits of the same data with the same settings are then answered from
+        the cache. Fits monitored by a callback function are not cached. Set None to
+        remove the cache from this fitter.
+        
+        :param cache: (FitCache) Result cache or None.
+        """
+        self._cache = cache
     
-    def fit(self, pars_guess = None, tau = 1e-2, eps1 = 1e-6, eps2 = 1e-6, kmax = 50, return_dict = False, callback = None):
+    def setMask(self, mask = None, roi = None):
+        """
+        Exclude data points from fitting.
+        
+        Following the convention of :mod:`numpy.ma`, points are excluded where
+        `mask` is True. Additionally, the fit can be restricted to a rectangular
+        region of interest given as tuple of slices, e.g. ``np.s_[10:90, 20:120]``.
+        Call without arguments to fit all data points again.
+        
+        The indices of the remaining points are computed once by this method.
+        Models supporting masks, like the two-dimensional models of this package,
+        evaluate the function values and jacobians for these points only. The
+        residuals and normal equations are always restricted to these points.
+        The methods :func:`guess` and :func:`getFitData` still work on the whole
+        dataset.
+        
+        :param mask: (ndarray) Boolean array, True for points to be excluded, or None.
+        :param roi: (tuple) Slices selecting the region of interest or None.
+        """
+        valid = np.ones(self.data.shape, dtype = bool)
+        if mask is not None:
+            mask = np.asarray(mask, dtype = bool)
+            if mask.shape != self.data.shape:
+                raise ValueError("Shape mismatch. Expected dimensions %s." % (self.data.shape, ))
+            valid &= ~mask
+        if roi is not None:
+            valid_roi = np.zeros_like(valid)
+            valid_roi[roi] = True
+            valid &= valid_roi
+        
+        if valid.all():
+            self._mask = self._mask_index = self._mask_coords = None
+        else:
+            index = np.flatnonzero(valid)
+            if index.size <= len(self.pars_name):
+                raise ValueError("Not enough data points left for fitting.")
+            self._mask = ~valid
+            self._mask_index = index
+            self._mask_coords = np.unravel_index(index, self.data.shape)
+        
+        # compact buffers for models evaluating the selected points only
+        size = self.data.size if self._mask_index is None or not self.supports_mask else self._mask_index.size
+        if size != self._f.size:
+            self._f = np.empty(size, dtype = self.dtype)
+            self.__J = self.__Jstep = None
+        self.__normal = None
+    
+    def getMask(self):
+        """
+        Return the data points excluded from fitting.
+        
+        :returns: (ndarray) Boolean array, True for excluded points, or None.
+        """
+        return self._mask
+    
+    def fit(self, pars_guess = None, tau = 1e-2, eps1 = 1e-6, eps2 = None, kmax = 50, return_dict = False, callback = None):
         """
         Fit the data currently assigned to the fitter.
         
@@ -170,22 +475,324 @@ class LevmarFitter(object):
                 print "Iteration at", k
                 return True
         
+        The fit stops if the gradient is smaller than `eps1` or the step is smaller
+        than `eps2` times the norm of the parameters. If `eps2` is None, the default
+        `eps2_default` of the model is used.
+        
         :param pars_guess: (ndarray) Start parameters for fitting. If None, guess from data.
         :param callback: (callable) Callback function.
         :returns: (ndarray) Fit parameters + optional fit dictionary.
         """
-        if pars_guess is None:
-            pars_guess = self.guess()
+        if eps2 is None:
+            eps2 = self.eps2_default
+        cache_key = None
+        if self._cache is not None and callback is None:
+            options = (tau, eps1, eps2, kmax, self._jacobian_approx, self._damping,
+                       self._geodesic, self._geodesic_h, self._geodesic_alpha)
+            cache_key = self._cache.key(self, pars_guess, options)
+            result = self._cache.get(cache_key)
+            if result is not None:
+                self.pars_fit[:], self.fit_log = result
+                if return_dict:
+                    return self.pars_fit.copy(), self.fit_log
+                else:
+                    return self.pars_fit.copy()
         
-        if len(pars_guess) != len(self.pars_name):
-            raise ValueError("Invalid number of guess parameters.")
+        if self.profiling:
+            self.__profile = dict.fromkeys(PROFILE_TIMES, 0.)
+            self.__profile.update(dict.fromkeys(PROFILE_COUNTS, 0))
         
-        pars_fit, fit_dict = self.__LM(pars_guess, tau, eps1, eps2, kmax, verbose = self.verbose, return_dict = True, callback = callback)
-        self.pars_fit[:] = self.sanitizePars(pars_fit)
+        try:
+            if pars_guess is None:
+                pars_guess = self.__timed("guess", self.guess)
+            
+            if len(pars_guess) != len(self.pars_name):
+                raise ValueError("Invalid number of guess parameters.")
+            
+            pars_fit, fit_dict = self.__LM(pars_guess, tau, eps1, eps2, kmax, verbose = self.verbose, return_dict = True, callback = callback)
+            self.pars_fit[:] = self.sanitizePars(pars_fit)
+            if cache_key is not None:
+                self._cache.put(cache_key, self.pars_fit, fit_dict)
+            if self.__profile is not None:
+                fit_dict["profile"] = profile = self.__profile
+                self.__profileEnd(dict(profile, fits = 1))
+        finally:
+            # a failed fit must not leave its partial profile to the next fit
+            self.__profile = None
         if return_dict:
             return self.pars_fit.copy(), fit_dict
         else:
             return self.pars_fit.copy()
+
+    def fitBatch(self, data, pars_guess = None, tau = 1e-2, eps1 = 1e-6, eps2 = None, kmax = 50, return_dict = False):
+        """
+        Fit a stack of datasets within a single batched fit run.
+
+        Each item of the stack must have the shape of the data assigned to the
+        fitter. All fit problems are iterated together, the function values
+        and jacobians are calculated for the whole stack by :func:`fJBatch` and
+        the normal equations are solved as a stack of small linear systems.
+        Items which reached a stop condition are masked from further iterations.
+        The damping selected by :func:`setSolver` is used, geodesic acceleration
+        is not.
+
+        The data assigned to the fitter and the results of :func:`fit` are
+        not modified. If `return_dict` is set, a list of fit dictionaries as
+        described in :func:`getFitLog` is returned as well.
+
+        Batch fitting multiple images::
+
+            fitter = Gauss2D(images[0])
+            pars_fit = fitter.fitBatch(images)
+
+        :param data: (ndarray) Stack of datasets, the first axis indexing the datasets.
+        :param pars_guess: (ndarray) Start parameters for each dataset or common start parameters. If None, guess from data.
+        :returns: (ndarray) Fit parameters for each dataset + optional list of fit dictionaries.
+        """
+        data = np.asarray(data, dtype = self.dtype)
+        if data.shape[1:] != self.data.shape:
+            raise ValueError("Shape mismatch. Expected dimensions (N,) + %s." % (self.data.shape, ))
+        n_items, n_pars = data.shape[0], len(self.pars_name)
+
+        if pars_guess is None:
+            # guess each dataset, restore the data assigned to the fitter
+            data_fitter = self.data
+            pars_guess = np.empty([n_items, n_pars], dtype = DEFAULT_TYPE_NPY)
+            try:
+                for i in range(n_items):
+                    self.data = data[i]
+                    pars_guess[i] = self.guess()
+            finally:
+                self.data = data_fitter
+
+        pars_guess = np.asfarray(pars_guess, dtype = DEFAULT_TYPE_NPY)
+        if pars_guess.shape[-1] != n_pars:
+            raise ValueError("Invalid number of guess parameters.")
+        pars_guess = np.array(np.broadcast_to(pars_guess, (n_items, n_pars)))
+
+        if eps2 is None:
+            eps2 = self.eps2_default
+        pars_fit, fit_dicts = self.__LMBatch(data, pars_guess, tau, eps1, eps2, kmax)
+        for i in range(n_items):
+            pars_fit[i] = self.sanitizePars(pars_fit[i])
+        if return_dict:
+            return pars_fit, fit_dicts
+        else:
+            return pars_fit
+
+    def fitSequence(self, data, tau = 1e-2, eps1 = 1e-6, eps2 = None, kmax = 50, residual_jump = 4., return_dict = False):
+        """
+        Fit a sequence of datasets, starting each fit from the previous result.
+
+        Consecutive datasets of a measurement series, like the shots of a scan,
+        usually differ only slightly. Instead of guessing the start parameters for
+        each dataset, the best fit parameters of the previous dataset are used.
+        The fitter falls back to :func:`guess` if the warm started fit does not
+        converge or if its sum of squared residuals exceeds the one of the previous
+        fit by more than the factor `residual_jump`.
+
+        The datasets are assigned to the fitter one after another using :func:`setData`.
+        If `return_dict` is set, a report of the sequence is returned as well:
+
+        =========   ==============================
+        Name        Description
+        =========   ==============================
+        fits        Number of datasets fitted.
+        iter        Total number of iterations.
+        iter_saved  Estimated number of iterations saved by warm starts.
+        fallbacks   Number of fits restarted from :func:`guess`.
+        fit_logs    List of fit dictionaries as described in :func:`getFitLog`.
+        =========   ==============================
+
+        The iterations saved are estimated from the average number of iterations
+        needed for fits started from :func:`guess`. The time saved by not calling
+        :func:`guess` is not included.
+
+        :param data: (iterable) Sequence of datasets.
+        :param residual_jump: (float) Relative increase of the residuals causing a fallback.
+        :returns: (ndarray) Fit parameters for each dataset + optional report.
+        """
+        pars_fit, fit_logs = [], []
+        iter_warm = iter_cold = fits_cold = fallbacks = 0
+        pars_last = errsq_last = None
+
+        for data_i in data:
+            self.setData(data_i)
+            if pars_last is not None:
+                pars, fit_log = self.fit(pars_last, tau, eps1, eps2, kmax, return_dict = True)
+                iter_warm += fit_log["iter"]
+                diverged = not (fit_log["success"] and np.all(np.isfinite(pars)))
+                if diverged or fit_log["errsq"] > residual_jump * errsq_last:
+                    fallbacks += 1
+                    pars_warm, fit_log_warm = pars, fit_log
+                    pars, fit_log = self.fit(None, tau, eps1, eps2, kmax, return_dict = True)
+                    iter_cold += fit_log["iter"]; fits_cold += 1
+                    if not diverged and fit_log_warm["errsq"] <= fit_log["errsq"]:
+                        # the data changed indeed, keep the warm started result
+                        pars, fit_log = pars_warm, fit_log_warm
+                        self.pars_fit[:] = pars
+                        self.fit_log = fit_log
+            else:
+                pars, fit_log = self.fit(None, tau, eps1, eps2, kmax, return_dict = True)
+                iter_cold += fit_log["iter"]; fits_cold += 1
+            pars_fit.append(pars)
+            fit_logs.append(fit_log)
+            if fit_log["success"]:
+                pars_last, errsq_last = pars, fit_log["errsq"]
+
+        pars_fit = np.array(pars_fit, dtype = DEFAULT_TYPE_NPY).reshape(-1, len(self.pars_name))
+        if not return_dict:
+            return pars_fit
+
+        n_fits = len(fit_logs)
+        iter_total = iter_warm + iter_cold
+        iter_saved = float(iter_cold) / max(fits_cold, 1) * n_fits - iter_total
+        report = {"fits": n_fits,
+                  "iter": iter_total,
+                  "iter_saved": iter_saved,
+                  "fallbacks": fallbacks,
+                  "fit_logs": fit_logs}
+        return pars_fit, report
+
+    def fitPyramid(self, pars_guess = None, binning = 4, roi = None, kmax_fine = 5, tau_fine = 1e-6, tau = 1e-2, eps1 = 1e-6, eps2 = None, kmax = 50, return_dict = False):
+        """
+        Fit a two-dimensional dataset coarse to fine.
+
+        The image is binned by `binning` x `binning` pixels and fitted first. The
+        parameters are scaled back to the original pixel grid and refined by at most
+        `kmax_fine` iterations on the full resolution image. If `roi` is given as
+        (height, width), the full resolution fit is restricted to a window of this
+        size centered at the position found in the binned image. For images where
+        the signal covers only a small part of the frame, this reduces the time per
+        fit by orders of magnitude. As the scaled parameters are already close to
+        the optimum, the refinement starts with the low damping `tau_fine`.
+
+        The fitters for the binned image and the window are created on first use
+        and reused for subsequent calls. Masked pixels, see :func:`setMask`, are
+        excluded at both stages and errors, see :func:`setSigma`, are weighted at
+        both stages, using the error of the mean for the binned pixels. The settings
+        of :func:`setJacobianApprox` and :func:`setSolver` apply to both stages as
+        well. The model must define `pars_kind` as
+        described in the class documentation, its constructor must accept the
+        keyword argument `dtype` and further constructor arguments are taken
+        from :func:`_fitterArgs`. The resulting fit dictionary
+        describes the full resolution fit and includes the number of iterations
+        of the binned fit as "iter_coarse".
+
+        :param pars_guess: (ndarray) Start parameters for fitting. If None, guess from binned data.
+        :param binning: (int) Number of pixels binned along each axis.
+        :param roi: ((int, int)) Size of the full resolution window or None for the whole image.
+        :param kmax_fine: (int) Maximum number of full resolution iterations.
+        :param tau_fine: (float) Initial damping of the full resolution fit.
+        :returns: (ndarray) Fit parameters + optional fit dictionary.
+        """
+        if self.pars_kind is None or self.data.ndim != 2:
+            raise NotImplementedError("Fitter does not support pyramid fitting")
+        kind = np.asarray([str(k) for k in self.pars_kind])
+        pos_x, pos_y, size = (kind == "x"), (kind == "y"), (kind == "size")
+        b = int(binning)
+        sigma = None if self._invsigma is None else 1. / self._invsigma
+
+        # fit binned image, positions refer to the center of the binned pixels
+        ny, nx = self.data.shape[0] // b, self.data.shape[1] // b
+        data = self.data[:ny*b, :nx*b].reshape(ny, b, nx, b).mean(axis = 3).mean(axis = 1)
+        fitter = self.__subFitter(("binning", b), data)
+        if self._mask is not None:
+            # bins containing masked pixels are masked
+            fitter.setMask(self._mask[:ny*b, :nx*b].reshape(ny, b, nx, b).any(axis = 3).any(axis = 1))
+        elif fitter._mask is not None:
+            fitter.setMask(None)
+        if sigma is not None:
+            # error of the mean of the binned pixels
+            sigma_sq = np.square(sigma[:ny*b, :nx*b]).reshape(ny, b, nx, b).sum(axis = 3).sum(axis = 1)
+            fitter.setSigma(np.sqrt(sigma_sq) / b**2)
+        elif fitter._invsigma is not None:
+            fitter.setSigma(None)
+        if pars_guess is not None:
+            pars_guess = np.array(pars_guess, dtype = DEFAULT_TYPE_NPY)
+            pars_guess[pos_x | pos_y] = (pars_guess[pos_x | pos_y] - .5*(b-1)) / b
+            pars_guess[size] /= b
+        pars, fit_log_coarse = fitter.fit(pars_guess, tau, eps1, eps2, kmax, return_dict = True)
+        pars[pos_x | pos_y] = pars[pos_x | pos_y] * b + .5*(b-1)
+        pars[size] *= b
+
+        # refine on the full resolution image or window
+        if roi is None:
+            pars, fit_log = self.fit(pars, tau_fine, eps1, eps2, kmax_fine, return_dict = True)
+        else:
+            h, w = min(int(roi[0]), self.data.shape[0]), min(int(roi[1]), self.data.shape[1])
+            x_c, y_c = np.mean(pars[pos_x]), np.mean(pars[pos_y])
+            y0 = int(np.clip(round(y_c - .5*h), 0, self.data.shape[0] - h))
+            x0 = int(np.clip(round(x_c - .5*w), 0, self.data.shape[1] - w))
+            fitter = self.__subFitter(("roi", h, w), self.data[y0:y0+h, x0:x0+w])
+            if self._mask is not None or fitter._mask is not None:
+                fitter.setMask(None if self._mask is None else self._mask[y0:y0+h, x0:x0+w])
+            if sigma is not None or fitter._invsigma is not None:
+                fitter.setSigma(None if sigma is None else sigma[y0:y0+h, x0:x0+w])
+            pars[pos_x] -= x0; pars[pos_y] -= y0
+            pars, fit_log = fitter.fit(pars, tau_fine, eps1, eps2, kmax_fine, return_dict = True)
+            pars[pos_x] += x0; pars[pos_y] += y0
+            self.pars_fit[:] = pars
+            self.fit_log = fit_log
+        fit_log["iter_coarse"] = fit_log_coarse["iter"]
+
+        if return_dict:
+            return self.pars_fit.copy(), fit_log
+        else:
+            return self.pars_fit.copy()
+
+    def __subFitter(self, key, data):
+        """
+        Return a cached fitter of the same model for data derived from the dataset.
+        """
+        fitter = self._pyramid.get(key)
+        if fitter is None:
+            fitter = self._pyramid[key] = type(self)(data, *self._fitterArgs(), dtype = self.dtype)
+            # sub-fits are profiled as part of this fitter
+            fitter._profile_totals = self._profile_totals
+        else:
+            fitter.setData(data)
+        fitter.profiling = self.profiling
+        fitter.setJacobianApprox(self._jacobian_approx)
+        fitter.setSolver(self._damping, self._geodesic, self._geodesic_h, self._geodesic_alpha)
+        return fitter
+
+    def normalEquations(self, pars):
+        """
+        Calculate the normal equations of the fit problem for given parameters.
+        
+        The normal equations are calculated from the data, errors and mask
+        currently assigned to the fitter, the same way as within :func:`fit`.
+        This is used for fit problems composed of several datasets, see
+        :class:`qao.fit.globalfit.GlobalFit`.
+        
+        :param pars: (ndarray) Fit parameters.
+        :returns: (ndarray, ndarray, float) Matrix J*J^T, gradient J*r and sum of squared residuals.
+        """
+        pars = np.asfarray(pars, dtype = DEFAULT_TYPE_NPY)
+        matrix_free = self._has_JTJ and self._invsigma is None and self._mask_index is None
+        residual, jacobian = self.__residualFunctions()
+        if matrix_free: self.f(pars)
+        else: self.fJ(pars)
+        r = residual()
+        if matrix_free:
+            A, g = self.JTJ(pars, r)
+        else:
+            J = jacobian()
+            A, g = np.inner(J, J), np.inner(J, r)
+        errsq = float(np.linalg.norm(r))**2
+        return np.asarray(A, dtype = np.double), np.asarray(g, dtype = np.double), errsq
+    
+    def _fitterArgs(self):
+        """
+        Return the constructor arguments following the data, used for creating
+        fitters of the same model, see :func:`fitPyramid` and :func:`getFitErr`.
+        
+        Reimplement this function if the constructor takes further arguments.
+        
+        :returns: (tuple) Positional constructor arguments.
+        """
+        return ()
     
     def sanitizePars(self, pars):
         """
@@ -201,16 +808,50 @@ class LevmarFitter(object):
     def __JACapprox(self, pars):
         
         pars = np.asfarray(pars, dtype = DEFAULT_TYPE_NPY).copy()
+        forward = (self._jacobian_approx == "forward")
+        
+        # step sizes must resolve the floating type used for f
+        delta_rel = max(DELTA_REL, np.sqrt(np.finfo(self.dtype).eps))
+        delta = np.maximum(DELTA_ABS, delta_rel*np.abs(pars))
+        
+        if self._has_fBatch:
+            # evaluate all perturbed parameter sets within one call
+            J = self._J
+            pars_step = pars + np.diag(delta)
+            self.fBatch(pars_step, J)
+            if forward:
+                self.f(pars)
+                J -= self._f
+                J *= (1./delta)[:, np.newaxis]
+            else:
+                if self.__Jstep is None:
+                    self.__Jstep = np.empty_like(J)
+                pars_step -= 2*np.diag(delta)
+                self.fBatch(pars_step, self.__Jstep)
+                J -= self.__Jstep
+                J *= (.5/delta)[:, np.newaxis]
+            return
+        
+        if forward:
+            self.f(pars)
+            f0 = self._f.copy()
+            for i in range(pars.size):
+                pars[i] += delta[i]
+                self.f(pars)
+                pars[i] -= delta[i]
+                np.subtract(self._f, f0, out = self._J[i, :])
+                self._J[i, :] *= 1./delta[i]
+            self._f[:] = f0
+            return
         
         for i in range(pars.size):
-            delta = max(DELTA_ABS, DELTA_REL*abs(pars[i]))
-            pars[i] += delta
+            pars[i] += delta[i]
             self.f(pars)
             self._J[i, :] = self._f.ravel()
-            pars[i] -= 2*delta
+            pars[i] -= 2*delta[i]
             self.f(pars)
             self._J[i, :] -= self._f.ravel()
-            self._J[i, :] *= 1./(2*delta)
+            self._J[i, :] *= 1./(2*delta[i])
     
     def __LM(self, pars, tau = 1e-2, eps1 = 1e-6, eps2 = 1e-6, kmax = 50,
            verbose = False, return_dict = False, callback = None):
@@ -228,17 +869,62 @@ class LevmarFitter(object):
         # get pars, create cache
         pars = np.asfarray(pars, dtype = DEFAULT_TYPE_NPY)
         
+        # accumulate the normal equations without jacobian if possible
+        matrix_free = self._has_JTJ and self._invsigma is None and self._mask_index is None
+        residual, jacobian = self.__residualFunctions()
+        
+        def normalEquations(pars, r):
+            if matrix_free:
+                A, g = self.JTJ(pars, r)
+            else:
+                J = jacobian()
+                A, g = np.inner(J, J), np.inner(J, r)
+            return np.asarray(A, dtype = np.double), np.asarray(g, dtype = np.double)
+        
+        profile = self.__profile
+        def evaluate(pars, with_jacobian = True):
+            if profile is not None: profile["fJ_calls"] += 1
+            if matrix_free or (not with_jacobian and self._has_f): self.f(pars)
+            else: self.fJ(pars)
+        
+        # the damped normal equations A + mu*D are solved from the eigensystem of the
+        # scaled matrix, which is reused for every mu until a step is accepted
+        def factorize(A, D):
+            scale = 1. / np.sqrt(D)
+            w, V = np.linalg.eigh(A * scale * scale[:, np.newaxis])
+            return w, V, scale
+        
+        def solve(factors, mu, b):
+            w, V, scale = factors
+            return scale * np.dot(V, np.dot(V.T, scale * b) / (w + mu))
+        
+        # geodesic acceleration needs the jacobian at pars, trial steps evaluate f only.
+        # Models implementing fJ only overwrite the jacobian, a copy at pars is kept.
+        geodesic = self._geodesic
+        keep_jacobian = geodesic and not matrix_free and not self._has_f
+        def gradient(pars, r, J):
+            if matrix_free:
+                return np.asarray(self.JTJ(pars, r)[1], dtype = np.double)
+            return np.inner(jacobian() if J is None else J, r).astype(np.double)
+        
         # calculate f and J
-        self.fJ(pars)
-        if self.data is not None: self._f -= self.data.ravel()
-        if self._invsigma is not None: self._f *= self._invsigma.ravel()
+        self.__timed("fJ", evaluate, pars)
+        r = residual()
+        if geodesic: r_pars = r.astype(np.double)
+        J_pars = np.array(jacobian()) if keep_jacobian else None
         
-        A = np.inner(self._J, self._J)
-        g = np.inner(self._J, self._f)
-        I = np.eye(pars.size)
+        A, g = self.__timed("normal", normalEquations, pars, r)
+        errsq_pars = float(np.linalg.norm(r))**2
         
-        k = 0; nu = 2
-        mu = tau * max(np.diag(A))
+        # damping along the identity or along the largest diagonal of A seen so far
+        marquardt = self._damping == "marquardt"
+        D = np.ones(pars.size)
+        if marquardt:
+            D = np.maximum(np.diag(A), 1e-6 * np.diag(A).max())
+        factors = None
+        
+        k = 0; nu = 2; rejected = 0
+        mu = tau * max(np.diag(A) / D)
         if np.linalg.norm(g, np.Inf) < eps1:
             stop = True
             stop_reason = "small gradient"
@@ -247,8 +933,12 @@ class LevmarFitter(object):
             k += 1
     
             try:
-                d = np.linalg.solve( A + mu*I, -g)
+                if factors is None:
+                    factors = self.__timed("solve", factorize, A, D)
+                d = self.__timed("solve", solve, factors, mu, -g)
             except np.linalg.LinAlgError:
+                d = None
+            if d is None or not np.all(np.isfinite(d)):
                 stop = True
                 stop_reason = "singular matrix"
                 break
@@ -257,21 +947,49 @@ class LevmarFitter(object):
                 stop = True
                 stop_reason = "small step"
                 break
-    
-            pars_new = pars + d
-            errsq = np.linalg.norm(self._f)**2
             
+            if geodesic:
+                # second directional derivative of the residuals along d
+                h = self._geodesic_h
+                self.__timed("fJ", evaluate, pars + h*d, False)
+                r_dd = residual().astype(np.double)
+                self.__timed("fJ", evaluate, pars - h*d, False)
+                r_dd += residual()
+                r_dd -= 2. * r_pars
+                r_dd *= 1. / h**2
+                a = self.__timed("solve", solve, factors, mu, -gradient(pars, r_dd, J_pars))
+                if 2. * np.linalg.norm(a / factors[2]) > self._geodesic_alpha * np.linalg.norm(d / factors[2]):
+                    # acceleration too large, reject like a failed step
+                    mu = mu * nu
+                    nu = 2*nu
+                    rejected += 1
+                    continue
+                pars_new = pars + d + .5 * a
+            else:
+                pars_new = pars + d
+
             # recalculate f and J for new pars
-            self.fJ(pars_new)
-            if self.data is not None: self._f -= self.data.ravel()
-            if self._invsigma is not None: self._f *= self._invsigma.ravel()
+            self.__timed("fJ", evaluate, pars_new, not geodesic)
+            r = residual()
             
-            errsq_new = np.linalg.norm(self._f)**2
-            rho = (errsq - errsq_new)/np.inner(d, mu*d - g)
+            # the gain is measured against the current parameters, not a rejected step
+            errsq_new = float(np.linalg.norm(r))**2
+            rho = (errsq_pars - errsq_new)/np.inner(d, mu*D*d - g)
             if rho > 0:
                 pars = pars_new
-                A = np.inner(self._J, self._J)
-                g = np.inner(self._J, self._f)
+                errsq_pars = errsq_new
+                if geodesic:
+                    if not matrix_free and self._has_f:
+                        self.__timed("fJ", evaluate, pars)
+                        r = residual()
+                    r_pars = r.astype(np.double)
+                    if keep_jacobian:
+                        J_pars[:] = jacobian()
+                A, g = self.__timed("normal", normalEquations, pars, r)
+                if marquardt:
+                    np.maximum(D, np.diag(A), out = D)
+                    np.maximum(D, 1e-6 * D.max(), out = D)
+                factors = None
                 if (np.linalg.norm(g, np.Inf) < eps1):
                     stop = True
                     stop_reason = "small gradient"
@@ -281,9 +999,10 @@ class LevmarFitter(object):
             else:
                 mu = mu * nu
                 nu = 2*nu
+                rejected += 1
     
             if verbose:
-                print "step %2d: |f|: %9.6g mu: %8.3g rho: %8.3g" % (k, np.linalg.norm(self._f), mu, rho)
+                print "step %2d: |f|: %9.6g mu: %8.3g rho: %8.3g" % (k, np.linalg.norm(r), mu, rho)
                 
         else:
             if not stop_reason and k == kmax:
@@ -293,32 +1012,192 @@ class LevmarFitter(object):
     
         if verbose:
             print stop_reason
+        if profile is not None:
+            profile["rejected"] = rejected
         
         self.fit_log = {"iter": k,
                         "reason": stop_reason,
-                        "success": stop_reason in ["small gradient", "small step"]}
+                        "success": stop_reason in ["small gradient", "small step"],
+                        "errsq": errsq_pars}
+        
+        # keep the normal equations at the result for estimating the errors
+        if self._invsigma is None:
+            self.__normal = (pars.copy(), A, errsq_pars, r.size)
+        else:
+            self.__normal = None
         
         if return_dict:
             return pars, self.fit_log
         else:
             return pars
 
+    def __residualFunctions(self, weighted = True):
+        """
+        Return functions computing the residuals and the jacobian of the data
+        points to be fitted from the current contents of `self._f` and `self._J`.
+        """
+        index = self._mask_index
+        gather = index is not None and not self.supports_mask
+        
+        # restrict data and errors to the selected points once per fit
+        data = self._data_flat
+        invsigma = self._invsigma.ravel() if self._invsigma is not None and weighted else None
+        if index is not None and invsigma is not None:
+            invsigma = invsigma[index]
+        
+        def residual():
+            r = self._f[index] if gather else self._f
+            r -= data
+            if invsigma is not None: r *= invsigma
+            return r
+        
+        def jacobian():
+            return self._J[:, index] if gather else self._J
+        
+        return residual, jacobian
+    
+    def __LMBatch(self, data, pars, tau = 1e-2, eps1 = 1e-6, eps2 = 1e-6, kmax = 50):
+        """Implementation of the Levenberg-Marquardt algorithm for a stack
+        of fit problems. Items are iterated together until each one reached
+        a stop condition."""
+
+        n_items, n_pars = pars.shape
+        data = data.reshape(n_items, -1)
+        invsigma = self._invsigma.ravel() if self._invsigma is not None else None
+
+        # buffers for f and J, only the first m items are used for m active fits
+        f = np.empty(data.shape, dtype = self.dtype)
+        J = np.empty([n_items, n_pars, data.shape[1]], dtype = self.dtype)
+
+        # batched models evaluate all points, masked points are discarded
+        index = self._mask_index
+        if index is not None:
+            data = data[:, index]
+            if invsigma is not None: invsigma = invsigma[index]
+
+        def normalEquations(pars, items):
+            m = items.size
+            f_m, J_m = f[:m], J[:m]
+            self.fJBatch(pars, f_m, J_m)
+            if index is not None:
+                f_m, J_m = f_m[:, index], J_m[:, :, index]
+            f_m -= data[items]
+            if invsigma is not None: f_m *= invsigma
+            errsq = np.einsum("ij,ij->i", f_m, f_m).astype(np.double)
+            A = np.matmul(J_m, J_m.transpose(0, 2, 1)).astype(np.double)
+            g = np.matmul(J_m, f_m[:, :, np.newaxis])[:, :, 0].astype(np.double)
+            return errsq, A, g
+
+        # process control for each item
+        k = np.zeros(n_items, dtype = int)
+        stop_reason = [""] * n_items
+        active = np.ones(n_items, dtype = bool)
+
+        def stopItems(items, reason):
+            active[items] = False
+            for i in items:
+                stop_reason[i] = reason
+
+        # calculate f and J
+        pars = pars.copy()
+        errsq, A, g = normalEquations(pars, np.arange(n_items))
+        I = np.eye(n_pars)
+
+        # damping along the identity or along the largest diagonal of A seen so far
+        marquardt = self._damping == "marquardt"
+        D = np.ones([n_items, n_pars])
+        if marquardt:
+            D = np.diagonal(A, axis1 = 1, axis2 = 2).copy()
+            np.maximum(D, 1e-6 * D.max(axis = 1)[:, np.newaxis], out = D)
+
+        nu = np.empty(n_items); nu.fill(2.)
+        mu = tau * np.max(np.diagonal(A, axis1 = 1, axis2 = 2) / D, axis = 1)
+        stopItems(np.flatnonzero(np.max(np.abs(g), axis = 1) < eps1), "small gradient")
+
+        for _ in range(kmax):
+            items = np.flatnonzero(active)
+            if not items.size:
+                break
+            k[items] += 1
+
+            # solve all damped normal equations, identify singular items on failure
+            M = A[items] + (mu[items, np.newaxis] * D[items])[:, np.newaxis, :] * I
+            try:
+                d = np.linalg.solve(M, -g[items, :, np.newaxis])[:, :, 0]
+                singular = np.zeros(items.size, dtype = bool)
+            except np.linalg.LinAlgError:
+                d = np.zeros([items.size, n_pars])
+                singular = np.zeros(items.size, dtype = bool)
+                for j, i in enumerate(items):
+                    try:
+                        d[j] = np.linalg.solve(M[j], -g[i])
+                    except np.linalg.LinAlgError:
+                        singular[j] = True
+            stopItems(items[singular], "singular matrix")
+
+            small = np.linalg.norm(d, axis = 1) < eps2*(np.linalg.norm(pars[items], axis = 1) + eps2)
+            stopItems(items[small & ~singular], "small step")
+
+            proceed = ~(singular | small)
+            items, d = items[proceed], d[proceed]
+            if not items.size:
+                continue
+
+            # recalculate f and J for new pars
+            pars_new = pars[items] + d
+            errsq_new, A_new, g_new = normalEquations(pars_new, items)
+            rho = (errsq[items] - errsq_new) / np.einsum("ij,ij->i", d, mu[items, np.newaxis]*D[items]*d - g[items])
+
+            accept = rho > 0
+            acc, rej = items[accept], items[~accept]
+            pars[acc], errsq[acc], A[acc], g[acc] = pars_new[accept], errsq_new[accept], A_new[accept], g_new[accept]
+            if marquardt:
+                D[acc] = np.maximum(D[acc], np.diagonal(A[acc], axis1 = 1, axis2 = 2))
+                D[acc] = np.maximum(D[acc], 1e-6 * D[acc].max(axis = 1)[:, np.newaxis])
+            mu[acc] *= np.maximum(1.0/3, 1.0 - (2*rho[accept] - 1)**3)
+            nu[acc] = 2.0
+            stopItems(acc[np.max(np.abs(g[acc]), axis = 1) < eps1], "small gradient")
+            mu[rej] *= nu[rej]
+            nu[rej] *= 2
+
+        stopItems(np.flatnonzero(active), "max iter reached")
+
+        fit_dicts = [{"iter": int(k[i]),
+                      "reason": stop_reason[i],
+                      "success": stop_reason[i] in ["small gradient", "small step"]}
+                     for i in range(n_items)]
+        return pars, fit_dicts
+
     def __estError(self, pars):
         """
         Calculate the estimated errors for best fit parameters.
         """
-        self.fJ(pars)  # refresh f and J
-        if self.data is not None: self._f -= self.data.ravel()
+        if self.__normal is not None and np.array_equal(self.__normal[0], pars):
+            # reuse the normal equations from the last iteration of the fit
+            A, errsq, N = self.__normal[1:]
+        else:
+            # refresh f and J
+            matrix_free = self._has_JTJ and self._mask_index is None
+            if matrix_free: self.f(pars)
+            else: self.fJ(pars)
+            residual, jacobian = self.__residualFunctions(weighted = False)
+            r = residual()
+            if matrix_free:
+                A = self.JTJ(pars, r)[0]
+            else:
+                J = jacobian()
+                A = np.inner(J, J)
+            A = np.asarray(A, dtype = np.double)
+            errsq = float(np.linalg.norm(r))**2 # sum square residuum
+            N = r.size                          # number of points
         
         alpha = 0.05            # 95%, 2sigma confidence limit
-        N = self._f.size        # number of points
         m = len(pars)  # number of parameters
         
-        errsq = np.linalg.norm(self._f)**2 # sum square residuum
         sigma = np.sqrt(errsq / (N - m))   # estimated standard deviation
         
         try:
-            diag = np.diagonal(np.linalg.inv(np.inner(self._J, self._J)))
+            diag = np.diagonal(np.linalg.inv(A))
             pars_err = np.sqrt(diag) * sigma * scipy.stats.t.ppf(1 - alpha / 2, N - m)
         except:
             pars_err = pars * np.inf
@@ -359,6 +1238,32 @@ class LevmarFitter(object):
         :param pars: (ndarray) Fit parameters.
         """
     
+    def fBatch(self, pars, f):
+        """
+        Calculate the model function for a stack of parameters.
+        
+        .. note::
+        
+            This function is usually not called
+            from the user directly.
+        
+        For `m` sets of fit parameters given by `pars` with shape (m, k),
+        the function values are to be stored in the already allocated
+        ndarray `f` of shape (m, n). Each row corresponds to the result
+        of :func:`f`.
+        
+        This method is optional. If a subclass implements it, the jacobian
+        of models without :func:`fJ` is approximated by evaluating all
+        perturbed parameter sets within one call instead of calling :func:`f`
+        for each fit parameter.
+        
+        :param pars: (ndarray) Stack of fit parameters.
+        :param f: (ndarray) Output array for the function values.
+        """
+        for i in range(len(pars)):
+            self.f(pars[i])
+            f[i] = self._f
+    
     def fJ(self, pars):
         """
         Calculate the model function and the jacobian for given parameters.
@@ -378,13 +1283,68 @@ class LevmarFitter(object):
         
         If you can not or do not want to implement this function you
         may implement :func:`f` instead, and the jacobian will be
-        approximated.
+        approximated by finite differences, see :func:`setJacobianApprox`
+        and :func:`fBatch`.
 
         :param pars: (ndarray) Fit parameters.
         """
     
         self.__JACapprox(pars)
-        self.f(pars)
+        if self._jacobian_approx != "forward":
+            self.f(pars)
+
+    def JTJ(self, pars, r):
+        """
+        Calculate the normal equations for given parameters and residuals.
+        
+        .. note::
+        
+            This function is usually not called
+            from the user directly.
+        
+        For the jacobian `J` of the model function at `pars` and the residual
+        vector `r` of shape (n,), return the matrix J*J^T of shape (k, k) and
+        the gradient J*r of shape (k,). The fitter calls :func:`f` for the same
+        parameters beforehand, so intermediate results cached by :func:`f` may
+        be reused.
+        
+        This method is optional. If a subclass implements it, the fitter uses
+        :func:`f` and :func:`JTJ` instead of :func:`fJ` for fitting unweighted
+        data and the jacobian `self._J` is never allocated. Implementations
+        should therefore accumulate the sums without storing the jacobian.
+        
+        :param pars: (ndarray) Fit parameters.
+        :param r: (ndarray) Residuals of the model function.
+        :returns: (ndarray, ndarray) Matrix J*J^T and gradient J*r.
+        """
+        raise NotImplementedError("Normal equations not implemented by this fitter")
+
+    def fJBatch(self, pars, f, J):
+        """
+        Calculate the model function and the jacobian for a stack of parameters.
+
+        .. note::
+
+            This function is usually not called
+            from the user directly.
+
+        For `m` sets of fit parameters given by `pars` with shape (m, k),
+        the function values and the jacobians are to be stored in the
+        already allocated ndarrays `f` and `J`, having the shapes (m, n)
+        and (m, k, n). Each item corresponds to the result of :func:`fJ`.
+
+        The default implementation calls :func:`fJ` for each set of
+        parameters. Reimplement this function for vectorized evaluation
+        in :func:`fitBatch`.
+
+        :param pars: (ndarray) Stack of fit parameters.
+        :param f: (ndarray) Output array for the function values.
+        :param J: (ndarray) Output array for the jacobians.
+        """
+        for i in range(len(pars)):
+            self.fJ(pars[i])
+            f[i] = self._f
+            J[i] = self._J
     
     def getFitParNames(self):
         """
@@ -406,7 +1366,7 @@ class LevmarFitter(object):
         """
         return self.pars_fit
     
-    def getFitErr(self):
+    def getFitErr(self, method = "covariance", samples = 100, processes = None, seed = None):
         """
         Return the estimated errors of the best fit parameters.
         
@@ -415,9 +1375,85 @@ class LevmarFitter(object):
         the order, refer to :func:`getFitParsDict` or
         :func:`getFitParNames`.
         
-        :returns: (ndarray) Best fit parameters.
+        The errors are given as half width of the 95% confidence interval.
+        By default, they are estimated from the covariance matrix of the fit
+        parameters. The normal equations of the last fit iteration are reused
+        for this, so the estimate is free after :func:`fit`.
+        
+        If the model is strongly non-linear within the confidence interval, like
+        :class:`Bimodal2D` near the condensation threshold, the covariance matrix
+        may be a poor approximation. The methods "bootstrap" and "montecarlo" fit
+        `samples` synthetic datasets instead, created by adding noise to the best
+        fit model. The noise is either drawn from the fit residuals with replacement
+        or from a normal distribution with the standard deviation of the residuals.
+        The synthetic datasets are fitted in parallel by a :class:`FitJob` using
+        `processes` workers, each fit starting from the best fit parameters. The
+        errors are taken from the percentiles of the resulting parameters. This
+        requires the constructor of the model to accept the keyword argument `dtype`.
+        Models with further constructor arguments must return them by :func:`_fitterArgs`.
+        
+        :param method: (str) Either "covariance", "bootstrap" or "montecarlo".
+        :param samples: (int) Number of synthetic datasets for resampling methods.
+        :param processes: (int) Number of worker processes, None for all cpus.
+        :param seed: (int) Seed of the random numbers for resampling methods.
+        :returns: (ndarray) Estimated errors of the best fit parameters.
+        """
+        if method not in ("covariance", "bootstrap", "montecarlo"):
+            raise ValueError("Unknown error estimation method %s." % method)
+        t0 = time.time()
+        if method == "covariance":
+            pars_err = self.__estError(self.pars_fit)
+        else:
+            pars_err = self.__resampleError(self.pars_fit, method, int(samples), processes, seed)
+        if self.profiling:
+            t_error = time.time() - t0
+            if self.fit_log is not None and "profile" in self.fit_log:
+                self.fit_log["profile"]["error"] += t_error
+            self.__profileEnd({"error": t_error})
+        return pars_err
+    
+    def __resampleError(self, pars, method, samples, processes, seed):
         """
-        return self.__estError(self.pars_fit)        
+        Estimate the errors of the best fit parameters by fitting synthetic datasets.
+        """
+        from fitjob import FitJob
+        
+        # residuals of the selected points, normalized if errors are given
+        model = self.getFitData(pars).astype(DEFAULT_TYPE_NPY).ravel()
+        index = np.arange(model.size) if self._mask_index is None else self._mask_index
+        if self._invsigma is None:
+            sigma, scale = None, 1.
+        else:
+            sigma = 1. / self._invsigma
+            scale = sigma.ravel()[index]
+        r = (self.data.ravel()[index] - model[index]) / scale
+        r_std = np.sqrt(np.dot(r, r) / (r.size - len(pars)))
+        
+        # fit the synthetic datasets in batches, starting from the best fit
+        rng = np.random.RandomState(seed)
+        job_kwargs = {"processes": processes, "fitter_args": self._fitterArgs(),
+                      "fitter_kwargs": {"dtype": self.dtype}, "mask": self._mask, "sigma": sigma}
+        batch = min(samples, 8 * (processes or multiprocessing.cpu_count()))
+        stack = np.empty((batch, ) + self.data.shape, dtype = DEFAULT_TYPE_NPY)
+        stack_flat = stack.reshape(len(stack), -1)
+        stack_flat[:] = model
+        pars_samples = []
+        with FitJob(type(self), stack, **job_kwargs) as job:
+            while len(pars_samples) < samples:
+                if method == "bootstrap":
+                    noise = r[rng.randint(r.size, size = (len(stack), r.size))]
+                else:
+                    noise = rng.normal(0., r_std, (len(stack), r.size))
+                stack_flat[:, index] = model[index] + noise * scale
+                job.setData(stack)
+                pars_samples.extend(job.run(pars, errors = False)[0])
+        
+        pars_samples = np.array(pars_samples[:samples])
+        pars_samples = pars_samples[np.all(np.isfinite(pars_samples), axis = 1)]
+        if len(pars_samples) < 2:
+            return pars * np.inf
+        lower, upper = np.percentile(pars_samples, [2.5, 97.5], axis = 0)
+        return .5 * (upper - lower)
     
     def getFitParsDict(self, errors = True):
         """
@@ -450,6 +1486,9 @@ class LevmarFitter(object):
         =======   ==============================
         iter      Number of iterations.
         reason    Reason for stopping the fit ("small gradient", "small step", "singular matrix").
+        success   True if the fit converged.
+        errsq     Sum of squared residuals for the resulting parameters.
+        profile   Fit profile if enabled, see :func:`setProfiling`.
         =======   ==============================
         
         :returns: (dict) Fit procedure details.
@@ -474,6 +1513,19 @@ class LevmarFitter(object):
         if len(pars) != len(self.pars_name):
             raise ValueError("Invalid number of guess parameters.")
         pars = np.asfarray(pars, dtype = DEFAULT_TYPE_NPY)
-        self.fJ(pars)
-        return self._f.copy().reshape(self.data.shape)
+        if self._mask_coords is None or not self.supports_mask:
+            if self._has_JTJ: self.f(pars)
+            else: self.fJ(pars)
+            return self._f.copy().reshape(self.data.shape)
+        
+        # evaluate all points, not only the ones selected for fitting
+        buffers = self._f, self.__J, self.__Jstep, self._mask_coords
+        try:
+            self._f = np.empty(self.data.size, dtype = self.dtype)
+            self.__J = self.__Jstep = self._mask_coords = None
+            if self._has_JTJ: self.f(pars)
+            else: self.fJ(pars)
+            return self._f.reshape(self.data.shape)
+        finally:
+            self._f, self.__J, self.__Jstep, self._mask_coords = buffers
 
@@ -1,15 +1,72 @@
 import numpy as np
-import scipy.weave as weave
 from scipy.special import erf
 from scipy.ndimage import rotate
-from fitter import LevmarFitter, DEFAULT_TYPE_C, DEFAULT_TYPE_NPY
+from fitter import LevmarFitter, DEFAULT_TYPE_NPY
+import kernels
 
-__compiler_args = ["-O3", "-march=native", "-ffast-math", "-fno-openmp"]
-__linker_args   = ["-fno-openmp"]
-opt_args = {"extra_compile_args": __compiler_args,
-            "extra_link_args": __linker_args}
-
-DEFAULT_TYPEDEFC = "typedef {0} float_type;\n".format(DEFAULT_TYPE_C)
+def momentGuess2D(data):
+    """
+    Guess the parameters (A, x_0, s_x, y_0, s_y, off) of a two-dimensional Gauss
+    function without fitting. The offset is taken from a low percentile of the x and y
+    projections of the image, the position from the centroid and the width from the
+    number of values above half maximum of the background free projections.
+    
+    :param data: (ndarray) Image.
+    :returns: (ndarray) Guessed parameters.
+    """
+    ny, nx = data.shape
+    proj_x = data.sum(axis = 0, dtype = DEFAULT_TYPE_NPY)
+    proj_y = data.sum(axis = 1, dtype = DEFAULT_TYPE_NPY)
+    
+    def percentile(proj, q):
+        k = int(q * (proj.size - 1))
+        return np.partition(proj, k)[k]
+    
+    off = .5 * (percentile(proj_x, .05) / ny + percentile(proj_y, .05) / nx)
+    
+    def moments(proj, n):
+        q = proj - off * n
+        peak = q.max()
+        above = np.flatnonzero(q > .5 * peak)
+        w = q[above]
+        if above.size < 5 or w.sum() <= 0:
+            # width from the number of values above half maximum
+            return peak, above.mean(), max(above.size, 1) / 2.3548
+        # the variance within the half maximum is 0.3827 times the variance of a gaussian
+        x_0 = np.dot(above, w) / w.sum()
+        var = np.dot(np.square(above - x_0), w) / w.sum()
+        return peak, x_0, np.sqrt(var / .3827)
+    
+    peak_x, x_0, s_x = moments(proj_x, ny)
+    peak_y, y_0, s_y = moments(proj_y, nx)
+    amp = .5 * (peak_x / s_y + peak_y / s_x) / np.sqrt(2. * np.pi)
+    return np.asfarray((amp, x_0, s_x, y_0, s_y, off))
+
+def poorGuess(fitter, pars, tolerance, points = 1 << 14):
+    """
+    Check whether the model at `pars` misses more than the fraction `tolerance` of the
+    signal variance of a two-dimensional dataset. The noise variance is estimated from
+    the differences of neighbouring pixels and subtracted from both the residual and
+    the signal. Large images are checked on a subset of about `points` pixels.
+    
+    :param fitter: (LevmarFitter) Fitter with the data assigned.
+    :param pars: (ndarray) Parameters to be checked.
+    :param tolerance: (float) Fraction of the signal variance missed by a good guess.
+    :returns: (bool) True if the guess is poor.
+    """
+    if not np.all(np.isfinite(pars)):
+        return True
+    fitter.f(pars)
+    data = fitter._data_flat
+    f = fitter._f if fitter._f.size == data.size else fitter._f[fitter._mask_index]
+    step = max(1, data.size // points)
+    data, f = data[::step], f[::step]
+    rows = fitter.data[::max(1, fitter.data.size // points)]
+    noise = .5 * np.mean(np.square(np.diff(rows, axis = 1)))
+    excess = np.dot(f - data, f - data) - noise * data.size
+    data = data - data.mean()
+    signal = np.dot(data, data) - noise * data.size
+    return not excess <= tolerance * max(signal, 0.)
 
 class Gauss1D(LevmarFitter):
     r"""
@@ -21,11 +78,12 @@ class Gauss1D(LevmarFitter):
     
     The order of the fit parameters is (A, x_0, s, off). 
     
-    :param data: (ndarray) Array of measurements.    
+    :param data: (ndarray) Array of measurements.
+    :param dtype: (dtype) Floating point type for computations or None.
     """
     
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A", "x_0", "s", "off"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "x_0", "s", "off"], data, dtype)
 
         cache_z = np.empty_like(self._f)
         cache_e = np.empty_like(self._f)
@@ -57,55 +115,13 @@ class Gauss1D(LevmarFitter):
         # decide by error estimation which guess seems more apropriate
         return guess_normal if error_normal < error_bg else guess_bg
 
-
-    
-    f_code = DEFAULT_TYPEDEFC + """
-    const int n = Nf[0];
-    const float_type invp2sq = 1.0/(p[2]*p[2]);
-    for (int i = 0; i < n; ++i) {
-        float_type dist = i-p[1];
-        cache_z[i] = dist * invp2sq;
-        cache_e[i] = exp(-.5*dist*cache_z[i]);
-        f[i] = p[0] * cache_e[i] + p[3];
-    }
-    """
-    
     def f(self, pars):
-        f = self._f
         cache_z, cache_e = self.cache
-        p = pars
-        weave.inline(self.f_code, ["f", "cache_z", "cache_e", "p"], **opt_args)
-    
-    fJ_code = DEFAULT_TYPEDEFC + """
-    const int n = Nf[0];
-    const float_type invp2sq = 1.0/(p[2]*p[2]);
-    for (int i = 0; i < n; ++i) {
-        float_type dist = i-p[1];
-        cache_z[i] = dist * invp2sq;
-        cache_e[i] = exp(-.5*dist*cache_z[i]);
-        f[i] = p[0] * cache_e[i] + p[3];
-    }
-    
-    const float_type invp2 = 1.0/p[2];
-    for(int i=0; i<n; ++i){
-        J[i] = cache_e[i];
-    }
-    for(int i=0; i<n; ++i){
-        J[n+i] = cache_z[i] * p[0] * cache_e[i];
-    }
-    for(int i=0; i<n; ++i){
-        J[2*n+i] = cache_z[i]*cache_z[i]*p[2] * p[0] * cache_e[i];
-    }
-    for(int i=0; i<n; ++i){
-        J[3*n+i] = 1.;
-    }
-    """
+        kernels.gauss1d_f(pars, self._f, cache_z, cache_e)
     
     def fJ(self, pars):
-        f, J = self._f, self._J
         cache_z, cache_e = self.cache
-        p = pars
-        weave.inline(self.fJ_code, ["f", "J", "cache_z", "cache_e", "p"], **opt_args)
+        kernels.gauss1d_fJ(pars, self._f, self._J, cache_z, cache_e)
     
     def sanitizePars(self, pars):
         pars[2] = abs(pars[2])
@@ -140,11 +156,12 @@ class Gauss1DAsym(LevmarFitter):
     
     The order of the fit parameters is (A, x_0, s1, s2, off). 
     
-    :param data: (ndarray) Array of measurements.    
+    :param data: (ndarray) Array of measurements.
+    :param dtype: (dtype) Floating point type for computations or None.
     """
     
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A", "x_0", "s1", "s2", "off"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "x_0", "s1", "s2", "off"], data, dtype)
 
         cache_z = np.empty_like(self._f)
         cache_e = np.empty_like(self._f)
@@ -155,58 +172,13 @@ class Gauss1DAsym(LevmarFitter):
         # symmetric gauss guess
         return g1d_pars[[0, 1, 2, 2, 3]]
 
-    f_code = DEFAULT_TYPEDEFC + """
-    const int n = Nf[0];
-    const float_type inv_s1_sq = 1.0/(p[2]*p[2]);
-    const float_type inv_s2_sq = 1.0/(p[3]*p[3]);
-    for (int i = 0; i < n; ++i) {
-        float_type dist = i-p[1];
-        float_type left = float_type(dist < 0);
-        cache_z[i] = dist * (inv_s1_sq*left + inv_s2_sq*(1.-left));
-        cache_e[i] = exp(-.5*dist*cache_z[i]);
-        f[i] = p[0] * cache_e[i] + p[4];
-    }
-    """
-    
     def f(self, pars):
-        f = self._f
         cache_z, cache_e = self.cache
-        p = pars
-        weave.inline(self.f_code, ["f", "cache_z", "cache_e", "p"], **opt_args)
-    
-    fJ_code = DEFAULT_TYPEDEFC + """
-    const int n = Nf[0];
-    const float_type inv_s1_sq = 1.0/(p[2]*p[2]);
-    const float_type inv_s2_sq = 1.0/(p[3]*p[3]);
-    for (int i = 0; i < n; ++i) {
-        float_type dist = i-p[1];
-        float_type left = float_type(dist < 0);
-        cache_z[i] = dist * (inv_s1_sq*left + inv_s2_sq*(1.-left));
-        cache_e[i] = exp(-.5*dist*cache_z[i]);
-        f[i] = p[0] * cache_e[i] + p[4];
-    }
-
-    for(int i=0; i<n; ++i){
-        J[i] = cache_e[i];
-    }
-    for(int i=0; i<n; ++i){
-        J[n+i] = cache_z[i] * p[0] * cache_e[i];
-    }
-    for(int i=0; i<n; ++i){
-        float_type left = float_type(i-p[1] < 0);
-        J[2*n+i] = left * cache_z[i]*cache_z[i]* p[2] * p[0] * cache_e[i];
-        J[3*n+i] = (1.-left) * cache_z[i]*cache_z[i]* p[3] * p[0] * cache_e[i];
-    }
-    for(int i=0; i<n; ++i){
-        J[4*n+i] = 1.;
-    }
-    """
+        kernels.gauss1dasym_f(pars, self._f, cache_z, cache_e)
 
     def fJ(self, pars):
-        f, J = self._f, self._J
         cache_z, cache_e = self.cache
-        p = pars
-        weave.inline(self.fJ_code, ["f", "J", "cache_z", "cache_e", "p"], **opt_args)
+        kernels.gauss1dasym_fJ(pars, self._f, self._J, cache_z, cache_e)
 
     def sanitizePars(self, pars):
         pars[2] = abs(pars[2])
@@ -225,6 +197,145 @@ class Gauss1DAsym(LevmarFitter):
         return .5 * np.sqrt(2.*np.pi) * pars[0] * (pars[2] + pars[3])
 
 
+class MultiGauss1D(LevmarFitter):
+    r"""
+    Fitter for a sum of one-dimensional Gauss functions.
+    
+    The data to be fitted is interpreted as evenly spaced measurements, like the
+    bins of a time of flight histogram.
+    
+    .. math:: f(x) = \sum_{i=0}^{N-1} A_i\cdot\exp\left[-\frac{(x-x_i)^2}{2 \sigma_i^2}\right] + \text{off}
+    
+    The order of the fit parameters is (A_0, x_0, s_0, A_1, x_1, s_1, ..., off).
+    
+    Each peak is evaluated within `cutoff` standard deviations around its center only.
+    Since the jacobian of a peak vanishes outside of this window, the normal equations
+    are accumulated from the windows of the peaks and their overlaps by :func:`JTJ`.
+    The full jacobian is not stored for unweighted data, so fitting many narrow peaks
+    on a long spectrum is limited by the widths of the peaks, not the length of the data.
+    
+    :param data: (ndarray) Array of measurements.
+    :param peaks: (int) Number of peaks.
+    :param dtype: (dtype) Floating point type for computations or None.
+    """
+    
+    # the norm of the parameters is dominated by the peak positions of long spectra
+    eps2_default = 1e-10
+    
+    # peaks are evaluated within this number of standard deviations
+    cutoff = 7.
+    
+    def __init__(self, data, peaks, dtype = None):
+        self.peaks = int(peaks)
+        pars_name = ["%s_%d" % (name, i) for i in range(self.peaks) for name in ("A", "x", "s")]
+        LevmarFitter.__init__(self, pars_name + ["off"], data, dtype)
+        self.x = np.arange(self.data.size, dtype = self.dtype)
+    
+    def _fitterArgs(self):
+        return (self.peaks, )
+    
+    def guess(self):
+        data = np.asfarray(self.data)
+        off = np.median(data)
+        residual = data - off
+        peaks = []
+        for i in range(self.peaks):
+            # take the largest remaining peak, width from its half maximum
+            x_0 = int(np.argmax(residual))
+            A = residual[x_0]
+            left, right = x_0, x_0
+            while left > 0 and residual[left-1] > .5*A: left -= 1
+            while right < data.size-1 and residual[right+1] > .5*A: right += 1
+            s = max((right - left + 1) / 2.3548, .5)
+            residual -= A * np.exp(-.5 * (np.arange(data.size) - x_0)**2 / s**2)
+            peaks.append((x_0, A, s))
+        pars = [(A, x_0, s) for x_0, A, s in sorted(peaks)]
+        return np.asfarray(list(np.ravel(pars)) + [off])
+    
+    def windows(self, pars):
+        """
+        Return the range of data points within the cutoff of each peak.
+        
+        :param pars: (ndarray) Fit parameters.
+        :returns: (ndarray, ndarray) Start and stop index for each peak.
+        """
+        x_0, s = pars[1:-1:3], np.abs(pars[2:-1:3])
+        start = np.clip(np.floor(x_0 - self.cutoff*s), 0, self.x.size).astype(int)
+        stop = np.clip(np.ceil(x_0 + self.cutoff*s) + 1, 0, self.x.size).astype(int)
+        return start, stop
+    
+    def __peak(self, pars, i, start, stop):
+        # values and derivatives of a single peak within its window
+        A, x_0, s = pars[3*i:3*i+3]
+        dx = self.x[start:stop] - x_0
+        z = dx * (1. / (s*s))
+        D = np.empty([3, stop - start], dtype = self.dtype)
+        np.exp(-.5 * dx * z, out = D[0])
+        np.multiply(D[0], A * z, out = D[1])
+        np.multiply(D[1], dx * (1. / s), out = D[2])
+        return D
+    
+    def f(self, pars):
+        start, stop = self.windows(pars)
+        self._f[:] = pars[-1]
+        for i in range(self.peaks):
+            A, x_0, s = pars[3*i:3*i+3]
+            dx = self.x[start[i]:stop[i]] - x_0
+            self._f[start[i]:stop[i]] += A * np.exp(-.5 / (s*s) * dx*dx)
+    
+    def fJ(self, pars):
+        start, stop = self.windows(pars)
+        self._f[:] = pars[-1]
+        J = self._J
+        J[:-1] = 0.
+        J[-1] = 1.
+        for i in range(self.peaks):
+            D = self.__peak(pars, i, start[i], stop[i])
+            J[3*i:3*i+3, start[i]:stop[i]] = D
+            self._f[start[i]:stop[i]] += pars[3*i] * D[0]
+    
+    def JTJ(self, pars, r):
+        start, stop = self.windows(pars)
+        k = len(self.pars_name)
+        D = [self.__peak(pars, i, start[i], stop[i]).astype(DEFAULT_TYPE_NPY) for i in range(self.peaks)]
+        JTJ = np.zeros([k, k])
+        JTr = np.zeros(k)
+        JTJ[-1, -1] = r.size
+        JTr[-1] = r.sum(dtype = DEFAULT_TYPE_NPY)
+        
+        # only peaks with overlapping windows couple, visit them ordered by position
+        order = np.argsort(start)
+        for n, i in enumerate(order):
+            bi = slice(3*i, 3*i+3)
+            JTr[bi] = np.dot(D[i], r[start[i]:stop[i]])
+            JTJ[bi, -1] = JTJ[-1, bi] = D[i].sum(axis = 1)
+            for j in order[n:]:
+                if start[j] >= stop[i]:
+                    break
+                a, b = max(start[i], start[j]), min(stop[i], stop[j])
+                block = np.inner(D[i][:, a-start[i]:b-start[i]], D[j][:, a-start[j]:b-start[j]])
+                JTJ[bi, 3*j:3*j+3] = block
+                JTJ[3*j:3*j+3, bi] = block.T
+        return JTJ, JTr
+    
+    def sanitizePars(self, pars):
+        pars[2:-1:3] = np.abs(pars[2:-1:3])
+        return pars
+    
+    def integral(self, pars = None, peak = None):
+        """
+        Calculate the integral of the gauss functions defined by `pars`.
+        
+        :param pars: (ndarray) Parameters or `None` to use param from fit.
+        :param peak: (int) Index of a single peak or `None` for the sum of all peaks.
+        :return: (float) Value of the integral.
+        """
+        if pars is None:
+            pars = self.pars_fit
+        integrals = np.sqrt(2.*np.pi) * pars[0:-1:3] * np.abs(pars[2:-1:3])
+        return integrals.sum() if peak is None else integrals[peak]
+
+
 class Gauss2D(LevmarFitter):
     r"""
     Fitter for two-dimensional axis aligned Gauss functions.
@@ -237,16 +348,37 @@ class Gauss2D(LevmarFitter):
     The order of the fit parameters is (A, x_0, s_x, y_0, s_y, off). 
     
     :param data: (ndarray) Image to be fitted.
+    :param dtype: (dtype) Floating point type for computations or None.
     """
+    
+    pars_kind = (None, "x", "size", "y", "size", None)
+    supports_mask = True
+    
+    # fraction of the signal missed by the moment guess before falling back to projection fits
+    guess_tolerance = .5
         
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A", "x_0", "s_x", "y_0", "s_y", "off"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "x_0", "s_x", "y_0", "s_y", "off"], data, dtype)
 
-        cache_ex = np.empty(data.shape[1], dtype = DEFAULT_TYPE_NPY)
-        cache_ey = np.empty(data.shape[0], dtype = DEFAULT_TYPE_NPY)
+        cache_ex = np.empty(data.shape[1], dtype = self.dtype)
+        cache_ey = np.empty(data.shape[0], dtype = self.dtype)
         self.cache = (cache_ex, cache_ey)
     
     def guess(self):
+        """
+        Guess the parameters from the moments of the x and y projections, see
+        :func:`momentGuess2D`. If this guess misses more than `guess_tolerance`
+        of the signal, the parameters are guessed by :func:`guessProjectionFit`.
+        """
+        pars = momentGuess2D(self.data)
+        if poorGuess(self, pars, self.guess_tolerance):
+            return self.guessProjectionFit()
+        return pars
+    
+    def guessProjectionFit(self):
+        """
+        Guess the parameters by fitting the x and y projections with :class:`Gauss1D`.
+        """
         # fit projection to x and y direction
         projection_fitter = Gauss1D(self.data.sum(axis=0))
         pars_x = projection_fitter.fit()
@@ -269,81 +401,69 @@ class Gauss2D(LevmarFitter):
         off = 0.5 * (pars_x[3]/(ny-1) + pars_y[3]/(nx-1))
         return np.asfarray((amp, x_0, s_x, y_0, s_y, off))
     
-    f_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ncache_ex[0];
-    const int ny = Ncache_ey[0];
-    const float_type inv_sx_2 = 1. / p[2] / p[2];
-    const float_type inv_sy_2 = 1. / p[4] / p[4];
-
-    // cache exp values
-    for (int ix = 0; ix < nx; ++ix) {
-        float_type dist = ix-p[1];
-        cache_ex[ix] = exp(-.5*inv_sx_2*dist*dist);
-    }
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type dist = iy-p[3];
-        cache_ey[iy] = exp(-.5*inv_sy_2*dist*dist);
-    }
-    // calc f
-    for (int iy = 0; iy < ny; ++iy) {
-        for (int ix = 0; ix < nx; ++ix) {
-            f[nx*iy+ix] = p[0] * cache_ex[ix] * cache_ey[iy] + p[5];
-        }
-    }
-    """
-    
     def f(self, pars):
-        f = self._f
         cache_ex, cache_ey = self.cache
-        p = pars
-        weave.inline(self.f_code, ["f", "cache_ex", "cache_ey", "p"], **opt_args)
-    
-    fJ_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ncache_ex[0];
-    const int ny = Ncache_ey[0];
-    const int n = nx * ny;
-    const float_type invsx = 1. / p[2];
-    const float_type invsy = 1. / p[4];
-    const float_type inv_sx_2 = invsx * invsx;
-    const float_type inv_sy_2 = invsy * invsy;
-    const float_type inv_sx_3 = inv_sx_2 * invsx;
-    const float_type inv_sy_3 = inv_sy_2 * invsy;
-
-    // cache exp values
-    for (int ix = 0; ix < nx; ++ix) {
-        float_type dist = ix-p[1];
-        cache_ex[ix] = exp(-.5*inv_sx_2*dist*dist);
-    }
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type dist = iy-p[3];
-        cache_ey[iy] = exp(-.5*inv_sy_2*dist*dist);
-    }
-    // calc f and jacobian
-    #pragma omp parallel for
-    for (int iy = 0; iy < ny; ++iy) {
-        const float_type disty = iy-p[3];
-        
-        for (int ix = 0; ix < nx; ++ix) {
-            const float_type distx = ix-p[1];
-            const float_type e = cache_ex[ix] * cache_ey[iy];
-            const int ind = nx*iy+ix;
-            
-            f[ind] = p[0] * e + p[5];
-            J[ind] = e;
-            J[ind+1*n] = distx * inv_sx_2 * p[0] * e;
-            J[ind+2*n] = distx*distx * inv_sx_3 * p[0] * e;
-            J[ind+3*n] = disty * inv_sy_2 * p[0] * e;
-            J[ind+4*n] = disty*disty * inv_sy_3 * p[0] * e;
-            J[ind+5*n] = 1.0;
-        }
-    }
-    """
+        if self._mask_coords is None:
+            kernels.gauss2d_f(pars, self._f, cache_ex, cache_ey)
+        else:
+            iy, ix = self._mask_coords
+            kernels.gauss2d_f_masked(pars, self._f, cache_ex, cache_ey, ix, iy)
     
     def fJ(self, pars):
-        f, J = self._f, self._J
         cache_ex, cache_ey = self.cache
-        p = pars
-        weave.inline(self.fJ_code, ["f", "J", "cache_ex", "cache_ey", "p"], **opt_args)
+        if self._mask_coords is None:
+            kernels.gauss2d_fJ(pars, self._f, self._J, cache_ex, cache_ey)
+        else:
+            iy, ix = self._mask_coords
+            kernels.gauss2d_fJ_masked(pars, self._f, self._J, cache_ex, cache_ey, ix, iy)
+
+    def JTJ(self, pars, r):
+        A, x_0, s_x, y_0, s_y, off = pars
+        ny, nx = self.data.shape
+        dx = np.arange(nx, dtype = DEFAULT_TYPE_NPY) - x_0
+        dy = np.arange(ny, dtype = DEFAULT_TYPE_NPY) - y_0
+        ex = np.exp(-.5 * dx**2 / s_x**2)
+        ey = np.exp(-.5 * dy**2 / s_y**2)
+
+        # each row of the jacobian is an outer product J_k(y, x) = V_k(y) * U_k(x)
+        U = np.empty([6, nx], dtype = DEFAULT_TYPE_NPY)
+        V = np.empty([6, ny], dtype = DEFAULT_TYPE_NPY)
+        U[0] = ex;                     V[0] = ey
+        U[1] = A * dx / s_x**2 * ex;   V[1] = ey
+        U[2] = U[1] * dx / s_x;        V[2] = ey
+        U[3] = ex;                     V[3] = A * dy / s_y**2 * ey
+        U[4] = ex;                     V[4] = V[3] * dy / s_y
+        U[5] = 1.;                     V[5] = 1.
+
+        # sum over pixels factorizes into sums over x and y
+        JTJ = np.inner(U, U) * np.inner(V, V)
+        JTr = (np.dot(V.astype(self.dtype), r.reshape(ny, nx)) * U).sum(axis = 1)
+        return JTJ, JTr
+
+    def fJBatch(self, pars, f, J):
+        m = len(pars)
+        ny, nx = self.data.shape
+        A, x_0, s_x, y_0, s_y, off = [pars[:, i, np.newaxis] for i in range(6)]
+
+        # exp values and derivative factors along x and y, shape (m, nx) and (m, ny)
+        dx = np.arange(nx, dtype = DEFAULT_TYPE_NPY) - x_0
+        dy = np.arange(ny, dtype = DEFAULT_TYPE_NPY) - y_0
+        zx = dx * (1. / s_x**2)
+        zy = dy * (1. / s_y**2)
+        ex = np.exp(-.5 * dx * zx)
+        ey = np.exp(-.5 * dy * zy)
+
+        # calc f and jacobian
+        f, J = f.reshape(m, ny, nx), J.reshape(m, 6, ny, nx)
+        e = J[:, 0]
+        np.multiply(ey[:, :, np.newaxis], ex[:, np.newaxis, :], out = e)
+        np.multiply(e, A[:, :, np.newaxis], out = f)
+        f += off[:, :, np.newaxis]
+        np.multiply(e, (A * zx)[:, np.newaxis, :], out = J[:, 1])
+        np.multiply(e, (A * zx * dx / s_x)[:, np.newaxis, :], out = J[:, 2])
+        np.multiply(e, (A * zy)[:, :, np.newaxis], out = J[:, 3])
+        np.multiply(e, (A * zy * dy / s_y)[:, :, np.newaxis], out = J[:, 4])
+        J[:, 5] = 1.0
 
     def sanitizePars(self, pars):
         pars[2] = abs(pars[2])
@@ -380,10 +500,14 @@ class Gauss2DRot(LevmarFitter):
     The order of the fit parameters is (A, x_0, s_x, y_0, s_y, alpha, off). 
     
     :param data: (ndarray) Image to be fitted.
+    :param dtype: (dtype) Floating point type for computations or None.
     """
     
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A", "x_0", "s_x", "y_0", "s_y", "alpha", "off"], data)
+    pars_kind = (None, "x", "size", "y", "size", None, None)
+    supports_mask = True
+    
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "x_0", "s_x", "y_0", "s_y", "alpha", "off"], data, dtype)
     
     def guess(self):
         # fit projection to x and y direction
@@ -425,82 +549,21 @@ class Gauss2DRot(LevmarFitter):
         
         return np.asfarray([amp, x0, pars_x_rot[2], y0, pars_y_rot[2], alpha, offset])
 
-    f_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ndata[1];
-    const int ny = Ndata[0];
-    const int n = nx * ny;
-    const float_type cosa = cos(p[5]), sina = sin(p[5]);
-    
-    const float_type inv_sx = 1./p[2], inv_sy = 1.0/p[4];
-    const float_type inv_sx_2 = inv_sx*inv_sx, inv_sy_2 = inv_sy*inv_sy;
-
-    // calc rotated gauss
-    #pragma omp parallel for
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type dy = iy - p[3];
-        for (int ix = 0; ix < nx; ++ix) {
-            float_type dx = ix - p[1];
-            float_type xrot = cosa*dx + sina*dy;
-            float_type yrot = cosa*dy - sina*dx;
-            float_type e = exp(.5 * ( - inv_sx_2*xrot*xrot - inv_sy_2*yrot*yrot ) );                
-            f[iy*nx + ix] = p[0] * e + p[6];
-        }
-    }
-    """
-
     def f(self, pars):
-        data = self.data
-        f = self._f
-        p = pars
-        weave.inline(self.f_code, ["f", "p", "data"], **opt_args)
-    
-    fJ_code = DEFAULT_TYPEDEFC + """
-    const int nx = Ndata[1];
-    const int ny = Ndata[0];
-    const int n = nx * ny;
-    const float_type cosa = cos(p[5]), sina = sin(p[5]);
-    
-    const float_type inv_sx = 1./p[2], inv_sy = 1.0/p[4];
-    const float_type inv_sx_2 = inv_sx*inv_sx, inv_sy_2 = inv_sy*inv_sy;
-    const float_type inv_sx_3 = inv_sx_2*inv_sx, inv_sy_3 = inv_sy_2*inv_sy;
-
-    // calc rotated gauss
-    #pragma omp parallel for
-    for (int iy = 0; iy < ny; ++iy) {
-        float_type dy = iy - p[3];
-        for (int ix = 0; ix < nx; ++ix) {
-            float_type dx = ix - p[1];
-            float_type xrot = cosa*dx + sina*dy;
-            float_type yrot = cosa*dy - sina*dx;
-            
-            int ind = iy*nx + ix;
-            float_type e = exp(.5 * ( - inv_sx_2*xrot*xrot - inv_sy_2*yrot*yrot ) );
-            
-            f[ind] = p[0] * e + p[6];
-            
-            float_type coeff[5];
-            coeff[0] = inv_sx_2*cosa*xrot - inv_sy_2*sina*yrot;
-            coeff[1] = inv_sx_3*xrot*xrot;
-            coeff[2] = inv_sx_2*sina*xrot + inv_sy_2*cosa*yrot;
-            coeff[3] = inv_sy_3*yrot*yrot;
-            coeff[4] = (p[2]*p[2]-p[4]*p[4])*inv_sx_2*inv_sy_2 * yrot*xrot;
-            
-            J[ind] = e;
-            J[ind+1*n] = p[0] * e * coeff[0];
-            J[ind+2*n] = p[0] * e * coeff[1];
-            J[ind+3*n] = p[0] * e * coeff[2];
-            J[ind+4*n] = p[0] * e * coeff[3];
-            J[ind+5*n] = p[0] * e * coeff[4];
-            J[ind+6*n] = 1.;
-        }
-    }
-    """
+        ny, nx = self.data.shape
+        if self._mask_coords is None:
+            kernels.gauss2drot_f(pars, self._f, nx, ny)
+        else:
+            iy, ix = self._mask_coords
+            kernels.gauss2drot_f_masked(pars, self._f, nx, ny, ix, iy)
     
     def fJ(self, pars):
-        data = self.data
-        f, J = self._f, self._J
-        p = pars
-        weave.inline(self.fJ_code, ["f", "J", "p", "data"], **opt_args)
+        ny, nx = self.data.shape
+        if self._mask_coords is None:
+            kernels.gauss2drot_fJ(pars, self._f, self._J, nx, ny)
+        else:
+            iy, ix = self._mask_coords
+            kernels.gauss2drot_fJ_masked(pars, self._f, self._J, nx, ny, ix, iy)
 
     def sanitizePars(self, pars):
         pars[2] = abs(pars[2])
@@ -0,0 +1,281 @@
+r"""
+Global fits
+-----------
+
+Some parameters of a measurement series are often common to all datasets, like the
+widths of clouds limited by the trap frequencies or the background offset, while the
+amplitudes and positions vary from shot to shot. The :class:`GlobalFit` fits all
+datasets of such a series at once, tying the shared parameters across all datasets.
+The model of a single dataset is given by any fitter derived from :class:`LevmarFitter`.
+
+For `N` datasets with `s` shared and `l` individual parameters, the normal equations
+of the global fit problem have a block arrow structure. The shared parameters couple
+to all datasets, while the individual parameters of different datasets do not couple
+at all. Instead of solving a dense system of size (s + N*l), the step of the shared
+parameters is solved from the Schur complement and the steps of the individual
+parameters from N small systems. The cost of each iteration grows linearly with N.
+
+.. math::
+
+    \begin{pmatrix} U & W_1 & \cdots & W_N \\ W_1^T & V_1 & & \\ \vdots & & \ddots & \\ W_N^T & & & V_N \end{pmatrix}
+
+Example::
+
+    from qao.fit import Gauss2D, GlobalFit
+
+    fit = GlobalFit(Gauss2D, images, shared = ["s_x", "s_y", "off"])
+    pars = fit.fit()
+    errs = fit.getFitErr()
+
+"""
+
+import numpy as np
+import scipy.stats
+from fitter import DEFAULT_TYPE_NPY
+
+class GlobalFit(object):
+    """
+    Fit a stack of datasets with parameters shared by all datasets.
+
+    The first axis of `data` enumerates the datasets, the remaining axes are passed to
+    a single fitter of the class `fitter_class`, which is created using `fitter_args`
+    and `fitter_kwargs`. The shared parameters are given by their names or indices.
+    A common mask and standard deviations for all datasets are passed to the fitter
+    by :func:`LevmarFitter.setMask` and :func:`LevmarFitter.setSigma`.
+
+    The fit parameters are returned as (N, p) array like :func:`LevmarFitter.fitBatch`,
+    the columns of the shared parameters being equal for all datasets.
+
+    :param fitter_class: (class) Fitter class derived from :class:`LevmarFitter`.
+    :param data: (ndarray) Stack of datasets to be fitted.
+    :param shared: (list) Names or indices of the shared fit parameters.
+    :param mask: (ndarray) Points excluded from fitting or None.
+    :param sigma: (ndarray) Standard deviations of the data points or None.
+    """
+
+    def __init__(self, fitter_class, data, shared, fitter_args = (), fitter_kwargs = None,
+                 mask = None, sigma = None):
+        data = np.asarray(data)
+        if data.ndim < 2:
+            raise ValueError("Expected a stack of datasets.")
+        self.fitter = fitter_class(data[0], *fitter_args, **dict(fitter_kwargs or {}))
+        if mask is not None: self.fitter.setMask(mask)
+        if sigma is not None: self.fitter.setSigma(sigma)
+        self.data = data
+        self.pars_name = self.fitter.getFitParNames()
+
+        n_pars = len(self.pars_name)
+        self.shared = np.zeros(n_pars, dtype = bool)
+        for par in shared:
+            self.shared[self.pars_name.index(par) if isinstance(par, basestring) else int(par)] = True
+        if self.shared.all() or not self.shared.any():
+            raise ValueError("Expected shared and individual fit parameters.")
+
+        self.pars_fit = np.zeros([len(data), n_pars], dtype = DEFAULT_TYPE_NPY)
+        self.fit_log = None
+        self.__normal = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def setData(self, data):
+        """
+        Replace the datasets to be fitted. The shape of the stack must not change.
+
+        :param data: (ndarray) New stack of datasets.
+        """
+        data = np.asarray(data)
+        if data.shape != self.data.shape:
+            raise ValueError("Shape mismatch. Expected dimensions %s." % (self.data.shape, ))
+        self.data = data
+        self.__normal = None
+
+    def guess(self):
+        """
+        Guess the parameters of each dataset by the fitter. The shared parameters
+        are averaged over all datasets.
+
+        :returns: (ndarray) Fit parameters guessed for each dataset.
+        """
+        pars = np.empty(self.pars_fit.shape, dtype = DEFAULT_TYPE_NPY)
+        for i, data in enumerate(self.data):
+            self.fitter.setData(data)
+            pars[i] = self.fitter.guess()
+        pars[:, self.shared] = pars[:, self.shared].mean(axis = 0)
+        return pars
+
+    def _normalEquations(self, pars):
+        # normal equations of the single datasets, shapes (N, p, p) and (N, p)
+        A = np.empty(pars.shape + pars.shape[-1:])
+        g = np.empty(pars.shape)
+        errsq = 0.
+        for i, data in enumerate(self.data):
+            self.fitter.setData(data)
+            A[i], g[i], errsq_i = self.fitter.normalEquations(pars[i])
+            errsq += errsq_i
+        return A, g, errsq
+
+    def __blocks(self, A):
+        # blocks U, W and V of the block arrow matrix
+        s, l = self.shared, ~self.shared
+        U = A[:, s][:, :, s].sum(axis = 0)
+        W = A[:, s][:, :, l]
+        V = A[:, l][:, :, l]
+        return U, W, V
+
+    def __flat(self, x, shared_sum = False):
+        # vector of the unknowns of the global problem from an (N, p) array
+        x_s = x[:, self.shared].sum(axis = 0) if shared_sum else x[0, self.shared]
+        return np.concatenate([x_s, x[:, ~self.shared].ravel()])
+
+    def _solve(self, A, g, mu):
+        """
+        Solve the damped normal equations of the global problem.
+        """
+        U, W, V = self.__blocks(A)
+        s, l = self.shared, ~self.shared
+        V = V + mu * np.eye(V.shape[-1])
+
+        # V^-1 * W^T and V^-1 * g for all datasets at once
+        X = np.linalg.solve(V, np.concatenate([W.transpose(0, 2, 1), g[:, l, np.newaxis]], axis = 2))
+        VW, Vg = X[:, :, :-1], X[:, :, -1]
+
+        # Schur complement for the shared parameters, back substitution for the individual ones
+        S = U + mu * np.eye(U.shape[0]) - np.einsum("nsl,nlt->st", W, VW)
+        d_s = np.linalg.solve(S, -g[:, s].sum(axis = 0) + np.einsum("nsl,nl->s", W, Vg))
+        d = np.empty(g.shape)
+        d[:, s] = d_s
+        d[:, l] = -Vg - np.einsum("nls,s->nl", VW, d_s)
+        return d
+
+    def fit(self, pars_guess = None, tau = 1e-2, eps1 = 1e-6, eps2 = None, kmax = 50, return_dict = False, callback = None):
+        """
+        Fit all datasets at once.
+
+        Initial parameters can be given for all datasets at once or individually as
+        (N, p) array. The initial shared parameters are averaged over the datasets.
+        If `pars_guess` is None, the parameters are determined by :func:`guess`.
+        The arguments are used like in :func:`LevmarFitter.fit`, the fit dictionary
+        describes the global fit problem.
+
+        :param pars_guess: (ndarray) Start parameters for fitting or None.
+        :param callback: (callable) Callback function.
+        :returns: (ndarray) Fit parameters for each dataset + optional fit dictionary.
+        """
+        if callback is None:
+            callback = lambda k: True
+        if eps2 is None:
+            eps2 = self.fitter.eps2_default
+        if pars_guess is None:
+            pars = self.guess()
+        else:
+            pars_guess = np.asfarray(pars_guess, dtype = DEFAULT_TYPE_NPY)
+            if pars_guess.shape[-1] != len(self.pars_name):
+                raise ValueError("Invalid number of guess parameters.")
+            pars = np.array(np.broadcast_to(pars_guess, self.pars_fit.shape))
+            pars[:, self.shared] = pars[:, self.shared].mean(axis = 0)
+
+        A, g, errsq = self._normalEquations(pars)
+        g_flat = self.__flat(g, shared_sum = True)
+        U, W, V = self.__blocks(A)
+        mu = tau * max(np.diag(U).max(), np.diagonal(V, axis1 = 1, axis2 = 2).max())
+        k = 0; nu = 2
+        stop_reason = ""
+        if np.linalg.norm(g_flat, np.Inf) < eps1:
+            stop_reason = "small gradient"
+
+        while not stop_reason and k < kmax and callback(k):
+            k += 1
+
+            try:
+                d = self._solve(A, g, mu)
+            except np.linalg.LinAlgError:
+                stop_reason = "singular matrix"
+                break
+
+            d_flat = self.__flat(d)
+            if np.linalg.norm(d_flat) < eps2*(np.linalg.norm(self.__flat(pars)) + eps2):
+                stop_reason = "small step"
+                break
+
+            pars_new = pars + d
+            A_new, g_new, errsq_new = self._normalEquations(pars_new)
+            rho = (errsq - errsq_new)/np.inner(d_flat, mu*d_flat - g_flat)
+            if rho > 0:
+                pars, A, g, errsq = pars_new, A_new, g_new, errsq_new
+                g_flat = self.__flat(g, shared_sum = True)
+                if (np.linalg.norm(g_flat, np.Inf) < eps1):
+                    stop_reason = "small gradient"
+                    break
+                mu = mu * max([1.0/3, 1.0 - (2*rho - 1)**3])
+                nu = 2.0
+            else:
+                mu = mu * nu
+                nu = 2*nu
+
+        else:
+            if not stop_reason:
+                stop_reason = "max iter reached" if k == kmax else "user abort"
+
+        self.fit_log = {"iter": k,
+                        "reason": stop_reason,
+                        "success": stop_reason in ["small gradient", "small step"],
+                        "errsq": errsq}
+        self.__normal = (A, errsq)
+        for i in range(len(pars)):
+            self.pars_fit[i] = self.fitter.sanitizePars(pars[i])
+
+        if return_dict:
+            return self.pars_fit.copy(), self.fit_log
+        else:
+            return self.pars_fit.copy()
+
+    def getFitPars(self):
+        """
+        Return the best fit parameters of each dataset.
+
+        :returns: (ndarray) Best fit parameters.
+        """
+        return self.pars_fit
+
+    def getFitErr(self):
+        """
+        Return the estimated errors of the best fit parameters of each dataset.
+
+        The errors are estimated from the covariance matrix of the global fit
+        problem, given as half width of the 95% confidence interval. Only the
+        diagonal blocks of the covariance matrix are computed.
+
+        :returns: (ndarray) Estimated errors of the best fit parameters.
+        """
+        if self.__normal is None:
+            raise ValueError("No fit results available.")
+        A, errsq = self.__normal
+        U, W, V = self.__blocks(A)
+        s, l = self.shared, ~self.shared
+
+        mask = self.fitter.getMask()
+        n_points = len(self.data) * (self.data[0].size if mask is None else int((~mask).sum()))
+        n_free = s.sum() + len(self.data) * l.sum()
+        alpha = 0.05            # 95%, 2sigma confidence limit
+        sigma = np.sqrt(errsq / (n_points - n_free))
+
+        pars_err = np.empty(self.pars_fit.shape)
+        try:
+            V_inv = np.linalg.inv(V)
+            VW = np.matmul(V_inv, W.transpose(0, 2, 1))
+            C_s = np.linalg.inv(U - np.einsum("nsl,nlt->st", W, VW))
+            pars_err[:, s] = np.diag(C_s)
+            pars_err[:, l] = np.diagonal(V_inv, axis1 = 1, axis2 = 2) + np.einsum("nls,st,nlt->nl", VW, C_s, VW)
+            pars_err = np.sqrt(pars_err) * sigma * scipy.stats.t.ppf(1 - alpha / 2, n_points - n_free)
+        except np.linalg.LinAlgError:
+            pars_err.fill(np.inf)
+        return pars_err
+
+    def getFitLog(self):
+        """
+        Return details from the fitting iteration, see :func:`LevmarFitter.getFitLog`.
+
+        :returns: (dict) Fit procedure details.
+        """
+        return self.fit_log
@@ -0,0 +1,864 @@
+r"""
+Fit model kernels
+-----------------
+
+The fit models in :mod:`qao.fit.gauss` and :mod:`qao.fit.coldatoms` compute their
+function values and jacobians using the kernels from this module. Each kernel is
+available for different backends:
+
+* **numpy** - Vectorized numpy implementation, always available.
+* **numba** - Compiled, multithreaded loops. Only available if numba is installed.
+  Compiled kernels are cached on disk, so only the very first call compiles.
+
+The backend is chosen when this module is imported. The fastest available backend
+is used, unless the environment variable `QAO_FIT_BACKEND` names a specific one.
+It can be changed at runtime by :func:`setBackend`, which affects all fitters since
+the models look up the kernels from this module for each call.
+
+All kernels take the fit parameters `p`, the flat output arrays `f` and `J`, and the
+cache arrays of the fit models. They write their results in place and may be called
+with arrays of any floating point type. The image kernels are also available as
+masked variants, taking the pixel coordinates `ix` and `iy` of the pixels to be
+evaluated. Their outputs hold only these pixels, see :func:`LevmarFitter.setMask`.
+
+Running this module as main routine benchmarks the available backends.
+"""
+
+import os
+import math
+import time
+import numpy as np
+
+# exponentials below exp(EXP_MIN) are flushed to zero by the per pixel loop
+# kernels, avoiding slow denormal numbers in single precision
+EXP_MIN = -80.
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+prange = numba.prange if numba is not None else range
+
+##########################################################################
+
+__grid_cache = {}
+
+def _grid(n, dtype):
+    # cached pixel coordinates 0..n-1, not to be modified
+    key = (n, np.dtype(dtype).char)
+    if key not in __grid_cache:
+        grid = np.arange(n, dtype = dtype)
+        grid.flags.writeable = False
+        __grid_cache[key] = grid
+    return __grid_cache[key]
+
+##########################################################################
+# numpy kernels
+
+def gauss1d_f_numpy(p, f, cache_z, cache_e):
+    np.subtract(_grid(f.size, f.dtype), p[1], out = cache_z)
+    np.multiply(cache_z, cache_z, out = cache_e)
+    cache_e *= -.5 / (p[2]*p[2])
+    np.exp(cache_e, out = cache_e)
+    cache_z *= 1. / (p[2]*p[2])
+    np.multiply(cache_e, p[0], out = f)
+    f += p[3]
+
+def gauss1d_fJ_numpy(p, f, J, cache_z, cache_e):
+    gauss1d_f_numpy(p, f, cache_z, cache_e)
+    J[0] = cache_e
+    np.multiply(cache_e, cache_z, out = J[1])
+    J[1] *= p[0]
+    np.multiply(J[1], cache_z, out = J[2])
+    J[2] *= p[2]
+    J[3] = 1.
+
+def gauss1dasym_f_numpy(p, f, cache_z, cache_e):
+    np.subtract(_grid(f.size, f.dtype), p[1], out = cache_z)
+    inv_s_sq = np.where(cache_z < 0, 1. / (p[2]*p[2]), 1. / (p[3]*p[3]))
+    np.multiply(cache_z, cache_z, out = cache_e)
+    cache_e *= -.5 * inv_s_sq
+    np.exp(cache_e, out = cache_e)
+    cache_z *= inv_s_sq
+    np.multiply(cache_e, p[0], out = f)
+    f += p[4]
+
+def gauss1dasym_fJ_numpy(p, f, J, cache_z, cache_e):
+    gauss1dasym_f_numpy(p, f, cache_z, cache_e)
+    left = _grid(f.size, f.dtype) < p[1]
+    J[0] = cache_e
+    np.multiply(cache_e, cache_z, out = J[1])
+    J[1] *= p[0]
+    np.multiply(J[1], cache_z, out = J[2])
+    J[3] = J[2]
+    J[2] *= p[2] * left
+    J[3] *= p[3] * ~left
+    J[4] = 1.
+
+def gauss2d_f_numpy(p, f, cache_ex, cache_ey):
+    nx, ny = cache_ex.size, cache_ey.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    np.exp(-.5 / (p[2]*p[2]) * dx*dx, out = cache_ex)
+    np.exp(-.5 / (p[4]*p[4]) * dy*dy, out = cache_ey)
+    f = f.reshape(ny, nx)
+    np.multiply(cache_ey[:, np.newaxis], p[0]*cache_ex, out = f)
+    f += p[5]
+
+def gauss2d_fJ_numpy(p, f, J, cache_ex, cache_ey):
+    nx, ny = cache_ex.size, cache_ey.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    inv_sx_2, inv_sy_2 = 1. / (p[2]*p[2]), 1. / (p[4]*p[4])
+    np.exp(-.5 * inv_sx_2 * dx*dx, out = cache_ex)
+    np.exp(-.5 * inv_sy_2 * dy*dy, out = cache_ey)
+
+    f, J = f.reshape(ny, nx), J.reshape(6, ny, nx)
+    e = J[0]
+    np.multiply(cache_ey[:, np.newaxis], cache_ex, out = e)
+    np.multiply(e, p[0], out = f)
+    f += p[5]
+    np.multiply(e, (p[0] * inv_sx_2) * dx, out = J[1])
+    np.multiply(J[1], dx / p[2], out = J[2])
+    np.multiply(e, ((p[0] * inv_sy_2) * dy)[:, np.newaxis], out = J[3])
+    np.multiply(J[3], (dy / p[4])[:, np.newaxis], out = J[4])
+    J[5] = 1.
+
+def gauss2d_f_masked_numpy(p, f, cache_ex, cache_ey, ix, iy):
+    nx, ny = cache_ex.size, cache_ey.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    np.exp(-.5 / (p[2]*p[2]) * dx*dx, out = cache_ex)
+    np.exp(-.5 / (p[4]*p[4]) * dy*dy, out = cache_ey)
+    np.multiply(cache_ex[ix], cache_ey[iy], out = f)
+    f *= p[0]
+    f += p[5]
+
+def gauss2d_fJ_masked_numpy(p, f, J, cache_ex, cache_ey, ix, iy):
+    nx, ny = cache_ex.size, cache_ey.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    inv_sx_2, inv_sy_2 = 1. / (p[2]*p[2]), 1. / (p[4]*p[4])
+    np.exp(-.5 * inv_sx_2 * dx*dx, out = cache_ex)
+    np.exp(-.5 * inv_sy_2 * dy*dy, out = cache_ey)
+
+    e = J[0]
+    np.multiply(cache_ex[ix], cache_ey[iy], out = e)
+    np.multiply(e, p[0], out = f)
+    f += p[5]
+    np.multiply(e, ((p[0] * inv_sx_2) * dx)[ix], out = J[1])
+    np.multiply(J[1], (dx / p[2])[ix], out = J[2])
+    np.multiply(e, ((p[0] * inv_sy_2) * dy)[iy], out = J[3])
+    np.multiply(J[3], (dy / p[4])[iy], out = J[4])
+    J[5] = 1.
+
+def _rotated_numpy(p, nx, ny, dtype):
+    # rotated coordinates of the pixel grid
+    cosa, sina = math.cos(p[5]), math.sin(p[5])
+    dx = _grid(nx, dtype) - p[1]
+    dy = (_grid(ny, dtype) - p[3])[:, np.newaxis]
+    xrot = cosa*dx + sina*dy
+    yrot = cosa*dy - sina*dx
+    return cosa, sina, xrot, yrot
+
+def gauss2drot_f_numpy(p, f, nx, ny):
+    cosa, sina, xrot, yrot = _rotated_numpy(p, nx, ny, f.dtype)
+    f = f.reshape(ny, nx)
+    np.exp(-.5 / (p[2]*p[2]) * xrot*xrot - .5 / (p[4]*p[4]) * yrot*yrot, out = f)
+    f *= p[0]
+    f += p[6]
+
+def _gauss2drot_fJ_numpy(p, f, J, cosa, sina, xrot, yrot):
+    inv_sx_2, inv_sy_2 = 1. / (p[2]*p[2]), 1. / (p[4]*p[4])
+    e = J[0]
+    np.exp(-.5 * inv_sx_2 * xrot*xrot - .5 * inv_sy_2 * yrot*yrot, out = e)
+    np.multiply(e, p[0], out = f)
+    f += p[6]
+    ae = f - p[6]
+    np.multiply(ae, inv_sx_2*cosa*xrot - inv_sy_2*sina*yrot, out = J[1])
+    np.multiply(ae, inv_sx_2/p[2] * xrot*xrot, out = J[2])
+    np.multiply(ae, inv_sx_2*sina*xrot + inv_sy_2*cosa*yrot, out = J[3])
+    np.multiply(ae, inv_sy_2/p[4] * yrot*yrot, out = J[4])
+    np.multiply(ae, (p[2]*p[2]-p[4]*p[4])*inv_sx_2*inv_sy_2 * xrot*yrot, out = J[5])
+    J[6] = 1.
+
+def gauss2drot_fJ_numpy(p, f, J, nx, ny):
+    cosa, sina, xrot, yrot = _rotated_numpy(p, nx, ny, f.dtype)
+    _gauss2drot_fJ_numpy(p, f.reshape(ny, nx), J.reshape(7, ny, nx), cosa, sina, xrot, yrot)
+
+def _rotated_masked_numpy(p, nx, ny, ix, iy, dtype):
+    # rotated coordinates of the selected pixels
+    cosa, sina = math.cos(p[5]), math.sin(p[5])
+    dx = _grid(nx, dtype)[ix] - p[1]
+    dy = _grid(ny, dtype)[iy] - p[3]
+    xrot = cosa*dx + sina*dy
+    yrot = cosa*dy - sina*dx
+    return cosa, sina, xrot, yrot
+
+def gauss2drot_f_masked_numpy(p, f, nx, ny, ix, iy):
+    cosa, sina, xrot, yrot = _rotated_masked_numpy(p, nx, ny, ix, iy, f.dtype)
+    np.exp(-.5 / (p[2]*p[2]) * xrot*xrot - .5 / (p[4]*p[4]) * yrot*yrot, out = f)
+    f *= p[0]
+    f += p[6]
+
+def gauss2drot_fJ_masked_numpy(p, f, J, nx, ny, ix, iy):
+    cosa, sina, xrot, yrot = _rotated_masked_numpy(p, nx, ny, ix, iy, f.dtype)
+    _gauss2drot_fJ_numpy(p, f, J, cosa, sina, xrot, yrot)
+
+def thomasfermi2d_f_numpy(p, f, cache_x, cache_y):
+    nx, ny = cache_x.size, cache_y.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    np.multiply(dx, 1. / (p[2]*p[2]), out = cache_x)
+    np.multiply(dy, 1. / (p[4]*p[4]), out = cache_y)
+    f = f.reshape(ny, nx)
+    np.subtract(1. - dx*cache_x, (dy*cache_y)[:, np.newaxis], out = f)
+    np.clip(f, 0., None, out = f)
+    f **= 1.5
+    f *= p[0]
+    f += p[5]
+
+def thomasfermi2d_fJ_numpy(p, f, J, cache_x, cache_y):
+    nx, ny = cache_x.size, cache_y.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    np.multiply(dx, 1. / (p[2]*p[2]), out = cache_x)
+    np.multiply(dy, 1. / (p[4]*p[4]), out = cache_y)
+
+    f, J = f.reshape(ny, nx), J.reshape(6, ny, nx)
+    parab_sqrt = J[5]
+    np.subtract(1. - dx*cache_x, (dy*cache_y)[:, np.newaxis], out = parab_sqrt)
+    np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+    np.sqrt(parab_sqrt, out = parab_sqrt)
+    np.multiply(parab_sqrt, parab_sqrt, out = J[0])
+    J[0] *= parab_sqrt
+    np.multiply(J[0], p[0], out = f)
+    f += p[5]
+    np.multiply(parab_sqrt, (3.*p[0]) * cache_x, out = J[1])
+    np.multiply(J[1], dx / p[2], out = J[2])
+    np.multiply(parab_sqrt, ((3.*p[0]) * cache_y)[:, np.newaxis], out = J[3])
+    np.multiply(J[3], (dy / p[4])[:, np.newaxis], out = J[4])
+    J[5] = 1.
+
+def thomasfermi2d_f_masked_numpy(p, f, cache_x, cache_y, ix, iy):
+    nx, ny = cache_x.size, cache_y.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    np.multiply(dx, 1. / (p[2]*p[2]), out = cache_x)
+    np.multiply(dy, 1. / (p[4]*p[4]), out = cache_y)
+    np.subtract((1. - dx*cache_x)[ix], (dy*cache_y)[iy], out = f)
+    np.clip(f, 0., None, out = f)
+    f **= 1.5
+    f *= p[0]
+    f += p[5]
+
+def thomasfermi2d_fJ_masked_numpy(p, f, J, cache_x, cache_y, ix, iy):
+    nx, ny = cache_x.size, cache_y.size
+    dx = _grid(nx, f.dtype) - p[1]
+    dy = _grid(ny, f.dtype) - p[3]
+    np.multiply(dx, 1. / (p[2]*p[2]), out = cache_x)
+    np.multiply(dy, 1. / (p[4]*p[4]), out = cache_y)
+
+    parab_sqrt = J[5]
+    np.subtract((1. - dx*cache_x)[ix], (dy*cache_y)[iy], out = parab_sqrt)
+    np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+    np.sqrt(parab_sqrt, out = parab_sqrt)
+    np.multiply(parab_sqrt, parab_sqrt, out = J[0])
+    J[0] *= parab_sqrt
+    np.multiply(J[0], p[0], out = f)
+    f += p[5]
+    np.multiply(parab_sqrt, ((3.*p[0]) * cache_x)[ix], out = J[1])
+    np.multiply(J[1], (dx / p[2])[ix], out = J[2])
+    np.multiply(parab_sqrt, ((3.*p[0]) * cache_y)[iy], out = J[3])
+    np.multiply(J[3], (dy / p[4])[iy], out = J[4])
+    J[5] = 1.
+
+def bimodal2d_f_numpy(p, f, cache_ex, cache_ey):
+    nx, ny = cache_ex.size, cache_ey.size
+    dx = _grid(nx, f.dtype) - p[2]
+    dy = _grid(ny, f.dtype) - p[5]
+    np.exp(-.5 / (p[4]*p[4]) * dx*dx, out = cache_ex)
+    np.exp(-.5 / (p[7]*p[7]) * dy*dy, out = cache_ey)
+
+    f = f.reshape(ny, nx)
+    np.subtract(1. - dx*dx / (p[3]*p[3]), (dy*dy / (p[6]*p[6]))[:, np.newaxis], out = f)
+    np.clip(f, 0., None, out = f)
+    f **= 1.5
+    f *= abs(p[0])
+    f += np.outer(cache_ey, abs(p[1])*cache_ex)
+    f += p[8]
+
+def bimodal2d_fJ_numpy(p, f, J, cache_ex, cache_ey):
+    nx, ny = cache_ex.size, cache_ey.size
+    amp_t, amp_g = abs(p[0]), abs(p[1])
+    dx = _grid(nx, f.dtype) - p[2]
+    dy = _grid(ny, f.dtype) - p[5]
+    invrx_2, invsx_2 = 1. / (p[3]*p[3]), 1. / (p[4]*p[4])
+    invry_2, invsy_2 = 1. / (p[6]*p[6]), 1. / (p[7]*p[7])
+    np.exp(-.5 * invsx_2 * dx*dx, out = cache_ex)
+    np.exp(-.5 * invsy_2 * dy*dy, out = cache_ey)
+
+    f, J = f.reshape(ny, nx), J.reshape(9, ny, nx)
+    parab_sqrt, gauss = J[8], J[4]
+    np.subtract(1. - invrx_2 * dx*dx, (invry_2 * dy*dy)[:, np.newaxis], out = parab_sqrt)
+    np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+    np.sqrt(parab_sqrt, out = parab_sqrt)
+    np.multiply(parab_sqrt, parab_sqrt, out = J[0])
+    J[0] *= parab_sqrt
+    np.multiply(cache_ey[:, np.newaxis], cache_ex, out = J[1])
+    np.multiply(J[1], amp_g, out = gauss)
+    np.multiply(J[0], amp_t, out = f)
+    f += gauss
+    f += p[8]
+
+    np.multiply(parab_sqrt, (3.*amp_t*invrx_2) * dx, out = J[2])
+    J[2] += gauss * (invsx_2 * dx)
+    np.multiply(parab_sqrt, (3.*amp_t*invrx_2/p[3]) * dx*dx, out = J[3])
+    np.multiply(parab_sqrt, ((3.*amp_t*invry_2) * dy)[:, np.newaxis], out = J[5])
+    J[5] += gauss * (invsy_2 * dy)[:, np.newaxis]
+    np.multiply(parab_sqrt, ((3.*amp_t*invry_2/p[6]) * dy*dy)[:, np.newaxis], out = J[6])
+    np.multiply(gauss, ((invsy_2/p[7]) * dy*dy)[:, np.newaxis], out = J[7])
+    gauss *= (invsx_2/p[4]) * dx*dx
+    J[8] = 1.
+
+def bimodal2d_f_masked_numpy(p, f, cache_ex, cache_ey, ix, iy):
+    nx, ny = cache_ex.size, cache_ey.size
+    dx = _grid(nx, f.dtype) - p[2]
+    dy = _grid(ny, f.dtype) - p[5]
+    np.exp(-.5 / (p[4]*p[4]) * dx*dx, out = cache_ex)
+    np.exp(-.5 / (p[7]*p[7]) * dy*dy, out = cache_ey)
+
+    np.subtract((1. - dx*dx / (p[3]*p[3]))[ix], (dy*dy / (p[6]*p[6]))[iy], out = f)
+    np.clip(f, 0., None, out = f)
+    f **= 1.5
+    f *= abs(p[0])
+    f += abs(p[1]) * cache_ex[ix] * cache_ey[iy]
+    f += p[8]
+
+def bimodal2d_fJ_masked_numpy(p, f, J, cache_ex, cache_ey, ix, iy):
+    nx, ny = cache_ex.size, cache_ey.size
+    amp_t, amp_g = abs(p[0]), abs(p[1])
+    dx = _grid(nx, f.dtype) - p[2]
+    dy = _grid(ny, f.dtype) - p[5]
+    invrx_2, invsx_2 = 1. / (p[3]*p[3]), 1. / (p[4]*p[4])
+    invry_2, invsy_2 = 1. / (p[6]*p[6]), 1. / (p[7]*p[7])
+    np.exp(-.5 * invsx_2 * dx*dx, out = cache_ex)
+    np.exp(-.5 * invsy_2 * dy*dy, out = cache_ey)
+
+    parab_sqrt, gauss = J[8], J[4]
+    np.subtract((1. - invrx_2 * dx*dx)[ix], (invry_2 * dy*dy)[iy], out = parab_sqrt)
+    np.clip(parab_sqrt, 0., None, out = parab_sqrt)
+    np.sqrt(parab_sqrt, out = parab_sqrt)
+    np.multiply(parab_sqrt, parab_sqrt, out = J[0])
+    J[0] *= parab_sqrt
+    np.multiply(cache_ex[ix], cache_ey[iy], out = J[1])
+    np.multiply(J[1], amp_g, out = gauss)
+    np.multiply(J[0], amp_t, out = f)
+    f += gauss
+    f += p[8]
+
+    np.multiply(parab_sqrt, ((3.*amp_t*invrx_2) * dx)[ix], out = J[2])
+    J[2] += gauss * (invsx_2 * dx)[ix]
+    np.multiply(parab_sqrt, ((3.*amp_t*invrx_2/p[3]) * dx*dx)[ix], out = J[3])
+    np.multiply(parab_sqrt, ((3.*amp_t*invry_2) * dy)[iy], out = J[5])
+    J[5] += gauss * (invsy_2 * dy)[iy]
+    np.multiply(parab_sqrt, ((3.*amp_t*invry_2/p[6]) * dy*dy)[iy], out = J[6])
+    np.multiply(gauss, ((invsy_2/p[7]) * dy*dy)[iy], out = J[7])
+    gauss *= ((invsx_2/p[4]) * dx*dx)[ix]
+    J[8] = 1.
+
+##########################################################################
+# loop kernels, compiled by numba
+
+def gauss1d_f_loop(p, f, cache_z, cache_e):
+    n = f.shape[0]
+    invp2sq = 1.0/(p[2]*p[2])
+    for i in range(n):
+        dist = i-p[1]
+        cache_z[i] = dist * invp2sq
+        cache_e[i] = math.exp(-.5*dist*cache_z[i])
+        f[i] = p[0] * cache_e[i] + p[3]
+
+def gauss1d_fJ_loop(p, f, J, cache_z, cache_e):
+    n = f.shape[0]
+    invp2sq = 1.0/(p[2]*p[2])
+    for i in range(n):
+        dist = i-p[1]
+        cache_z[i] = dist * invp2sq
+        cache_e[i] = math.exp(-.5*dist*cache_z[i])
+        f[i] = p[0] * cache_e[i] + p[3]
+        J[0, i] = cache_e[i]
+        J[1, i] = cache_z[i] * p[0] * cache_e[i]
+        J[2, i] = cache_z[i]*cache_z[i]*p[2] * p[0] * cache_e[i]
+        J[3, i] = 1.
+
+def gauss1dasym_f_loop(p, f, cache_z, cache_e):
+    n = f.shape[0]
+    inv_s1_sq = 1.0/(p[2]*p[2])
+    inv_s2_sq = 1.0/(p[3]*p[3])
+    for i in range(n):
+        dist = i-p[1]
+        cache_z[i] = dist * (inv_s1_sq if dist < 0 else inv_s2_sq)
+        cache_e[i] = math.exp(-.5*dist*cache_z[i])
+        f[i] = p[0] * cache_e[i] + p[4]
+
+def gauss1dasym_fJ_loop(p, f, J, cache_z, cache_e):
+    n = f.shape[0]
+    inv_s1_sq = 1.0/(p[2]*p[2])
+    inv_s2_sq = 1.0/(p[3]*p[3])
+    for i in range(n):
+        dist = i-p[1]
+        left = dist < 0
+        cache_z[i] = dist * (inv_s1_sq if left else inv_s2_sq)
+        cache_e[i] = math.exp(-.5*dist*cache_z[i])
+        f[i] = p[0] * cache_e[i] + p[4]
+        J[0, i] = cache_e[i]
+        J[1, i] = cache_z[i] * p[0] * cache_e[i]
+        J[2, i] = cache_z[i]*cache_z[i]* p[2] * p[0] * cache_e[i] if left else 0.
+        J[3, i] = 0. if left else cache_z[i]*cache_z[i]* p[3] * p[0] * cache_e[i]
+        J[4, i] = 1.
+
+def gauss2d_f_loop(p, f, cache_ex, cache_ey):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    inv_sx_2 = 1. / p[2] / p[2]
+    inv_sy_2 = 1. / p[4] / p[4]
+    for ix in range(nx):
+        dist = ix-p[1]
+        cache_ex[ix] = math.exp(-.5*inv_sx_2*dist*dist)
+    for iy in range(ny):
+        dist = iy-p[3]
+        cache_ey[iy] = math.exp(-.5*inv_sy_2*dist*dist)
+    for iy in prange(ny):
+        for ix in range(nx):
+            f[nx*iy+ix] = p[0] * cache_ex[ix] * cache_ey[iy] + p[5]
+
+def gauss2d_fJ_loop(p, f, J, cache_ex, cache_ey):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    invsx = 1. / p[2]
+    invsy = 1. / p[4]
+    inv_sx_2 = invsx * invsx
+    inv_sy_2 = invsy * invsy
+    inv_sx_3 = inv_sx_2 * invsx
+    inv_sy_3 = inv_sy_2 * invsy
+    for ix in range(nx):
+        dist = ix-p[1]
+        cache_ex[ix] = math.exp(-.5*inv_sx_2*dist*dist)
+    for iy in range(ny):
+        dist = iy-p[3]
+        cache_ey[iy] = math.exp(-.5*inv_sy_2*dist*dist)
+    for iy in prange(ny):
+        disty = iy-p[3]
+        for ix in range(nx):
+            distx = ix-p[1]
+            e = cache_ex[ix] * cache_ey[iy]
+            ind = nx*iy+ix
+            f[ind] = p[0] * e + p[5]
+            J[0, ind] = e
+            J[1, ind] = distx * inv_sx_2 * p[0] * e
+            J[2, ind] = distx*distx * inv_sx_3 * p[0] * e
+            J[3, ind] = disty * inv_sy_2 * p[0] * e
+            J[4, ind] = disty*disty * inv_sy_3 * p[0] * e
+            J[5, ind] = 1.0
+
+def gauss2d_f_masked_loop(p, f, cache_ex, cache_ey, ix, iy):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    inv_sx_2 = 1. / p[2] / p[2]
+    inv_sy_2 = 1. / p[4] / p[4]
+    for x in range(nx):
+        dist = x-p[1]
+        cache_ex[x] = math.exp(-.5*inv_sx_2*dist*dist)
+    for y in range(ny):
+        dist = y-p[3]
+        cache_ey[y] = math.exp(-.5*inv_sy_2*dist*dist)
+    for i in prange(f.shape[0]):
+        f[i] = p[0] * cache_ex[ix[i]] * cache_ey[iy[i]] + p[5]
+
+def gauss2d_fJ_masked_loop(p, f, J, cache_ex, cache_ey, ix, iy):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    invsx = 1. / p[2]
+    invsy = 1. / p[4]
+    inv_sx_2 = invsx * invsx
+    inv_sy_2 = invsy * invsy
+    inv_sx_3 = inv_sx_2 * invsx
+    inv_sy_3 = inv_sy_2 * invsy
+    for x in range(nx):
+        dist = x-p[1]
+        cache_ex[x] = math.exp(-.5*inv_sx_2*dist*dist)
+    for y in range(ny):
+        dist = y-p[3]
+        cache_ey[y] = math.exp(-.5*inv_sy_2*dist*dist)
+    for i in prange(f.shape[0]):
+        distx = ix[i]-p[1]
+        disty = iy[i]-p[3]
+        e = cache_ex[ix[i]] * cache_ey[iy[i]]
+        f[i] = p[0] * e + p[5]
+        J[0, i] = e
+        J[1, i] = distx * inv_sx_2 * p[0] * e
+        J[2, i] = distx*distx * inv_sx_3 * p[0] * e
+        J[3, i] = disty * inv_sy_2 * p[0] * e
+        J[4, i] = disty*disty * inv_sy_3 * p[0] * e
+        J[5, i] = 1.0
+
+def gauss2drot_f_loop(p, f, nx, ny):
+    cosa, sina = math.cos(p[5]), math.sin(p[5])
+    inv_sx = 1./p[2]
+    inv_sy = 1./p[4]
+    inv_sx_2, inv_sy_2 = inv_sx*inv_sx, inv_sy*inv_sy
+    for iy in prange(ny):
+        dy = iy - p[3]
+        for ix in range(nx):
+            dx = ix - p[1]
+            xrot = cosa*dx + sina*dy
+            yrot = cosa*dy - sina*dx
+            arg = .5 * ( - inv_sx_2*xrot*xrot - inv_sy_2*yrot*yrot )
+            e = math.exp(arg) if arg > EXP_MIN else 0.
+            f[iy*nx + ix] = p[0] * e + p[6]
+
+def gauss2drot_fJ_loop(p, f, J, nx, ny):
+    cosa, sina = math.cos(p[5]), math.sin(p[5])
+    inv_sx = 1./p[2]
+    inv_sy = 1./p[4]
+    inv_sx_2, inv_sy_2 = inv_sx*inv_sx, inv_sy*inv_sy
+    inv_sx_3, inv_sy_3 = inv_sx_2*inv_sx, inv_sy_2*inv_sy
+    for iy in prange(ny):
+        dy = iy - p[3]
+        for ix in range(nx):
+            dx = ix - p[1]
+            xrot = cosa*dx + sina*dy
+            yrot = cosa*dy - sina*dx
+            ind = iy*nx + ix
+            arg = .5 * ( - inv_sx_2*xrot*xrot - inv_sy_2*yrot*yrot )
+            e = math.exp(arg) if arg > EXP_MIN else 0.
+            f[ind] = p[0] * e + p[6]
+            J[0, ind] = e
+            J[1, ind] = p[0] * e * (inv_sx_2*cosa*xrot - inv_sy_2*sina*yrot)
+            J[2, ind] = p[0] * e * (inv_sx_3*xrot*xrot)
+            J[3, ind] = p[0] * e * (inv_sx_2*sina*xrot + inv_sy_2*cosa*yrot)
+            J[4, ind] = p[0] * e * (inv_sy_3*yrot*yrot)
+            J[5, ind] = p[0] * e * ((p[2]*p[2]-p[4]*p[4])*inv_sx_2*inv_sy_2 * yrot*xrot)
+            J[6, ind] = 1.
+
+def gauss2drot_f_masked_loop(p, f, nx, ny, ix, iy):
+    cosa, sina = math.cos(p[5]), math.sin(p[5])
+    inv_sx = 1./p[2]
+    inv_sy = 1./p[4]
+    inv_sx_2, inv_sy_2 = inv_sx*inv_sx, inv_sy*inv_sy
+    for i in prange(f.shape[0]):
+        dx = ix[i] - p[1]
+        dy = iy[i] - p[3]
+        xrot = cosa*dx + sina*dy
+        yrot = cosa*dy - sina*dx
+        arg = .5 * ( - inv_sx_2*xrot*xrot - inv_sy_2*yrot*yrot )
+        e = math.exp(arg) if arg > EXP_MIN else 0.
+        f[i] = p[0] * e + p[6]
+
+def gauss2drot_fJ_masked_loop(p, f, J, nx, ny, ix, iy):
+    cosa, sina = math.cos(p[5]), math.sin(p[5])
+    inv_sx = 1./p[2]
+    inv_sy = 1./p[4]
+    inv_sx_2, inv_sy_2 = inv_sx*inv_sx, inv_sy*inv_sy
+    inv_sx_3, inv_sy_3 = inv_sx_2*inv_sx, inv_sy_2*inv_sy
+    for i in prange(f.shape[0]):
+        dx = ix[i] - p[1]
+        dy = iy[i] - p[3]
+        xrot = cosa*dx + sina*dy
+        yrot = cosa*dy - sina*dx
+        arg = .5 * ( - inv_sx_2*xrot*xrot - inv_sy_2*yrot*yrot )
+        e = math.exp(arg) if arg > EXP_MIN else 0.
+        f[i] = p[0] * e + p[6]
+        J[0, i] = e
+        J[1, i] = p[0] * e * (inv_sx_2*cosa*xrot - inv_sy_2*sina*yrot)
+        J[2, i] = p[0] * e * (inv_sx_3*xrot*xrot)
+        J[3, i] = p[0] * e * (inv_sx_2*sina*xrot + inv_sy_2*cosa*yrot)
+        J[4, i] = p[0] * e * (inv_sy_3*yrot*yrot)
+        J[5, i] = p[0] * e * ((p[2]*p[2]-p[4]*p[4])*inv_sx_2*inv_sy_2 * yrot*xrot)
+        J[6, i] = 1.
+
+def thomasfermi2d_f_loop(p, f, cache_x, cache_y):
+    nx = cache_x.shape[0]
+    ny = cache_y.shape[0]
+    inv_rx_2 = 1. / p[2] / p[2]
+    inv_ry_2 = 1. / p[4] / p[4]
+    for ix in range(nx):
+        cache_x[ix] = (ix-p[1]) * inv_rx_2
+    for iy in range(ny):
+        cache_y[iy] = (iy-p[3]) * inv_ry_2
+    for iy in prange(ny):
+        disty = iy-p[3]
+        for ix in range(nx):
+            distx = ix-p[1]
+            parab = max(1. - distx*cache_x[ix] - disty*cache_y[iy], 0.0)
+            f[nx*iy+ix] = p[0]*parab*math.sqrt(parab) + p[5]
+
+def thomasfermi2d_fJ_loop(p, f, J, cache_x, cache_y):
+    nx = cache_x.shape[0]
+    ny = cache_y.shape[0]
+    invrx = 1. / p[2]
+    invry = 1. / p[4]
+    for ix in range(nx):
+        cache_x[ix] = (ix-p[1])*invrx*invrx
+    for iy in range(ny):
+        cache_y[iy] = (iy-p[3])*invry*invry
+    for iy in prange(ny):
+        disty = iy-p[3]
+        for ix in range(nx):
+            distx = ix-p[1]
+            ind = nx*iy+ix
+            parab = 1. - distx*cache_x[ix] - disty*cache_y[iy]
+            parab_sqrt = math.sqrt(parab) if parab > 0. else 0.
+            f[ind] = p[0]*parab_sqrt*parab_sqrt*parab_sqrt + p[5]
+            J[0, ind] = parab_sqrt*parab_sqrt*parab_sqrt
+            J[1, ind] = p[0]*3.*cache_x[ix] * parab_sqrt
+            J[2, ind] = p[0]*3.*distx*cache_x[ix]*invrx * parab_sqrt
+            J[3, ind] = p[0]*3.*cache_y[iy] * parab_sqrt
+            J[4, ind] = p[0]*3.*disty*cache_y[iy]*invry * parab_sqrt
+            J[5, ind] = 1.0
+
+def thomasfermi2d_f_masked_loop(p, f, cache_x, cache_y, ix, iy):
+    nx = cache_x.shape[0]
+    ny = cache_y.shape[0]
+    inv_rx_2 = 1. / p[2] / p[2]
+    inv_ry_2 = 1. / p[4] / p[4]
+    for x in range(nx):
+        cache_x[x] = (x-p[1]) * inv_rx_2
+    for y in range(ny):
+        cache_y[y] = (y-p[3]) * inv_ry_2
+    for i in prange(f.shape[0]):
+        distx = ix[i]-p[1]
+        disty = iy[i]-p[3]
+        parab = max(1. - distx*cache_x[ix[i]] - disty*cache_y[iy[i]], 0.0)
+        f[i] = p[0]*parab*math.sqrt(parab) + p[5]
+
+def thomasfermi2d_fJ_masked_loop(p, f, J, cache_x, cache_y, ix, iy):
+    nx = cache_x.shape[0]
+    ny = cache_y.shape[0]
+    invrx = 1. / p[2]
+    invry = 1. / p[4]
+    for x in range(nx):
+        cache_x[x] = (x-p[1])*invrx*invrx
+    for y in range(ny):
+        cache_y[y] = (y-p[3])*invry*invry
+    for i in prange(f.shape[0]):
+        distx = ix[i]-p[1]
+        disty = iy[i]-p[3]
+        cx = cache_x[ix[i]]
+        cy = cache_y[iy[i]]
+        parab = 1. - distx*cx - disty*cy
+        parab_sqrt = math.sqrt(parab) if parab > 0. else 0.
+        f[i] = p[0]*parab_sqrt*parab_sqrt*parab_sqrt + p[5]
+        J[0, i] = parab_sqrt*parab_sqrt*parab_sqrt
+        J[1, i] = p[0]*3.*cx * parab_sqrt
+        J[2, i] = p[0]*3.*distx*cx*invrx * parab_sqrt
+        J[3, i] = p[0]*3.*cy * parab_sqrt
+        J[4, i] = p[0]*3.*disty*cy*invry * parab_sqrt
+        J[5, i] = 1.0
+
+def bimodal2d_f_loop(p, f, cache_ex, cache_ey):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    amp_t = abs(p[0])
+    amp_g = abs(p[1])
+    invrx = 1. / p[3]
+    invsx = 1. / p[4]
+    invry = 1. / p[6]
+    invsy = 1. / p[7]
+    for ix in range(nx):
+        dist = ix-p[2]
+        cache_ex[ix] = math.exp(-.5*invsx*invsx*dist*dist)
+    for iy in range(ny):
+        dist = iy-p[5]
+        cache_ey[iy] = math.exp(-.5*invsy*invsy*dist*dist)
+    for iy in prange(ny):
+        disty = iy-p[5]
+        for ix in range(nx):
+            distx = ix-p[2]
+            parab = 1. - distx*distx*invrx*invrx - disty*disty*invry*invry
+            parab_sqrt = math.sqrt(parab) if parab > 0. else 0.
+            f[nx*iy+ix] = amp_g * cache_ex[ix] * cache_ey[iy] + amp_t*parab_sqrt*parab_sqrt*parab_sqrt + p[8]
+
+def bimodal2d_fJ_loop(p, f, J, cache_ex, cache_ey):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    amp_t = abs(p[0])
+    amp_g = abs(p[1])
+    invrx = 1. / p[3]
+    invsx = 1. / p[4]
+    invry = 1. / p[6]
+    invsy = 1. / p[7]
+    for ix in range(nx):
+        dist = ix-p[2]
+        cache_ex[ix] = math.exp(-.5*invsx*invsx*dist*dist)
+    for iy in range(ny):
+        dist = iy-p[5]
+        cache_ey[iy] = math.exp(-.5*invsy*invsy*dist*dist)
+    for iy in prange(ny):
+        disty = iy-p[5]
+        for ix in range(nx):
+            ind = nx*iy+ix
+            distx = ix-p[2]
+            gauss = amp_g * cache_ex[ix] * cache_ey[iy]
+            parab = 1. - distx*distx*invrx*invrx - disty*disty*invry*invry
+            parab_sqrt = math.sqrt(parab) if parab > 0. else 0.
+            f[ind] = gauss + amp_t*parab_sqrt*parab_sqrt*parab_sqrt + p[8]
+            J[0, ind] = parab_sqrt*parab_sqrt*parab_sqrt
+            J[1, ind] = cache_ex[ix] * cache_ey[iy]
+            J[2, ind] = amp_t*3.*distx*invrx*invrx*parab_sqrt + distx*invsx*invsx*gauss
+            J[3, ind] = amp_t*3.*distx*distx*invrx*invrx*invrx * parab_sqrt
+            J[4, ind] = distx*distx*invsx*invsx*invsx * gauss
+            J[5, ind] = amp_t*3.*disty*invry*invry*parab_sqrt + disty*invsy*invsy*gauss
+            J[6, ind] = amp_t*3.*disty*disty*invry*invry*invry * parab_sqrt
+            J[7, ind] = disty*disty*invsy*invsy*invsy * gauss
+            J[8, ind] = 1.0
+
+def bimodal2d_f_masked_loop(p, f, cache_ex, cache_ey, ix, iy):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    amp_t = abs(p[0])
+    amp_g = abs(p[1])
+    invrx = 1. / p[3]
+    invsx = 1. / p[4]
+    invry = 1. / p[6]
+    invsy = 1. / p[7]
+    for x in range(nx):
+        dist = x-p[2]
+        cache_ex[x] = math.exp(-.5*invsx*invsx*dist*dist)
+    for y in range(ny):
+        dist = y-p[5]
+        cache_ey[y] = math.exp(-.5*invsy*invsy*dist*dist)
+    for i in prange(f.shape[0]):
+        distx = ix[i]-p[2]
+        disty = iy[i]-p[5]
+        parab = 1. - distx*distx*invrx*invrx - disty*disty*invry*invry
+        parab_sqrt = math.sqrt(parab) if parab > 0. else 0.
+        f[i] = amp_g * cache_ex[ix[i]] * cache_ey[iy[i]] + amp_t*parab_sqrt*parab_sqrt*parab_sqrt + p[8]
+
+def bimodal2d_fJ_masked_loop(p, f, J, cache_ex, cache_ey, ix, iy):
+    nx = cache_ex.shape[0]
+    ny = cache_ey.shape[0]
+    amp_t = abs(p[0])
+    amp_g = abs(p[1])
+    invrx = 1. / p[3]
+    invsx = 1. / p[4]
+    invry = 1. / p[6]
+    invsy = 1. / p[7]
+    for x in range(nx):
+        dist = x-p[2]
+        cache_ex[x] = math.exp(-.5*invsx*invsx*dist*dist)
+    for y in range(ny):
+        dist = y-p[5]
+        cache_ey[y] = math.exp(-.5*invsy*invsy*dist*dist)
+    for i in prange(f.shape[0]):
+        distx = ix[i]-p[2]
+        disty = iy[i]-p[5]
+        e = cache_ex[ix[i]] * cache_ey[iy[i]]
+        gauss = amp_g * e
+        parab = 1. - distx*distx*invrx*invrx - disty*disty*invry*invry
+        parab_sqrt = math.sqrt(parab) if parab > 0. else 0.
+        f[i] = gauss + amp_t*parab_sqrt*parab_sqrt*parab_sqrt + p[8]
+        J[0, i] = parab_sqrt*parab_sqrt*parab_sqrt
+        J[1, i] = e
+        J[2, i] = amp_t*3.*distx*invrx*invrx*parab_sqrt + distx*invsx*invsx*gauss
+        J[3, i] = amp_t*3.*distx*distx*invrx*invrx*invrx * parab_sqrt
+        J[4, i] = distx*distx*invsx*invsx*invsx * gauss
+        J[5, i] = amp_t*3.*disty*invry*invry*parab_sqrt + disty*invsy*invsy*gauss
+        J[6, i] = amp_t*3.*disty*disty*invry*invry*invry * parab_sqrt
+        J[7, i] = disty*disty*invsy*invsy*invsy * gauss
+        J[8, i] = 1.0
+
+##########################################################################
+# backend selection
+
+KERNEL_NAMES = ["gauss1d_f", "gauss1d_fJ", "gauss1dasym_f", "gauss1dasym_fJ",
+                "gauss2d_f", "gauss2d_fJ", "gauss2drot_f", "gauss2drot_fJ",
+                "thomasfermi2d_f", "thomasfermi2d_fJ", "bimodal2d_f", "bimodal2d_fJ",
+                "gauss2d_f_masked", "gauss2d_fJ_masked", "gauss2drot_f_masked", "gauss2drot_fJ_masked",
+                "thomasfermi2d_f_masked", "thomasfermi2d_fJ_masked", "bimodal2d_f_masked", "bimodal2d_fJ_masked"]
+
+def _jit(func):
+    # parallel loops only for kernels processing images
+    parallel = func.__name__.split("_")[0] not in ("gauss1d", "gauss1dasym")
+    return numba.njit(parallel = parallel, fastmath = True, cache = True)(func)
+
+_backends = {"numpy": dict((name, globals()[name + "_numpy"]) for name in KERNEL_NAMES)}
+if numba is not None:
+    _backends["numba"] = dict((name, _jit(globals()[name + "_loop"])) for name in KERNEL_NAMES)
+
+BACKENDS = sorted(_backends)
+BACKEND = None
+
+def setBackend(name):
+    """
+    Select the backend used by all fit models.
+
+    :param name: (str) Name of the backend, one of :data:`BACKENDS`.
+    """
+    global BACKEND
+    if name not in _backends:
+        raise ValueError("Backend %s not available. Choose from %s." % (name, BACKENDS))
+    globals().update(_backends[name])
+    BACKEND = name
+
+def getBackend():
+    """
+    Return the name of the backend currently used.
+
+    :returns: (str) Name of the backend.
+    """
+    return BACKEND
+
+setBackend(os.environ.get("QAO_FIT_BACKEND", "numba" if "numba" in _backends else "numpy"))
+
+##########################################################################
+
+def benchmark(shape = (512, 512), repeat = 10):
+    """
+    Measure the execution time of the image kernels for each backend.
+
+    The first call of each kernel is excluded from timing, so compilation
+    times of the numba backend do not enter the results.
+
+    :param shape: (tuple) Image dimensions (height, width).
+    :param repeat: (int) Number of calls to average.
+    :returns: (dict) Mean time in ms for each (kernel, backend).
+    """
+    ny, nx = shape
+    n = nx * ny
+    pars = {"gauss2d":       np.asfarray([1., nx/2., nx/8., ny/2., ny/8., .1]),
+            "gauss2drot":    np.asfarray([1., nx/2., nx/8., ny/2., ny/6., .3, .1]),
+            "thomasfermi2d": np.asfarray([1., nx/2., nx/4., ny/2., ny/4., .1]),
+            "bimodal2d":     np.asfarray([1., .5, nx/2., nx/4., nx/6., ny/2., ny/4., ny/6., .1])}
+    f = np.empty(n)
+    cache_x, cache_y = np.empty(nx), np.empty(ny)
+
+    results = {}
+    backend_current = BACKEND
+    try:
+        for backend in BACKENDS:
+            setBackend(backend)
+            for model, p in sorted(pars.items()):
+                J = np.empty([p.size, n])
+                extra = (nx, ny) if model == "gauss2drot" else (cache_x, cache_y)
+                for name, args in [(model + "_f", (p, f) + extra), (model + "_fJ", (p, f, J) + extra)]:
+                    kernel = globals()[name]
+                    kernel(*args)
+                    t_start = time.time()
+                    for _ in range(repeat):
+                        kernel(*args)
+                    results[(name, backend)] = (time.time() - t_start) / repeat * 1e3
+    finally:
+        setBackend(backend_current)
+    return results
+
+if __name__ == "__main__":
+    shape = (1024, 1024)
+    results = benchmark(shape)
+    print("kernel times for %dx%d images in ms" % shape)
+    print("%-18s" % "kernel" + "".join("%10s" % backend for backend in BACKENDS))
+    for name in KERNEL_NAMES:
+        if (name, BACKENDS[0]) in results:
+            print("%-18s" % name + "".join("%10.2f" % results[(name, backend)] for backend in BACKENDS))
@@ -2,8 +2,8 @@ from qao.fit.fitter import LevmarFitter, DEFAULT_TYPE_NPY
 import numpy as np
 
 class ExpDecayOffs(LevmarFitter):
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A", "tau", "off"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "tau", "off"], data, dtype)
     
     def guess(self):
         # determine maximum value
@@ -28,8 +28,8 @@ class ExpDecayOffs(LevmarFitter):
         self._J[2, :] = 1
 
 class ExpDecay(LevmarFitter):
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A", "tau"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "tau"], data, dtype)
     
     def guess(self):
         # determine maximum value
@@ -53,8 +53,8 @@ class ExpDecay(LevmarFitter):
         self._J[1, :] = x/(tau)**2  * (self._f[:])
 
 class DblExpDecay(LevmarFitter):
-    def __init__(self, data):
-        LevmarFitter.__init__(self, ["A1", "tau1", "A2", "tau2"], data)
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A1", "tau1", "A2", "tau2"], data, dtype)
     
     def guess(self):
         # determine maximum value
@@ -9,5 +9,6 @@ filesystem.
 .. automodule:: qao.io.imagefile
 .. automodule:: qao.io.qmi
 .. automodule:: qao.io.messageBus
+.. automodule:: qao.io.livefit
 
 """
\ No newline at end of file
@@ -4,16 +4,8 @@ from qao.io import CSVReader
 import os,h5py
 import numpy as np
 import copy
-import scipy.weave as weave
-
-__compiler_args = ["-O3", "-march=native", "-ffast-math", "-fno-openmp"]
-__linker_args   = ["-fno-openmp"]
-opt_args = {"extra_compile_args": __compiler_args,
-            "extra_link_args": __linker_args}
 
 DEFAULT_TYPE_NPY = np.double
-DEFAULT_TYPE_C = "double"
-DEFAULT_TYPEDEFC = "typedef {0} float_type;\n".format(DEFAULT_TYPE_C)
 
 class DataTooLongException(BaseException):
     pass
@@ -42,26 +34,15 @@ def createIonImageSlow(scanDescriptor,ionSignal,bins):
 
 
 def createIonImageC(scanDescriptor,ionSignal,bins):
-    f_code = DEFAULT_TYPEDEFC + """
-        const int n_counts = Ndata[0];
-        const int n_path = NpathX[0];
-        const int bins_x = Nhist[0];
-        const int bins_y = Nhist[1];
-        int pathIndex = 0;
-        int histIndex = 0;
-        for (int i = 0; i < n_counts; i++) {
-            pathIndex = (int)floor(data[i]*n_path/dur);
-            histIndex = (int)floor(pathY[pathIndex]*bins_y)*bins_x+(int)floor(pathX[pathIndex]*bins_x);
-            //printf("histIndex: %i\\n",histIndex);
-            hist[histIndex]++;
-        }
-        """
-        
     data = ionSignal.rawData
     pathX, pathY = scanDescriptor.getXYData()
     dur = scanDescriptor.duration*10e7
-    hist = np.zeros(bins)
-    weave.inline(f_code, ["data", "pathX", "pathY", "dur", "hist"], **opt_args)
+    bins_x, bins_y = bins[0], bins[1]
+    
+    # histogram of the scan path positions at the ion arrival times
+    pathIndex = np.floor(data*len(pathX)/dur).astype(int)
+    histIndex = np.floor(pathY[pathIndex]*bins_y).astype(int)*bins_x + np.floor(pathX[pathIndex]*bins_x).astype(int)
+    hist = np.bincount(histIndex, minlength=bins_x*bins_y).astype(DEFAULT_TYPE_NPY).reshape(bins)
     
     return hist, np.linspace(0,scanDescriptor.scanRegion.width(),bins[0],endpoint=False), np.linspace(0,scanDescriptor.scanRegion.height(),bins[1],endpoint=False)
 
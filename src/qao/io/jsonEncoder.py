@@ -7,8 +7,14 @@ This Module defines json method used to dump and load object types of the qao re
 """
 import base64
 import json
+import struct
 import numpy as np
 
+# binary messages start with a byte that never starts a json text
+BINARY_MAGIC = b"\x00QAO"
+BINARY_ALIGN = 16
+_binaryPrefix = struct.Struct(">4sI")
+
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
         """
@@ -35,7 +41,100 @@ def json_numpy_obj_hook(dct):
         return np.frombuffer(data, dct['dtype']).reshape(dct['shape'])
     return dct
 
+def _aligned(nbytes):
+    return (nbytes + BINARY_ALIGN - 1) // BINARY_ALIGN * BINARY_ALIGN
+
+
+class SegmentEncoder(NumpyEncoder):
+    """
+    Json encoder keeping the buffers of ndarrays as raw segments for a binary message.
+    """
+    def __init__(self, *args, **kwargs):
+        NumpyEncoder.__init__(self, *args, **kwargs)
+        self.segments = []
+        self.nbytes = 0
+
+    def default(self, obj):
+        """
+        if input object is a plain ndarray it will be converted into a dict holding dtype, shape and the
+        offset of its buffer within the segments
+        """
+        if isinstance(obj, np.ndarray) and obj.dtype.fields is None and not obj.dtype.hasobject:
+            obj = np.require(obj, requirements="C")
+            segment = dict(__segment__=self.nbytes,
+                           dtype=obj.dtype.str,
+                           shape=obj.shape)
+            self.segments.append(obj)
+            self.nbytes += _aligned(obj.nbytes)
+            return segment
+        return NumpyEncoder.default(self, obj)
+
+
+def isBinary(s):
+    """
+    Check if a message was serialized by :func:`dumpsBinary`.
+    :param s: (bytes) Serialized message.
+    :return: (bool) True for binary messages, False for json text
+    """
+    return isinstance(s, bytes) and s[:len(BINARY_MAGIC)] == BINARY_MAGIC
+
+def header(s):
+    """
+    Return the json text of a message, which is the header for binary messages.
+    :param s: (bytes) Serialized message.
+    :return: (str) json text without the ndarray buffers
+    """
+    if not isBinary(s):
+        return s
+    magic, nbytes = _binaryPrefix.unpack_from(s)
+    text = s[_binaryPrefix.size:_binaryPrefix.size + nbytes]
+    return text if isinstance(text, str) else text.decode("utf-8")
+
+def dumpsBinary(obj, separators=(',', ':'), sort_keys=True):
+    """
+    Serialize an object as binary message, with the buffers of all ndarrays appended
+    as raw segments instead of being base64 encoded.
+
+    The message starts with :data:`BINARY_MAGIC` and the size of the json header, followed
+    by the header and the segments, each aligned to :data:`BINARY_ALIGN` bytes. If the
+    object holds no ndarray, the plain json text is returned.
+    :param obj: (object) Object to be serialized
+    :return: (bytes) binary message or json text
+    """
+    encoder = SegmentEncoder(separators=separators, sort_keys=sort_keys)
+    text = encoder.encode(obj)
+    if not encoder.segments:
+        return text
+    text = text.encode("utf-8")
+    start = _binaryPrefix.size + len(text)
+    parts = [_binaryPrefix.pack(BINARY_MAGIC, len(text)), text, b"\x00" * (_aligned(start) - start)]
+    for segment in encoder.segments:
+        parts.append(segment.tobytes())
+        parts.append(b"\x00" * (_aligned(segment.nbytes) - segment.nbytes))
+    return b"".join(parts)
+
+def loadsBinary(s):
+    """
+    Decode a binary message. The ndarrays are created from the message buffer without
+    copying and are read-only.
+    :param s: (bytes) binary message
+    :return: (object) decoded object
+    """
+    magic, nbytes = _binaryPrefix.unpack_from(s)
+    start = _aligned(_binaryPrefix.size + nbytes)
+
+    def hook(dct):
+        if '__segment__' in dct:
+            shape = tuple(dct['shape'])
+            count = int(np.prod(shape))
+            return np.frombuffer(s, np.dtype(str(dct['dtype'])), count, start + dct['__segment__']).reshape(shape)
+        return json_numpy_obj_hook(dct)
+
+    return json.loads(header(s), object_hook=hook)
+
 def loads(s):
+    if isBinary(s):
+        return loadsBinary(s)
     return json.loads(s, object_hook=json_numpy_obj_hook)
 
 def dumps(obj, separators=(',', ':'), sort_keys=True):
@@ -0,0 +1,303 @@
+"""
+Live fitting
+------------
+
+Fit images as they are published on the messageBus.
+
+The :class:`LiveFitServer` subscribes to an image topic, fits each frame with a
+fitter from :mod:`qao.fit` and publishes the fit parameters and errors on a result
+topic. Frames are fitted by a pool of worker processes. Frames arriving while all
+workers are busy are kept in a short queue, and if the queue is full, the oldest
+frame is dropped. When the fits fall behind the camera, the latest frame always
+wins and the results keep up with the experiment.
+
+The frames may be published as plain arrays or as dictionaries holding the array
+as "image" together with any other information, like a shot number "id" which is
+passed on to the result. The result is published as dictionary::
+
+    {"id": 123,                                 # id of the frame if given
+     "model": "Gauss2D",
+     "pars": {"A": 1.2, "x_0": 301.5, ...},
+     "errs": {"A": 0.01, "x_0": 0.03, ...},
+     "success": True,
+     "iter": 8,
+     "fit_time": 0.004,                         # time spent fitting in seconds
+     "latency": 0.006,                          # time from receiving to publishing
+     "dropped": 0}                              # frames dropped so far
+
+.. note::
+
+    Running this module as main routine starts a live fit server, see the
+    command line help for the options.
+
+A live fit server can be run from a script as well::
+
+    app = QtCore.QCoreApplication([])
+    server = LiveFitServer("camera.image", "camera.fit", model = "Gauss2D")
+    server.connectToMessageBus("localhost")
+    app.exec_()
+"""
+import sys
+import time
+import collections
+import multiprocessing
+import numpy as np
+
+from qao.io.messageBus import MessageBusClient, DEFAULT_PORT, qtSignal
+from qao.gui.qt import QtCore
+from qao.fit.fitter import LevmarFitter
+
+LIVEFIT_QUEUE_SIZE = 2      # frames waiting for a free worker
+LIVEFIT_PROCESSES = 2       # worker processes
+LIVEFIT_TIMEOUT = 10.       # seconds before a frame lost by a worker is given up
+
+# state of a worker process, set by _workerInit
+_worker = {}
+
+def _workerInit(model, worker = None):
+    """
+    Initialize the state of a worker process, or the given state of a server
+    fitting within its own process.
+    """
+    worker = _worker if worker is None else worker
+    worker["model"] = model
+    worker["fitters"] = {}
+    return worker
+
+def _fitFrame(image, worker = None):
+    """
+    Fit a single frame within a worker, reusing one fitter per image shape.
+    """
+    t_start = time.time()
+    worker = _worker if worker is None else worker
+    try:
+        image = np.asarray(image)
+        fitter = worker["fitters"].get(image.shape)
+        if fitter is None:
+            fitter = worker["fitters"][image.shape] = worker["model"](image)
+        else:
+            fitter.setData(image)
+        pars, fit_log = fitter.fit(return_dict = True)
+        errs = fitter.getFitErr()
+        names = fitter.getFitParNames()
+        result = {"pars": dict(zip(names, pars.tolist())),
+                  "errs": dict(zip(names, errs.tolist())),
+                  "success": bool(fit_log["success"]),
+                  "iter": int(fit_log["iter"])}
+    except Exception as e:
+        result = {"success": False, "error": "%s, %s" % (type(e).__name__, e)}
+    result["fit_time"] = time.time() - t_start
+    return result
+
+def fitterClass(model):
+    """
+    Return the fitter class for a model given by name, like "Gauss2D", or by class.
+
+    :param model: (str) Name of a fitter from :mod:`qao.fit` or a fitter class.
+    :returns: (class) Fitter class.
+    """
+    cls = model
+    if isinstance(model, basestring):
+        import qao.fit
+        cls = getattr(qao.fit, model, None)
+    if not (isinstance(cls, type) and issubclass(cls, LevmarFitter)):
+        raise ValueError("Unknown fit model %s." % model)
+    return cls
+
+
+class LiveFitServer(QtCore.QObject):
+    """
+    Fit frames published on `imageTopic` and publish the results on `resultTopic`.
+
+    The frames are fitted by `processes` worker processes, or within the Qt event
+    loop if `processes` is 0. At most `queueSize` frames wait for a free worker,
+    older frames are dropped.
+
+    The latency of each frame is measured from receiving the frame until publishing
+    its result. Statistics over all frames are available from :func:`getStats`.
+
+    A frame whose worker fails or does not return within `timeout` seconds, e.g. as
+    the worker process died, is published as failed fit to release its worker slot.
+
+    :param imageTopic: (str) Topic of the published frames.
+    :param resultTopic: (str) Topic for publishing the fit results.
+    :param model: (str) Name of a fitter from :mod:`qao.fit` or a fitter class.
+    :param processes: (int) Number of worker processes.
+    :param queueSize: (int) Maximum number of frames waiting for a worker.
+    :param timeout: (float) Time in seconds to wait for the result of a worker.
+    """
+
+    frameFitted = qtSignal(object)
+    _fitDone = qtSignal(object, object)
+
+    def __init__(self, imageTopic, resultTopic, model = "Gauss2D",
+                 processes = LIVEFIT_PROCESSES, queueSize = LIVEFIT_QUEUE_SIZE, timeout = LIVEFIT_TIMEOUT):
+        QtCore.QObject.__init__(self)
+        if queueSize < 1:
+            raise ValueError("Queue size must be positive.")
+        self.imageTopic = str(imageTopic)
+        self.resultTopic = str(resultTopic)
+        self.model = fitterClass(model)
+        self.processes = int(processes)
+
+        self.queue = collections.deque()
+        self.queueSize = int(queueSize)
+        self.timeout = float(timeout)
+        self.inFlight = 0
+        # frames dispatched to the pool with their async results, by id of the frame info
+        self.pending = collections.OrderedDict()
+        self.resetStats()
+
+        # fitting within the Qt event loop keeps the fitters with the server
+        if self.processes > 0:
+            self.pool = multiprocessing.Pool(self.processes, _workerInit, (self.model, ))
+            self.worker = None
+        else:
+            self.pool = None
+            self.worker = _workerInit(self.model, {})
+        self._fitDone.connect(self._handleFitDone)
+        self.mbus = MessageBusClient(binary=True)
+
+    def connectToMessageBus(self, host, port = DEFAULT_PORT):
+        """
+        Connect to a messageBus server and start fitting the published frames.
+
+        :param host: (str) Hostname of the server.
+        :param port: (int) TCP port of the service.
+        """
+        self.mbus.connectToServer(host, port)
+        if not self.mbus.isConnected():
+            raise Exception("Error: Could not connect to messageBus")
+        self.mbus.subscribe(self.imageTopic, self.handleFrame)
+        self.mbus.waitForEventPublished()
+
+    def disconnectFromServer(self):
+        """
+        Disconnect from the messageBus and stop the worker processes.
+        """
+        self.mbus.disconnectFromServer()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def resetStats(self):
+        """
+        Reset the frame statistics.
+        """
+        self.stats = {"received": 0, "fitted": 0, "dropped": 0, "failed": 0,
+                      "latency_sum": 0., "latency_max": 0.}
+
+    def getStats(self):
+        """
+        Return the number of received, fitted, dropped and failed frames together
+        with the mean and maximum latency in seconds.
+
+        :returns: (dict) Frame statistics.
+        """
+        stats = dict(self.stats)
+        latency_sum = stats.pop("latency_sum")
+        stats["latency_mean"] = latency_sum / stats["fitted"] if stats["fitted"] else 0.
+        return stats
+
+    def handleFrame(self, data):
+        """
+        Queue a frame received from the messageBus, dropping the oldest frame
+        if the queue is full.
+
+        :param data: (object) Image array or dictionary holding the image as "image".
+        """
+        info = {"received": time.time()}
+        if isinstance(data, dict):
+            info["id"] = data.get("id")
+            data = data.get("image")
+        if data is None:
+            return
+        self.stats["received"] += 1
+        if len(self.queue) >= self.queueSize:
+            self.queue.popleft()
+            self.stats["dropped"] += 1
+        self.queue.append((info, data))
+        # frames received within the same network read are queued before dispatching
+        QtCore.QTimer.singleShot(0, self._dispatch)
+
+    def _dispatch(self):
+        self._releaseStale()
+        while self.queue and self.inFlight < max(self.processes, 1):
+            info, image = self.queue.popleft()
+            self.inFlight += 1
+            if self.pool is None:
+                self._publishResult(info, _fitFrame(image, self.worker))
+            else:
+                # the callback runs in a thread of the pool, results are passed by a queued signal
+                info["dispatched"] = time.time()
+                asyncResult = self.pool.apply_async(_fitFrame, (image, ),
+                                                    callback = lambda result, info = info: self._fitDone.emit(info, result))
+                self.pending[id(info)] = (info, asyncResult)
+
+    def _releaseStale(self):
+        # the callback is not called if the task failed, and never if its worker died
+        now = time.time()
+        for key, (info, asyncResult) in list(self.pending.items()):
+            if asyncResult.ready() and not asyncResult.successful():
+                error = "worker failed"
+            elif not asyncResult.ready() and now - info["dispatched"] > self.timeout:
+                error = "worker timed out"
+            else:
+                continue
+            del self.pending[key]
+            self._publishResult(info, {"success": False, "error": error, "fit_time": now - info["dispatched"]})
+
+    def _handleFitDone(self, info, result):
+        if self.pending.pop(id(info), None) is None:
+            # the frame was given up already
+            return
+        self._publishResult(info, result)
+        self._dispatch()
+
+    def _publishResult(self, info, result):
+        self.inFlight -= 1
+        latency = time.time() - info["received"]
+        result.update({"model": self.model.__name__,
+                       "latency": latency,
+                       "dropped": self.stats["dropped"]})
+        if info.get("id") is not None:
+            result["id"] = info["id"]
+
+        self.stats["fitted"] += 1
+        self.stats["failed"] += 0 if result["success"] else 1
+        self.stats["latency_sum"] += latency
+        self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+
+        self.mbus.publishEvent(self.resultTopic, result)
+        self.frameFitted.emit(result)
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+    # enable CTRL+C break
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    parser = argparse.ArgumentParser(description = "Fit images published on the messageBus.")
+    parser.add_argument("imageTopic", help = "topic of the published images")
+    parser.add_argument("resultTopic", help = "topic for publishing the fit results")
+    parser.add_argument("--model", default = "Gauss2D", help = "fitter from qao.fit (default Gauss2D)")
+    parser.add_argument("--host", default = "localhost", help = "messageBus server")
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT, help = "messageBus port")
+    parser.add_argument("--processes", type = int, default = LIVEFIT_PROCESSES, help = "worker processes")
+    parser.add_argument("--queue", type = int, default = LIVEFIT_QUEUE_SIZE, help = "frames waiting for a worker")
+    args = parser.parse_args()
+
+    app = QtCore.QCoreApplication([])
+    server = LiveFitServer(args.imageTopic, args.resultTopic, args.model, args.processes, args.queue)
+
+    def printFrameFitted(result):
+        stats = server.getStats()
+        print("frame %s fitted in %.1f ms, latency %.1f ms, mean %.1f ms, dropped %d" % (
+            result.get("id", "-"), 1e3 * result["fit_time"], 1e3 * result["latency"],
+            1e3 * stats["latency_mean"], stats["dropped"]))
+    server.frameFitted.connect(printFrameFitted)
+
+    print("Starting live fit of %s on %s" % (args.imageTopic, args.host))
+    server.connectToMessageBus(args.host, args.port)
+    sys.exit(app.exec_())
@@ -57,17 +57,12 @@ if __name__ == "__main__":
     else:
         from PyQt5 import QtCore
 
-    # enable memory debugger if possible
-    try:
-        import guppy.heapy.RM
-        from guppy import hpy; hp=hpy()
-        print("enabled heapy memory debug")
-    except ImportError:
-        pass
-
 import os
+import re
 import sys
+import json
 import time
+import collections
 from qao.io import websocket
 from qao.io import jsonEncoder
 
@@ -93,6 +88,25 @@ TYPE_NAK            = "nak"
 
 INFO_RPC_LIST       = "RPClist"
 
+# websocket subprotocol for sending ndarrays as raw segments of binary frames
+PROTOCOL_BINARY     = "qao.binary"
+
+# policies for events exceeding the send queue of a slow client
+QUEUE_DROP_OLDEST   = "drop-oldest"
+QUEUE_DROP_NEWEST   = "drop-newest"
+QUEUE_CONFLATE      = "conflate"
+QUEUE_DISCONNECT    = "disconnect"
+QUEUE_POLICIES      = (QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_CONFLATE, QUEUE_DISCONNECT)
+
+DEFAULT_QUEUE_BYTES    = 64 << 20
+DEFAULT_QUEUE_MESSAGES = 1000
+# data passed to the socket before queueing events
+SEND_BUFFER_SIZE       = 1 << 20
+
+TOPIC_SEPARATOR     = "."
+WILDCARD_ONE        = "*"
+WILDCARD_ANY        = "#"
+
 def simplePublish(topic, data, hostname, port = DEFAULT_PORT):
     """
     Publish new data on a messageBus server.
@@ -111,6 +125,185 @@ def simplePublish(topic, data, hostname, port = DEFAULT_PORT):
     c.publishEvent(topic, data)
     c.waitForEventPublished()
 
+def encodeFrame(packet, masking=False):
+    """
+    Build the websocket frame for sending a serialized messageBus packet.
+
+    The frame may be sent to any number of connections, so data published to many
+    subscribers is only serialized once. Binary messages are sent as binary frames,
+    json text as text frames.
+
+    :param packet: (str) Serialized packet.
+    :param masking: (bool) Mask the payload, required for frames sent by clients.
+    :returns: (bytes) Raw websocket frame.
+    """
+    opCode = websocket.OPCODE_BINARY if jsonEncoder.isBinary(packet) else websocket.OPCODE_ASCII
+    mask = os.urandom(4) if masking else None
+    return websocket.Frame(opCode, packet, mask=mask, fin=1).build()
+
+def encodePacket(data, binary=False, masking=False):
+    """
+    Serialize a messageBus packet and build the websocket frame for sending.
+
+    If `binary` is set, ndarrays are sent as raw segments of a binary message, see
+    :func:`qao.io.jsonEncoder.dumpsBinary`. This requires the receiver to support
+    the :data:`PROTOCOL_BINARY` websocket subprotocol.
+
+    :param data: (list) Packet type, topic and optional data.
+    :param binary: (bool) Use the binary transport for ndarrays.
+    :param masking: (bool) Mask the payload, required for frames sent by clients.
+    :returns: (bytes) Raw websocket frame.
+    """
+    if binary:
+        dataSer = jsonEncoder.dumpsBinary(data, separators=(',', ':'), sort_keys=True)
+    else:
+        dataSer = jsonEncoder.dumps(data, separators=(',', ':'), sort_keys=True)
+    return encodeFrame(dataSer, masking)
+
+_jsonDecoder = json.JSONDecoder()
+_jsonWhitespace = re.compile(r'[ \t\n\r]*')
+
+def parseEnvelope(packet):
+    """
+    Read the type and topic of a serialized messageBus packet without decoding its data.
+
+    Only the leading type and topic strings are parsed, so the cost does not depend on
+    the size of the data. The data itself is not validated and may be passed on as is.
+
+    :param packet: (str) Serialized packet.
+    :returns: (str, str, int) Packet type, topic and offset of the data within `packet`,
+        the offset being None if the packet holds no data.
+    """
+    skip = lambda pos: _jsonWhitespace.match(packet, pos).end()
+    pos = skip(0)
+    if packet[pos:pos+1] != '[':
+        raise ValueError("packet is not a list")
+    pos = skip(pos + 1)
+    fields = []
+    while len(fields) < 2:
+        value, pos = _jsonDecoder.raw_decode(packet, pos)
+        fields.append(value)
+        pos = skip(pos)
+        if packet[pos:pos+1] == ']':
+            if len(fields) < 2:
+                break
+            return fields[0], fields[1], None
+        if packet[pos:pos+1] != ',':
+            raise ValueError("invalid packet separator at %d" % pos)
+        pos = skip(pos + 1)
+    if len(fields) < 2:
+        raise ValueError("packet with insufficient number of args")
+    return fields[0], fields[1], pos
+
+def parseTopicPattern(pattern):
+    """
+    Split a subscription pattern into its topic levels.
+
+    Topics are divided into levels by '.', a pattern level '*' matches exactly one
+    level of a topic and a final level '#' matches any number of remaining levels.
+    For example "camera.*" matches "camera.image", "daLog.#" matches "daLog" and
+    "daLog.lab.temperature".
+
+    :param pattern: (str) Topic or subscription pattern.
+    :returns: (list) Levels of a wildcard pattern or None for a plain topic.
+    """
+    levels = pattern.split(TOPIC_SEPARATOR)
+    if WILDCARD_ONE not in levels and WILDCARD_ANY not in levels:
+        return None
+    if WILDCARD_ANY in levels[:-1]:
+        raise ValueError("wildcard %s must be the last level of %s" % (WILDCARD_ANY, pattern))
+    return levels
+
+
+class _TopicNode(object):
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = set()
+
+
+class TopicIndex(object):
+    """
+    Index of subscribers by topic or wildcard pattern, see :func:`parseTopicPattern`.
+
+    Plain topics are looked up directly, wildcard patterns are kept in a trie of their
+    levels. Thus matching a topic neither depends on the number of subscribers nor on
+    the number of plain topics subscribed.
+    """
+
+    def __init__(self):
+        self.topics = {}
+        self.root = _TopicNode()
+
+    def add(self, pattern, subscriber):
+        """
+        Add a subscriber for a topic or pattern.
+
+        :param pattern: (str) Topic or subscription pattern.
+        :param subscriber: (object) Hashable subscriber.
+        """
+        levels = parseTopicPattern(pattern)
+        if levels is None:
+            self.topics.setdefault(pattern, set()).add(subscriber)
+            return
+        node = self.root
+        for level in levels:
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicNode()
+            node = child
+        node.subscribers.add(subscriber)
+
+    def remove(self, pattern, subscriber):
+        """
+        Remove a subscriber from a topic or pattern, raises KeyError if not subscribed.
+
+        :param pattern: (str) Topic or subscription pattern.
+        :param subscriber: (object) Subscriber to be removed.
+        """
+        levels = parseTopicPattern(pattern)
+        if levels is None:
+            subscribers = self.topics[pattern]
+            subscribers.remove(subscriber)
+            if not subscribers:
+                del self.topics[pattern]
+            return
+        path = [self.root]
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].subscribers.remove(subscriber)
+        # prune branches without subscribers
+        for i in reversed(range(len(levels))):
+            node = path[i+1]
+            if node.subscribers or node.children:
+                break
+            del path[i].children[levels[i]]
+
+    def match(self, topic):
+        """
+        Return all subscribers matching a published topic.
+
+        :param topic: (str) Published topic.
+        :returns: (set) Matching subscribers.
+        """
+        subscribers = set(self.topics.get(topic, ()))
+        if self.root.children:
+            self.__match(self.root, topic.split(TOPIC_SEPARATOR), 0, subscribers)
+        return subscribers
+
+    def __match(self, node, levels, i, subscribers):
+        anyLevels = node.children.get(WILDCARD_ANY)
+        if anyLevels is not None:
+            subscribers.update(anyLevels.subscribers)
+        if i == len(levels):
+            subscribers.update(node.subscribers)
+            return
+        for level in (levels[i], WILDCARD_ONE):
+            child = node.children.get(level)
+            if child is not None:
+                self.__match(child, levels, i+1, subscribers)
+
 
 class MessageBusCommunicator(QtCore.QObject):
     def __init__(self, masking=False):
@@ -123,6 +316,7 @@ class MessageBusCommunicator(QtCore.QObject):
         self.neededBytes = next(self.currentFrame.parser)
         self.httpHeader = websocket.HTTPHeader()
         self.handshakeDone = False
+        self.binaryTransport = False
         self.incompleteData = b''
 
     def _send(self, rawData, blocking=False):
@@ -140,12 +334,12 @@ class MessageBusCommunicator(QtCore.QObject):
         frm = websocket.Frame(opCode, data, mask=mask, fin=1)
         nWritten = self._send(frm.build())
 
-    def _sendPacket(self, data, binary=False):
+    def _sendPacket(self, data, binary=None):
         if len(data) <= 0:
             return
-        opCode = websocket.OPCODE_BINARY if binary else websocket.OPCODE_ASCII
-        dataSer = jsonEncoder.dumps(data, separators=(',', ':'), sort_keys=True)
-        self._sendFrame_(dataSer, opCode)
+        if binary is None:
+            binary = self.binaryTransport
+        self._send(encodePacket(data, binary, self.masking))
 
     def _handleReadyRead(self):
         while self.connection.bytesAvailable() > 0:
@@ -194,7 +388,7 @@ class MessageBusCommunicator(QtCore.QObject):
         if frm.opCode == websocket.OPCODE_ASCII or frm.opCode == websocket.OPCODE_BINARY:
             self.incompleteData += frm.data
             if frm.fin == 1:
-                if six.PY3 and isinstance(self.incompleteData, bytes):
+                if six.PY3 and not jsonEncoder.isBinary(self.incompleteData):
                     self.incompleteData = self.incompleteData.decode()
                 self._handleNewPacket(self.incompleteData)
                 self.incompleteData = b''
@@ -227,6 +421,13 @@ class MessageBusClient(MessageBusCommunicator):
     register callbacks for topics you want to receive notifications and data
     for using the :func:`subscribe` method. Sending data to the bus is
     possible using the :func:`publishEvent` method.
+
+    If `binary` is set, the client offers the :data:`PROTOCOL_BINARY` subprotocol
+    to the server. Once accepted, ndarrays are sent and received as raw segments of
+    binary frames instead of base64 encoded json. Received arrays are read-only views
+    of the frame then, callbacks modifying them in place have to copy them first.
+
+    :param binary: (bool) Use the binary transport for ndarrays if supported.
     """
 
     receivedEvent = qtSignal(str, object)
@@ -234,13 +435,16 @@ class MessageBusClient(MessageBusCommunicator):
     connected = qtSignal()
     disconnected = qtSignal()
 
-    def __init__(self):
+    def __init__(self, binary=False):
         MessageBusCommunicator.__init__(self)
+        self.binary = binary
         self.connection = QtNetwork.QTcpSocket()
         self.connection.disconnected.connect(self.disconnected)
         self.connection.readyRead.connect(self._handleReadyRead)
 
         self.subscriptionCallbacks = {}
+        self.subscriptionPatterns = TopicIndex()
+        self.subscriptionsWithTopic = set()
         self.rpcCallbacks = {}
         self.rpcPendingRequests = {}
 
@@ -264,6 +468,8 @@ class MessageBusClient(MessageBusCommunicator):
         """
         self._cleanupCommunicator_()
         self.subscriptionCallbacks = {}
+        self.subscriptionPatterns = TopicIndex()
+        self.subscriptionsWithTopic = set()
         self.connection.disconnectFromHost()
 
     def isConnected(self):
@@ -273,7 +479,7 @@ class MessageBusClient(MessageBusCommunicator):
         """
         return self.connection.state() == self.connection.ConnectedState
 
-    def subscribe(self, topic, callback=None):
+    def subscribe(self, topic, callback=None, withTopic=False):
         """
         Subscribe to a topic on the currently connected bus.
 
@@ -282,13 +488,26 @@ class MessageBusClient(MessageBusCommunicator):
         matches. If you already subscribed for this topic, the previously
         registered callback function will be replaced by the new one.
 
-        :param topic: (str) Topic to receive events for.
+        The topic may be a wildcard pattern like "camera.*" or "daLog.#", see
+        :func:`parseTopicPattern`. The callback is called with the data only, set
+        `withTopic` to call it with the published topic and the data. The topic of
+        each event is also emitted by the :attr:`receivedEvent` signal.
+
+        :param topic: (str) Topic or pattern to receive events for.
         :param callback: (callable) Callback function for new events.
+        :param withTopic: (bool) Pass the published topic to the callback.
         """
         topic = str(topic)
+        wildcard = parseTopicPattern(topic) is not None
         self._sendPacket([TYPE_SUBSCRIBE, topic])
         if callback:
             self.subscriptionCallbacks[topic] = callback
+            if wildcard:
+                self.subscriptionPatterns.add(topic, topic)
+            if withTopic:
+                self.subscriptionsWithTopic.add(topic)
+            else:
+                self.subscriptionsWithTopic.discard(topic)
 
     def unsubscribe(self, topic):
         """
@@ -302,6 +521,9 @@ class MessageBusClient(MessageBusCommunicator):
         self._sendPacket([TYPE_UNSUBSCRIBE, topic])
         if topic in self.subscriptionCallbacks:
             self.subscriptionCallbacks.pop(topic)
+            self.subscriptionsWithTopic.discard(topic)
+            if parseTopicPattern(topic) is not None:
+                self.subscriptionPatterns.remove(topic, topic)
 
     def publishEvent(self, topic, data):
         """
@@ -373,12 +595,23 @@ class MessageBusClient(MessageBusCommunicator):
 
     def _sendHeader(self):
         hdr = websocket.DefaultHTTPClientHeader()
+        if self.binary:
+            hdr.attr['Sec-WebSocket-Protocol'] = "%s, %s" % (PROTOCOL_BINARY, hdr.attr['Sec-WebSocket-Protocol'])
         nWritten = self._send(hdr.createHeader(), blocking=True)
 
     def handleEvent(self, topic, data):
         self.receivedEvent.emit(topic, data)
         if topic in self.subscriptionCallbacks:
-            self.subscriptionCallbacks[topic](data)
+            self._callSubscription(topic, topic, data)
+        for pattern in self.subscriptionPatterns.match(topic):
+            self._callSubscription(pattern, topic, data)
+
+    def _callSubscription(self, subscription, topic, data):
+        callback = self.subscriptionCallbacks[subscription]
+        if subscription in self.subscriptionsWithTopic:
+            callback(topic, data)
+        else:
+            callback(data)
 
     def _handleRPCRequest(self, funcName, data):
         if funcName in self.rpcCallbacks:
@@ -393,6 +626,7 @@ class MessageBusClient(MessageBusCommunicator):
 
     def _handleHeaderReceived(self, httpHeader):
         #TODO: check header received from the server
+        self.binaryTransport = self.binary and PROTOCOL_BINARY in httpHeader.protocols()
         self.connected.emit()
         pass
 
@@ -436,30 +670,124 @@ class MessageBusClient(MessageBusCommunicator):
 
 
 class ServerClientConnection(MessageBusCommunicator):
+    """
+    Connection of the server to a single client.
+
+    Events are only passed to the socket while less than :data:`SEND_BUFFER_SIZE`
+    bytes are waiting to be written, further events are kept in a send queue which
+    is drained as the client reads. If the queue exceeds `maxBytes` or `maxMessages`,
+    the `policy` decides which events to drop:
+
+    * :data:`QUEUE_DROP_OLDEST` drops the oldest queued events.
+    * :data:`QUEUE_DROP_NEWEST` drops the new event.
+    * :data:`QUEUE_CONFLATE` replaces a queued event of the same topic by the new one
+      and drops the oldest events if still exceeding the limits.
+    * :data:`QUEUE_DISCONNECT` disconnects the client.
+
+    Dropped events are counted by :attr:`droppedMessages` and :attr:`droppedBytes`.
+    Control packets like RPC requests and replies are never queued.
+
+    :param connection: (QTcpSocket) Socket connected to the client.
+    :param policy: (str) Policy for exceeding the send queue.
+    :param maxBytes: (int) Maximum number of bytes queued.
+    :param maxMessages: (int) Maximum number of events queued.
+    """
 
     eventPublished  = qtSignal(str, object)
     infoRequested   = qtSignal(str, object)
     rpcRequested    = qtSignal(str, object, object)
     rpcReplied      = qtSignal(str, object)
+    subscribed      = qtSignal(str, object)
+    unsubscribed    = qtSignal(str, object)
     disconnected    = qtSignal()
 
-    def __init__(self, connection):
+    def __init__(self, connection, policy=QUEUE_DROP_OLDEST,
+                 maxBytes=DEFAULT_QUEUE_BYTES, maxMessages=DEFAULT_QUEUE_MESSAGES):
         MessageBusCommunicator.__init__(self)
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("unknown queue policy %s" % policy)
         self.connection = connection
         self.connection.disconnected.connect(self.disconnected)
         self.connection.readyRead.connect(self._handleReadyRead)
+        self.connection.bytesWritten.connect(self._drainQueue)
         self.packetSize = 0
         self.subscriptions = set([])
         self.rpcFunctions = {}
         self.rpcPendingRequests = {}
 
+        self.policy = policy
+        self.maxBytes = maxBytes
+        self.maxMessages = maxMessages
+        # queued events as [topic, frame], the latest event of each topic for conflating
+        self.queue = collections.deque()
+        self.queuedBytes = 0
+        self.queuedTopics = {}
+        self.droppedMessages = 0
+        self.droppedBytes = 0
+
     def forwardEvent(self, topic, data, pkgType=TYPE_PUBLISH):
-        try:
+        if pkgType == TYPE_PUBLISH:
+            self.forwardFrame(encodePacket([pkgType, topic, data], self.binaryTransport), topic)
+        else:
             self._sendPacket([pkgType, topic, data])
-        except MemoryError:
-            print("Out of memory")
-            print(hp.heap())
-            exit()
+
+    def forwardFrame(self, frame, topic=None):
+        """
+        Send a websocket frame built by :func:`encodePacket`, using the send queue
+        if the client is falling behind.
+
+        :param frame: (bytes) Raw websocket frame.
+        :param topic: (str) Topic of the event for conflating.
+        """
+        if not self.queue and self.connection.bytesToWrite() < SEND_BUFFER_SIZE:
+            self._send(frame)
+            return
+
+        entry = None
+        if self.policy == QUEUE_CONFLATE and topic is not None:
+            entry = self.queuedTopics.get(topic)
+        if entry is not None:
+            # replace the queued event of this topic
+            self._dropped(entry[1])
+            self.queuedBytes += len(frame) - len(entry[1])
+            entry[1] = frame
+        elif self.queue and self.policy == QUEUE_DROP_NEWEST and self._exceeds(len(frame), 1):
+            self._dropped(frame)
+            return
+        else:
+            entry = [topic, frame]
+            self.queue.append(entry)
+            self.queuedBytes += len(frame)
+            self.queuedTopics[topic] = entry
+
+        if self.policy == QUEUE_DISCONNECT and self._exceeds():
+            print("client exceeding the send queue, disconnecting")
+            while self.queue:
+                self._dropped(self._popQueue()[1])
+            self.connection.abort()
+            return
+        # the latest event is kept even if exceeding the limits on its own
+        while len(self.queue) > 1 and self._exceeds():
+            self._dropped(self._popQueue()[1])
+
+    def _exceeds(self, nBytes=0, nMessages=0):
+        return (self.queuedBytes + nBytes > self.maxBytes or
+                len(self.queue) + nMessages > self.maxMessages)
+
+    def _dropped(self, frame):
+        self.droppedMessages += 1
+        self.droppedBytes += len(frame)
+
+    def _popQueue(self):
+        entry = self.queue.popleft()
+        self.queuedBytes -= len(entry[1])
+        if self.queuedTopics.get(entry[0]) is entry:
+            del self.queuedTopics[entry[0]]
+        return entry
+
+    def _drainQueue(self, nBytes=0):
+        while self.queue and self.connection.bytesToWrite() < SEND_BUFFER_SIZE:
+            self._send(self._popQueue()[1])
 
     def sendRPCRequest(self, func, data, issuer):
         if not 'id' in data:
@@ -468,15 +796,38 @@ class ServerClientConnection(MessageBusCommunicator):
         self.forwardEvent(func, data, pkgType=TYPE_RPC_REQUEST)
 
     def _handleHeaderReceived(self, httpHeader):
-        self._send(httpHeader.buildServerReply().createHeader())
+        self.binaryTransport = PROTOCOL_BINARY in httpHeader.protocols()
+        protocol = PROTOCOL_BINARY if self.binaryTransport else None
+        self._send(httpHeader.buildServerReply(protocol).createHeader())
 
     def _handleNewPacket(self, dataRaw):
         try:
-            #TODO: decoding the whole data on server side should not be necessary.
-            data = jsonEncoder.loads(dataRaw)
+            # route by type and topic, the data of published events is passed on as is
+            pkgType, topic, offset = parseEnvelope(jsonEncoder.header(dataRaw))
 
-            if len(data) < 2:
-                raise Exception("packet with insufficient number of args")
+            # publish packet to the server
+            if pkgType == TYPE_PUBLISH:
+                if offset is None:
+                    raise Exception("packet with insufficient number of args")
+                self.eventPublished.emit(topic, dataRaw)
+                return
+
+            # add the second arg to the list of subscriptions
+            if pkgType == TYPE_SUBSCRIBE:
+                parseTopicPattern(topic)
+                if topic not in self.subscriptions:
+                    self.subscriptions.add(topic)
+                    self.subscribed.emit(topic, self)
+                return
+
+            # remove the second arg to the list of subscriptions
+            if pkgType == TYPE_UNSUBSCRIBE:
+                self.subscriptions.remove(topic)
+                self.unsubscribed.emit(topic, self)
+                return
+
+            # decode the remaining control packets completely
+            data = jsonEncoder.loads(dataRaw)
 
             # add the second arg to the list of rpcFunctions
             if data[0] == TYPE_RPC_REGISTER:
@@ -524,23 +875,6 @@ class ServerClientConnection(MessageBusCommunicator):
                 self.rpcReplied.emit(data[1], data[2])
                 return
 
-            # add the second arg to the list of subscriptions
-            if data[0] == TYPE_SUBSCRIBE:
-                self.subscriptions.add(data[1])
-                return
-
-            # remove the second arg to the list of subscriptions
-            if data[0] == TYPE_UNSUBSCRIBE:
-                self.subscriptions.remove(data[1])
-                return
-
-            # publish packet to the server
-            if data[0] == TYPE_PUBLISH:
-                if len(data) < 3:
-                    raise Exception("packet with insufficient number of args")
-                self.eventPublished.emit(data[1], data[2])
-                return
-
             # packet not recognized
             raise Exception("unrecognized instruction in packet")
 
@@ -552,38 +886,99 @@ class ServerClientConnection(MessageBusCommunicator):
             print("error reading packet:", errorstr)
 
 class MessageBusServer(QtCore.QObject):
+    """
+    Server connecting all messageBus clients.
+
+    The server routes published events by reading the packet type and topic only,
+    the event data is forwarded to the subscribers without being decoded. Thus the
+    work of the server does not depend on the size of the published data. The data
+    is decoded only while the :attr:`eventPublished` signal is connected, which is
+    emitted with the decoded data as before. Unsetting `decodeEvents` disables the
+    decoding and :attr:`eventPublished` altogether. The :attr:`packetPublished` signal
+    is always emitted with the serialized packet.
+
+    Events published using the binary transport are transcoded to json once for
+    all subscribers not supporting the :data:`PROTOCOL_BINARY` subprotocol.
+
+    Each client connection queues the events a slow client is not able to receive,
+    see :class:`ServerClientConnection` for the queue limits and policies.
+
+    :param port: (int) TCP port of the service.
+    :param decodeEvents: (bool) Decode the published data for a connected :attr:`eventPublished`.
+    :param queuePolicy: (str) Policy for clients exceeding their send queue.
+    :param maxQueueBytes: (int) Maximum number of bytes queued per client.
+    :param maxQueueMessages: (int) Maximum number of events queued per client.
+    """
 
     clientConnected = qtSignal(object)
     clientDisconnected = qtSignal(object)
     eventPublished = qtSignal(str, object)
+    packetPublished = qtSignal(str, object)
 
-    def __init__(self, port=DEFAULT_PORT):
+    def __init__(self, port=DEFAULT_PORT, decodeEvents=True, queuePolicy=QUEUE_DROP_OLDEST,
+                 maxQueueBytes=DEFAULT_QUEUE_BYTES, maxQueueMessages=DEFAULT_QUEUE_MESSAGES):
         QtCore.QObject.__init__(self)
+        if queuePolicy not in QUEUE_POLICIES:
+            raise ValueError("unknown queue policy %s" % queuePolicy)
+        self.decodeEvents = decodeEvents
+        self.queuePolicy = queuePolicy
+        self.maxQueueBytes = maxQueueBytes
+        self.maxQueueMessages = maxQueueMessages
         # setup server
         self.server = QtNetwork.QTcpServer()
         self.server.listen(port=port)
         self.server.newConnection.connect(self._handleNewConnection)
         # list of client connections
         self.clients = []
+        # index of the subscribed client connections by topic
+        self.subscribers = TopicIndex()
 
     def _handleNewConnection(self):
-        client = ServerClientConnection(self.server.nextPendingConnection())
+        client = ServerClientConnection(self.server.nextPendingConnection(), self.queuePolicy,
+                                        self.maxQueueBytes, self.maxQueueMessages)
         client.eventPublished.connect(self._handlePublish)
         client.disconnected.connect(self._handleDisconnect)
         client.rpcRequested.connect(self._handleRPCRequest)
         client.infoRequested.connect(self._handleInfoRequest)
+        client.subscribed.connect(self._handleSubscribe)
+        client.unsubscribed.connect(self._handleUnsubscribe)
         self.clients.append(client)
         self.clientConnected.emit(client)
         print("new client connected (active connections: %d)" % len(self.clients))
         assert (not self.server.hasPendingConnections())  # TODO: do we have to check for multiple connections?
 
-    def _handlePublish(self, topic, data):
+    def _handlePublish(self, topic, packet):
         topic = str(topic)
-        # search clients for subscribers
-        for client in self.clients:
-            if topic in client.subscriptions:
-                client.forwardEvent(topic, data)
-        self.eventPublished.emit(topic, data)
+        subscribers = self.subscribers.match(topic)
+        binary = jsonEncoder.isBinary(packet)
+        frames = {}
+        decoded = None
+        for client in subscribers:
+            # the publish packet is forwarded unchanged, or transcoded once for clients without binary transport
+            transcode = binary and not client.binaryTransport
+            if transcode not in frames:
+                if transcode:
+                    decoded = jsonEncoder.loads(packet)
+                frames[transcode] = encodeFrame(jsonEncoder.dumps(decoded) if transcode else packet)
+            client.forwardFrame(frames[transcode], topic)
+        self.packetPublished.emit(topic, packet)
+        if self.decodeEvents and self._eventReceivers() > 0:
+            if decoded is None:
+                decoded = jsonEncoder.loads(packet)
+            self.eventPublished.emit(topic, decoded[2])
+
+    def _eventReceivers(self):
+        # PyQt4 and PySide only count the receivers of signal signatures
+        if QT_API == QT_API_PYQT5:
+            return self.receivers(self.eventPublished)
+        signature = "PyObject" if (QT_API == QT_API_PYSIDE) else "PyQt_PyObject"
+        return self.receivers(QtCore.SIGNAL("eventPublished(QString,%s)" % signature))
+
+    def _handleSubscribe(self, topic, client):
+        self.subscribers.add(str(topic), client)
+
+    def _handleUnsubscribe(self, topic, client):
+        self.subscribers.remove(str(topic), client)
 
     def _handleRPCRequest(self, func, data, issuer):
         func = six.u(func)
@@ -604,6 +999,8 @@ class MessageBusServer(QtCore.QObject):
         client = self.sender()
         self.clientDisconnected.emit(client)
         self.clients.remove(client)
+        for topic in client.subscriptions:
+            self.subscribers.remove(str(topic), client)
         print("client disconnected (active connections: %d)" % len(self.clients))
 
 if __name__ == "__main__":
@@ -614,8 +1011,8 @@ if __name__ == "__main__":
     # implement basic console server
     class ConsoleServer(MessageBusServer):
         def __init__(self):
-            MessageBusServer.__init__(self)
-            self.eventPublished.connect(self.printEventPublished)
+            MessageBusServer.__init__(self, decodeEvents=False)
+            self.packetPublished.connect(self.printEventPublished)
 
         def printEventPublished(self, topic, data):
             print("new event: %s" % str(topic))
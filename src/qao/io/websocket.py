@@ -48,7 +48,7 @@ def np_xor(data, mask):
 
 class HTTPHeader(object):
     def __init__(self, requestLine='', attr={}):
-        self.attr = attr
+        self.attr = dict(attr)
         self.requestLine = requestLine
         self.parser = self.readHeader()
         next(self.parser)
@@ -75,10 +75,19 @@ class HTTPHeader(object):
             except Exception as e:
                 print("could not interpret header line: %s: %s" % (line, e))
     
-    def buildServerReply(self):
+    def protocols(self):
+        """
+        Return the subprotocols listed in the 'Sec-WebSocket-Protocol' field.
+        """
+        value = self.attr.get('Sec-WebSocket-Protocol', '')
+        return [protocol.strip() for protocol in value.split(',') if protocol.strip()]
+
+    def buildServerReply(self, protocol=None):
         header = 'HTTP/1.1 101 Switching Protocols'
         answerAttributes = {'Upgrade': 'websocket',
                             'Connection': 'Upgrade'}
+        if protocol is not None:
+            answerAttributes['Sec-WebSocket-Protocol'] = protocol
         
         #calculate 'Sec-WebSocket-Accept'
         assert 'Sec-WebSocket-Key' in self.attr
@@ -25,9 +25,13 @@ A few color-maps are already provided by this module:
 """
 
 import numpy as np
-from scipy import weave
 from qao.gui.qt import QtGui
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 #########################################################################################
 
 cmap_wjet = {"r_map": np.array([1.0, 0.2, 0.0, 0.0, 0.5, 1.0, 1.0, 1.0]),
@@ -52,38 +56,50 @@ cmap_gray = {"r_map": np.array([0.0, 1.0]),
 
 ########################################################################################################################################################
 
-__ptr_from_capsule_code = """
-unsigned char *rgbdata = (unsigned char*) PyCapsule_GetPointer(rgbdata_capsule, NULL);
-"""
-__ptr_from_cobject_code = """
-unsigned char *rgbdata = (unsigned char*) PyCObject_AsVoidPtr(rgbdata_cobject);
-"""
-
-__cmapping_code = r"""
-const double * const pdata = data;
-const int size      = Ndata[1]*Ndata[0];
-const int ncmap     = Nr_map[0];
-const double scalef = (1. / (vmax-vmin)) * (ncmap-1);
-
-#pragma omp parallel for
-for (int i=0; i<size; ++i) {
-    unsigned char *prgb = rgbdata + 4*i;
-    double val = (pdata[i] - vmin) * scalef;
-    val = fmax(val, 0);
+def cmapping_numpy(data, rgbdata, vmin, vmax, r_map, g_map, b_map):
+    ncmap = r_map.size
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scalef = (1. / (vmax-vmin)) * (ncmap-1)
+        val = np.fmax((data.ravel() - vmin) * scalef, 0)
+    j = np.fmin(val   , ncmap-1).astype(np.intp)
+    k = np.fmin(val+1., ncmap-1).astype(np.intp)
+    f = val - j
     
-    int j = fmin(val   , ncmap-1);
-    int k = fmin(val+1., ncmap-1);
-    double f = val - j;
-
-    prgb[0] = (b_map[j]*(1.-f) + b_map[k]*f)*255;
-    prgb[1] = (g_map[j]*(1.-f) + g_map[k]*f)*255;
-    prgb[2] = (r_map[j]*(1.-f) + r_map[k]*f)*255;
-    prgb[3] = 255;
-}
-"""
-
-__compiler_args = "-O3 -march=native -ffast-math -fno-openmp"
-__linker_args   = "-fno-openmp"
+    prgb = rgbdata.reshape(data.size, 4)
+    prgb[:, 0] = (b_map[j]*(1.-f) + b_map[k]*f)*255
+    prgb[:, 1] = (g_map[j]*(1.-f) + g_map[k]*f)*255
+    prgb[:, 2] = (r_map[j]*(1.-f) + r_map[k]*f)*255
+    prgb[:, 3] = 255
+
+def __cmapping_loop(pdata, prgb, vmin, vmax, r_map, g_map, b_map):
+    ncmap  = r_map.size
+    scalef = (1. / (vmax-vmin)) * (ncmap-1)
+    for i in numba.prange(pdata.size):
+        val = max((pdata[i] - vmin) * scalef, 0.)
+        j = int(min(val   , ncmap-1))
+        k = int(min(val+1., ncmap-1))
+        f = val - j
+        prgb[i, 0] = (b_map[j]*(1.-f) + b_map[k]*f)*255
+        prgb[i, 1] = (g_map[j]*(1.-f) + g_map[k]*f)*255
+        prgb[i, 2] = (r_map[j]*(1.-f) + r_map[k]*f)*255
+        prgb[i, 3] = 255
+
+if numba is not None:
+    __cmapping_loop = numba.njit(parallel=True, fastmath=True, cache=True)(__cmapping_loop)
+
+    def cmapping_numba(data, rgbdata, vmin, vmax, r_map, g_map, b_map):
+        __cmapping_loop(data.ravel(), rgbdata.reshape(data.size, 4), vmin, vmax, r_map, g_map, b_map)
+
+    cmapping_ndarray = cmapping_numba
+else:
+    cmapping_ndarray = cmapping_numpy
+
+def __qimageArray(qimage):
+    # writable view on the pixel buffer of a 32bit QImage
+    bits = qimage.bits()
+    if hasattr(bits, "setsize"):
+        bits.setsize(qimage.byteCount())
+    return np.frombuffer(bits, dtype=np.uint8)
 
 def __checkTypes(data, vmin, vmax):
     # data must be contiguous and of type double
@@ -100,14 +116,6 @@ def __checkTypes(data, vmin, vmax):
         vmax = float(vmax)
     return data, vmin, vmax
 
-def cmapping_ndarray_inline(data, rgbdata, vmin, vmax, r_map, g_map, b_map):
-    weave.inline(__cmapping_code, ['data', 'rgbdata', 'vmin', 'vmax', 'r_map', 'g_map', 'b_map'],
-                 extra_compile_args = [__compiler_args], extra_link_args = [__linker_args])
-    
-def cmapping_cobject_inline(data, rgbdata_cobject, vmin, vmax, r_map, g_map, b_map):
-    weave.inline(__ptr_from_cobject_code + __cmapping_code, ['data', 'rgbdata_cobject', 'vmin', 'vmax', 'r_map', 'g_map', 'b_map'],
-                 extra_compile_args = [__compiler_args], extra_link_args = [__linker_args])
-
 def createRGB(data, vmin = None, vmax = None, cmap = cmap_wjet):
     """
     Create image from data using a color-map.
@@ -136,7 +144,7 @@ def createRGB(data, vmin = None, vmax = None, cmap = cmap_wjet):
     data, vmin, vmax = __checkTypes(data, vmin, vmax)
     # create rgb values from data
     rgbdata = np.empty([data.shape[0], data.shape[1], 4], dtype=np.uint8)
-    cmapping_ndarray_inline(data, rgbdata, vmin, vmax, cmap["b_map"], cmap["g_map"], cmap["r_map"])
+    cmapping_ndarray(data, rgbdata, vmin, vmax, cmap["b_map"], cmap["g_map"], cmap["r_map"])
     return rgbdata
 
 def createBGR(data, vmin = None, vmax = None, cmap = cmap_wjet):
@@ -167,7 +175,7 @@ def createBGR(data, vmin = None, vmax = None, cmap = cmap_wjet):
     data, vmin, vmax = __checkTypes(data, vmin, vmax)
     # create rgb values from data
     rgbdata = np.empty([data.shape[0], data.shape[1], 4], dtype=np.uint8)
-    cmapping_ndarray_inline(data, rgbdata, vmin, vmax, cmap["r_map"], cmap["g_map"], cmap["b_map"])
+    cmapping_ndarray(data, rgbdata, vmin, vmax, cmap["r_map"], cmap["g_map"], cmap["b_map"])
     return rgbdata
 
 def createQImage(data, vmin = None, vmax = None, cmap = cmap_wjet):
@@ -197,8 +205,8 @@ def createQImage(data, vmin = None, vmax = None, cmap = cmap_wjet):
     data, vmin, vmax = __checkTypes(data, vmin, vmax)
     # write rgb data to new QImage
     qimage = QtGui.QImage(data.shape[1], data.shape[0], QtGui.QImage.Format_RGB32)
-    rgbdata_cobject = qimage.bits().ascobject()
-    cmapping_cobject(data, rgbdata_cobject, vmin, vmax, cmap["r_map"], cmap["g_map"], cmap["b_map"])
+    rgbdata = __qimageArray(qimage)
+    cmapping_ndarray(data, rgbdata, vmin, vmax, cmap["r_map"], cmap["g_map"], cmap["b_map"])
     return qimage
 
 def updateQImage(qimage, data, vmin = None, vmax = None, cmap = cmap_wjet):
@@ -229,44 +237,8 @@ def updateQImage(qimage, data, vmin = None, vmax = None, cmap = cmap_wjet):
     data, vmin, vmax = __checkTypes(data, vmin, vmax)
     # write rgb data to existing QImage
     assert data.size == (qimage.height()*qimage.width()), "invalid size"
-    rgbdata_cobject = qimage.bits().ascobject()
-    cmapping_cobject(data, rgbdata_cobject, vmin, vmax, cmap["r_map"], cmap["g_map"], cmap["b_map"])
-
-def buildExt(compiler='', verbose=1, optimize=True):
-    # type definitions
-    data = np.zeros([2,2], dtype=np.double)
-    vmin = 0.; vmax = 1. #@UnusedVariable
-    r_map   = np.zeros(2, dtype=np.double) #@UnusedVariable
-    g_map   = np.zeros(2, dtype=np.double) #@UnusedVariable
-    b_map   = np.zeros(2, dtype=np.double) #@UnusedVariable
-    rgbdata = np.empty(data.size*4, dtype=np.uint8) #@UnusedVariable
-    qimage  = QtGui.QImage(data.shape[1], data.shape[0], QtGui.QImage.Format_RGB32)
-    rgbdata_cobject = qimage.bits().ascobject() #@UnusedVariable
-    
-    # build extension
-    mod = weave.ext_tools.ext_module("ext_image", compiler)
-    c_cmapping_ndarray = weave.ext_function("cmapping_ndarray", __cmapping_code, ['data', 'rgbdata', 'vmin', 'vmax', 'r_map', 'g_map', 'b_map'])
-    c_cmapping_cobject = weave.ext_function("cmapping_cobject", __ptr_from_cobject_code + __cmapping_code, ['data', 'rgbdata_cobject', 'vmin', 'vmax', 'r_map', 'g_map', 'b_map'])
-    mod.add_function(c_cmapping_ndarray)
-    mod.add_function(c_cmapping_cobject)
-    if optimize:
-        mod.customize.add_extra_compile_arg(__compiler_args)
-        mod.customize.add_extra_link_arg(__linker_args)
-    mod.compile(verbose = verbose)
-
-########################################################################################################################################################
-
-# try to determine if this system can compile code, if not, try to load a precompiled extension
-try:
-    cmapping_ndarray_inline(np.empty([1,1], dtype=float), np.empty(4, dtype=np.uint8), 0, 1, cmap_wjet["r_map"], cmap_wjet["g_map"], cmap_wjet["b_map"])
-    cmapping_ndarray = cmapping_ndarray_inline #@UnusedVariable
-    cmapping_cobject = cmapping_cobject_inline
-except:
-    print "cannot compile inline"
-    try:
-        from ext_image import cmapping_ndarray, cmapping_cobject #@UnresolvedImport @UnusedImport
-    except:
-        raise Exception("precompiled ext not found, compile using buildExt")
+    rgbdata = __qimageArray(qimage)
+    cmapping_ndarray(data, rgbdata, vmin, vmax, cmap["r_map"], cmap["g_map"], cmap["b_map"])
 
 ########################################################################################################################################################
 
@@ -0,0 +1,108 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from unittest.case import TestCase
+from qao.fit import Gauss1D, FitCache
+
+def gauss1d(x, pars):
+    A, x0, sx, off = pars
+    return A * np.exp(-(x-x0)**2 / sx**2 *.5) + off
+
+class TestFitCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pars = np.array([2., 40., 8., .5])
+        self.data = gauss1d(np.arange(100.), self.pars)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def countingFitter(self, cache):
+        fitter = Gauss1D(self.data)
+        fitter.setCache(cache)
+        fitter.guesses = []
+        fitter.guess = lambda guess=fitter.guess: fitter.guesses.append(1) or guess()
+        return fitter
+
+    def test_fit(self):
+        """
+        Test that repeated fits of the same data are answered from the cache
+        """
+        # Arrange
+        cache = FitCache()
+        fitter = self.countingFitter(cache)
+        expected, expected_log = fitter.fit(return_dict = True)
+
+        # Act
+        result, log = fitter.fit(return_dict = True)
+        fitter.setData(self.data + 1.)
+        shifted = fitter.fit()
+        fitter.setData(self.data)
+        fitter.fit(kmax = 10)
+
+        # Assert
+        self.assertTrue(np.array_equal(result, expected))
+        self.assertEqual(log, expected_log)
+        self.assertEqual(fitter.getFitLog(), expected_log)
+        self.assertTrue(np.allclose(shifted[-1], self.pars[-1] + 1.))
+        self.assertEqual(len(fitter.guesses), 3, "Cached fit was repeated")
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_solver(self):
+        """
+        Test that fits with different solver settings are not answered from the cache
+        """
+        # Arrange
+        cache = FitCache()
+        fitter = self.countingFitter(cache)
+        fitter.fit()
+
+        # Act
+        fitter.setSolver("marquardt")
+        fitter.fit()
+        fitter.setSolver("marquardt", geodesic = True)
+        fitter.fit()
+        fitter.fit()
+
+        # Assert
+        self.assertEqual(len(fitter.guesses), 3, "Cached fit used other solver settings")
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_lru(self):
+        """
+        Test that the least recently used results are discarded first
+        """
+        # Arrange
+        cache = FitCache(maxsize = 2)
+        for key in ["a", "b"]:
+            cache.put(key, self.pars, {})
+
+        # Act
+        cache.get("a")
+        cache.put("c", self.pars, {})
+
+        # Assert
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+
+    def test_persistence(self):
+        """
+        Test that the results are restored from the cache directory
+        """
+        # Arrange
+        fitter = self.countingFitter(FitCache(path = self.tmpdir))
+        expected = fitter.fit()
+
+        # Act
+        fitter = self.countingFitter(FitCache(path = self.tmpdir))
+        result = fitter.fit()
+
+        # Assert
+        self.assertTrue(np.array_equal(result, expected))
+        self.assertEqual(fitter.guesses, [], "Persistent result was not used")
+
+if __name__ == '__main__':
+    unittest.main()
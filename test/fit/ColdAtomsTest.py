@@ -1,7 +1,7 @@
 import unittest
 import numpy as np
 from unittest.case import TestCase
-from qao.fit.coldatoms import ThomasFermi2D
+from qao.fit.coldatoms import ThomasFermi2D, Bimodal2D
 from GaussTest import gauss2drot, gauss2d
 
 
@@ -70,5 +70,73 @@ class TestThomasFermi2D(TestCase):
                                     key, nsr, result[key], expected[key]
                                 ))
 
+    def test_fJ_batch(self):
+        """
+        Test that the batched function values and jacobians match the single evaluations
+        """
+        # Arrange
+        pars = np.array([[10, 20, 8, 15, 12, 1.],
+                         [5, 25.5, 10, 18.2, 6, .5],
+                         [-3, 14, 5, 20, 9, 0.]])
+        fitter = ThomasFermi2D(np.zeros((35, 40)))
+        f = np.empty((len(pars), fitter._f.size))
+        J = np.empty((len(pars), ) + fitter._J.shape)
+
+        # Act
+        fitter.fJBatch(pars, f, J)
+
+        # Assert
+        for i in range(len(pars)):
+            fitter.fJ(pars[i])
+            self.assertTrue(np.allclose(f[i], fitter._f), "Wrong function values of item %d" % i)
+            self.assertTrue(np.allclose(J[i], fitter._J), "Wrong jacobian of item %d" % i)
+
+
+class TestBimodal2D(TestCase):
+
+    def test_normal_equations(self):
+        """
+        Test that the normal equations from the separable factors match the ones from the jacobian
+        """
+        # Arrange
+        pars = np.array([[1., .5, 21., 8., 12., 17., 6., 9., .1],
+                         [-1., .5, 36.5, 8., 12., 2., -6., 9., .1],
+                         [1., -.5, 50., 8., 12., 17., 6., 9., .1]])
+        data = np.random.RandomState(0).rand(35, 40)
+        fitter = Bimodal2D(data)
+
+        for i in range(len(pars)):
+            fitter.fJ(pars[i])
+            r = fitter._f - data.ravel()
+            expected = np.inner(fitter._J, fitter._J), np.inner(fitter._J, r)
+
+            # Act
+            result = fitter.JTJ(pars[i], r)
+
+            # Assert
+            self.assertTrue(np.allclose(result[0], expected[0]), "Wrong matrix J*J^T of item %d" % i)
+            self.assertTrue(np.allclose(result[1], expected[1]), "Wrong gradient J*r of item %d" % i)
+
+    def test_fJ_batch(self):
+        """
+        Test that the batched function values and jacobians match the single evaluations
+        """
+        # Arrange
+        pars = np.array([[1., .5, 21., 8., 12., 17., 6., 9., .1],
+                         [2., .2, 15.5, 5., 7., 20.3, 9., 11., 0.],
+                         [-1., -.5, 25., 10., 6., 14., 4., 8., .3]])
+        fitter = Bimodal2D(np.zeros((35, 40)))
+        f = np.empty((len(pars), fitter._f.size))
+        J = np.empty((len(pars), ) + fitter._J.shape)
+
+        # Act
+        fitter.fJBatch(pars, f, J)
+
+        # Assert
+        for i in range(len(pars)):
+            fitter.fJ(pars[i])
+            self.assertTrue(np.allclose(f[i], fitter._f), "Wrong function values of item %d" % i)
+            self.assertTrue(np.allclose(J[i], fitter._J), "Wrong jacobian of item %d" % i)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import numpy as np
+from unittest.case import TestCase
+from qao.fit import Gauss2D, FitJob
+
+def gauss2d(x, y, pars):
+    A, x0, sx, y0, sy, off = pars
+    ex = np.exp(-(x-x0)**2 / sx**2 *.5)
+    ey = np.exp(-(y-y0)**2 / sy**2 *.5)
+    return A * ex * ey + off
+
+class TestFitJob(TestCase):
+
+    def setUp(self):
+        x = np.arange(60.)
+        y = np.arange(50.)
+        X, Y = np.meshgrid(x, y)
+        self.pars = np.array([(1. + .1*i, 30 + i, 8, 25. - i, 6, .5) for i in range(10)])
+        self.stack = np.array([gauss2d(X, Y, p) for p in self.pars])
+
+    def test_run(self):
+        """
+        Test that the fit job returns the results of the single fits in order
+        """
+        # Arrange
+        fitter = Gauss2D(self.stack[0])
+        expected = []
+        for data in self.stack:
+            fitter.setData(data)
+            expected.append(fitter.fit())
+        progress = []
+
+        # Act
+        with FitJob(Gauss2D, self.stack, processes = 2) as job:
+            pars, errs, logs = job.run(callback = lambda done, total: progress.append((done, total)) or True)
+
+        # Assert
+        self.assertTrue(np.allclose(pars, expected), "Fit job returned wrong values")
+        self.assertTrue(np.allclose(pars, self.pars, atol=1e-4), "Fit job returned wrong values")
+        self.assertEqual(errs.shape, pars.shape)
+        self.assertTrue(all(log["success"] for log in logs))
+        self.assertEqual(progress, [(i+1, len(self.stack)) for i in range(len(self.stack))])
+
+    def test_set_data(self):
+        """
+        Test that a fit job can be rerun on new data using the same workers
+        """
+        # Arrange
+        job = FitJob(Gauss2D, self.stack, processes = 2)
+        job.run(errors = False)
+
+        # Act
+        job.setData(self.stack[::-1])
+        pars, errs, logs = job.run(pars_guess = self.pars[0], errors = False)
+        job.close()
+
+        # Assert
+        self.assertIsNone(errs)
+        self.assertTrue(np.allclose(pars, self.pars[::-1], atol=1e-4), "Fit job returned wrong values")
+        self.assertRaises(ValueError, job.setData, self.stack[1:])
+
+    def test_invalid_fitter(self):
+        """
+        Test that invalid fitter arguments raise before the workers are started
+        """
+        self.assertRaises(TypeError, FitJob, Gauss2D, self.stack, fitter_args = (1, 2))
+        self.assertRaises(ValueError, FitJob, Gauss2D, self.stack, mask = np.zeros((2, 2)))
+
+    def test_resampled_errors(self):
+        """
+        Test that bootstrap and Monte-Carlo errors agree with the covariance estimate
+        """
+        # Arrange
+        data = self.stack[0] + np.random.RandomState(0).normal(0, .05, self.stack[0].shape)
+        fitter = Gauss2D(data)
+        fitter.fit()
+        expected = fitter.getFitErr()
+
+        for method in ["bootstrap", "montecarlo"]:
+            # Act
+            result = fitter.getFitErr(method, samples = 100, processes = 2, seed = 0)
+
+            # Assert
+            self.assertTrue(np.all((result > .5*expected) & (result < 2*expected)),
+                            "%s errors do not match: %s != %s" % (method, result, expected))
+
+        self.assertRaises(ValueError, fitter.getFitErr, "jackknife")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,340 @@
+import unittest
+import numpy as np
+from unittest.case import TestCase
+from qao.fit.fitter import LevmarFitter
+from qao.fit.stdfuncs import ExpDecayOffs
+
+
+class ExpDecay(LevmarFitter):
+    """
+    Model implementing f only, the jacobian is approximated.
+    """
+
+    def __init__(self, data, dtype = None):
+        LevmarFitter.__init__(self, ["A", "tau", "off"], data, dtype)
+        self.x = np.arange(self.data.size, dtype = self.dtype)
+
+    def guess(self):
+        return np.asfarray([self.data[0] - self.data[-1], .2 * self.data.size, self.data[-1]])
+
+    def f(self, pars):
+        A, tau, off = pars
+        self._f[:] = A * np.exp(-self.x / tau) + off
+
+    def fJexact(self, pars):
+        A, tau, off = pars
+        e = np.exp(-self.x / tau)
+        return np.array([e, A * self.x / tau**2 * e, np.ones_like(e)])
+
+
+class ExpDecayBatch(ExpDecay):
+    """
+    Model implementing f and the vectorized fBatch.
+    """
+
+    def fBatch(self, pars, f):
+        A, tau, off = [pars[:, i, np.newaxis] for i in range(3)]
+        f[:] = A * np.exp(-self.x / tau) + off
+
+
+class TestJacobianApprox(TestCase):
+
+    def setUp(self):
+        self.pars = np.array([2., 30., .5])
+        self.data = ExpDecay(np.zeros(200)).fJexact(self.pars)[0] * 2. + .5
+
+    def test_jacobian(self):
+        """
+        Test that all finite difference schemes approximate the exact jacobian
+        """
+        for cls in [ExpDecay, ExpDecayBatch]:
+            for method, atol in [("central", 1e-7), ("forward", 1e-5)]:
+                # Arrange
+                fitter = cls(self.data)
+                fitter.setJacobianApprox(method)
+                expected_J = fitter.fJexact(self.pars)
+                fitter.f(self.pars)
+                expected_f = fitter._f.copy()
+
+                # Act
+                fitter.fJ(self.pars)
+
+                # Assert
+                self.assertTrue(np.allclose(fitter._f, expected_f), "Wrong function values")
+                self.assertTrue(np.allclose(fitter._J, expected_J, atol=atol),
+                                "Wrong %s jacobian approximation by %s" % (method, cls.__name__))
+
+    def test_fit(self):
+        """
+        Test that the approximated jacobians lead to the same fit results
+        """
+        for cls in [ExpDecay, ExpDecayBatch]:
+            for method in ["central", "forward"]:
+                # Arrange
+                fitter = cls(self.data)
+                fitter.setJacobianApprox(method)
+
+                # Act
+                result = fitter.fit()
+
+                # Assert
+                self.assertTrue(np.allclose(result, self.pars, atol=1e-5),
+                                "Fit using %s differences by %s returned wrong values: %s != %s" % (
+                                    method, cls.__name__, result, self.pars))
+
+    def test_invalid_method(self):
+        fitter = ExpDecay(self.data)
+        self.assertRaises(ValueError, fitter.setJacobianApprox, "backward")
+
+
+class TestFitErr(TestCase):
+
+    def test_cached_normal_equations(self):
+        """
+        Test that the errors after a fit reuse the normal equations of the fit
+        """
+        # Arrange
+        pars = np.array([2., 30., .5])
+        data = ExpDecay(np.zeros(200)).fJexact(pars)[0] * 2. + .5
+        data += np.random.RandomState(0).normal(0, .01, data.shape)
+        fitter = ExpDecay(data)
+        fitter.fit()
+        calls = []
+        fitter.f = lambda p, f=fitter.f: calls.append(1) or f(p)
+
+        # Act
+        result = fitter.getFitErr()
+        fitter.setData(data)
+        expected = fitter.getFitErr()
+
+        # Assert
+        self.assertTrue(np.allclose(result, expected, rtol=1e-4),
+                        "Errors from fit do not match: %s != %s" % (result, expected))
+        self.assertEqual(len(calls), 2 * len(pars) + 1, "Errors after fit evaluated the model")
+
+
+class TestSolver(TestCase):
+
+    def test_fit(self):
+        """
+        Test that all solver variants converge to the same parameters from a poor guess
+        """
+        # Arrange
+        pars = np.array([2., 30., .5])
+        data = ExpDecay(np.zeros(200)).fJexact(pars)[0] * 2. + .5
+        guess = np.array([10., 1., 1.])
+
+        for damping in ["identity", "marquardt"]:
+            for geodesic in [False, True]:
+                fitter = ExpDecay(data)
+                fitter.setSolver(damping, geodesic)
+
+                # Act
+                result, log = fitter.fit(guess, kmax = 100, return_dict = True)
+
+                # Assert
+                self.assertTrue(log["success"])
+                self.assertTrue(np.allclose(result, pars, atol=1e-5),
+                                "Fit using %s damping, geodesic %s returned wrong values: %s" % (
+                                    damping, geodesic, result))
+
+    def test_fit_fJ_only(self):
+        """
+        Test that geodesic acceleration evaluates models implementing fJ only
+        """
+        # Arrange
+        pars = np.array([2., 30., .5])
+        data = ExpDecayOffs(np.zeros(200)).getFitData(pars)
+        guess = np.array([10., 10., 1.])
+
+        for damping in ["identity", "marquardt"]:
+            fitter = ExpDecayOffs(data)
+            fitter.setSolver(damping, True)
+
+            # Act
+            result, log = fitter.fit(guess, kmax = 100, return_dict = True)
+
+            # Assert
+            self.assertTrue(log["success"])
+            self.assertTrue(np.allclose(result, pars, atol=1e-5),
+                            "Fit using %s damping returned wrong values: %s" % (damping, result))
+
+    def test_fJ_only_acceleration(self):
+        """
+        Test that geodesic steps of models implementing fJ only match the ones of models implementing f
+        """
+        # Arrange
+        class ExpDecayOffsF(ExpDecayOffs):
+            def f(self, pars):
+                A, tau, off = pars
+                self._f[:] = A * np.exp(-np.arange(self.data.size) / tau) + off
+
+        pars = np.array([2., 30., .5])
+        data = ExpDecayOffs(np.zeros(200)).getFitData(pars)
+        data += np.random.RandomState(0).normal(0, .01, data.size)
+        guess = np.array([10., 10., 1.])
+        results = []
+
+        for cls in [ExpDecayOffs, ExpDecayOffsF]:
+            fitter = cls(data)
+            fitter.setSolver("identity", True)
+            fitter.setProfiling(True)
+
+            # Act
+            results.append(fitter.fit(guess, kmax = 100, return_dict = True))
+
+        # Assert
+        (result, log), (expected, expected_log) = results
+        self.assertEqual(log["iter"], expected_log["iter"])
+        self.assertEqual(log["profile"]["rejected"], expected_log["profile"]["rejected"])
+        self.assertTrue(np.allclose(result, expected, rtol=1e-10, atol=0),
+                        "Geodesic fit of fJ only model differs: %s != %s" % (result, expected))
+
+    def test_invalid_damping(self):
+        fitter = ExpDecay(np.zeros(200))
+        self.assertRaises(ValueError, fitter.setSolver, "levenberg")
+
+
+class TestSetData(TestCase):
+
+    def test_integer_data(self):
+        """
+        Test that integer data is converted into a buffer reused by every call
+        """
+        # Arrange
+        pars = np.array([2000., 30., 500.])
+        data = ExpDecay(np.zeros(200)).fJexact(pars)[0] * 2000. + 500.
+        frames = np.round([data, data + 100.]).astype(np.uint16)
+        fitter = ExpDecay(frames[0])
+        buffer = fitter.data
+
+        # Act
+        fitter.setData(frames[1])
+        result = fitter.fit()
+
+        # Assert
+        self.assertIs(fitter.data, buffer)
+        self.assertEqual(fitter.data.dtype, np.double)
+        self.assertTrue(np.array_equal(fitter.data, frames[1]))
+        self.assertTrue(np.allclose(result, pars + [0., 0., 100.], rtol=1e-3),
+                        "Fit of integer data returned wrong values: %s" % result)
+
+    def test_float_data(self):
+        """
+        Test that data of the fitter dtype is referenced without copying
+        """
+        data = np.ones(200)
+        fitter = ExpDecay(np.zeros(200))
+        fitter.setData(data)
+        self.assertIs(fitter.data, data)
+
+    def test_inplace_update(self):
+        """
+        Test that in-place updates of non-contiguous or masked data are fitted
+        """
+        # Arrange
+        pars = np.array([2., 30., .5])
+        data = ExpDecay(np.zeros(200)).fJexact(pars)[0] * 2. + .5
+        frame = np.zeros((2, 150))
+        frame[:, :100] = data.reshape(2, 100)
+        fitter = ExpDecay(frame[:, :100])
+        fitter_masked = ExpDecay(data.copy())
+        fitter_masked.setMask(roi = np.s_[:150])
+        fitter.fit(pars)
+        fitter_masked.fit(pars)
+
+        # Act
+        frame += 1.
+        fitter_masked.data += 1.
+        result = fitter.fit(pars)
+        result_masked = fitter_masked.fit(pars)
+
+        # Assert
+        for fit in [result, result_masked]:
+            self.assertTrue(np.allclose(fit, pars + [0., 0., 1.], rtol=1e-4),
+                            "Fit of updated data returned wrong values: %s" % fit)
+
+
+class TestProfile(TestCase):
+
+    def test_profile(self):
+        """
+        Test that the profile counts the model evaluations and sums over all fits
+        """
+        # Arrange
+        pars = np.array([2., 30., .5])
+        data = ExpDecay(np.zeros(200)).fJexact(pars)[0] * 2. + .5
+        fitter = ExpDecay(data)
+        fitter.setProfiling(True)
+
+        # Act
+        logs = [fitter.fit(return_dict = True)[1] for i in range(2)]
+        fitter.getFitErr()
+        totals = fitter.getProfile()
+
+        # Assert
+        for log in logs:
+            profile = log["profile"]
+            skipped = 1 if log["reason"] == "small step" else 0
+            self.assertEqual(profile["fJ_calls"], log["iter"] + 1 - skipped)
+            self.assertTrue(profile["fJ"] > 0 and profile["solve"] > 0)
+        self.assertTrue(logs[-1]["profile"]["error"] > 0)
+        self.assertEqual(totals["fits"], 2)
+        self.assertEqual(totals["fJ_calls"], sum(log["profile"]["fJ_calls"] for log in logs))
+        self.assertEqual(totals["rejected"], sum(log["profile"]["rejected"] for log in logs))
+
+    def test_disabled(self):
+        fitter = ExpDecay(np.zeros(200) + 1.)
+        fitter.fit()
+        self.assertNotIn("profile", fitter.getFitLog())
+
+    def test_failed_fit(self):
+        """
+        Test that the profile of a failed fit is not continued by the next fit
+        """
+        # Arrange
+        fitter = ExpDecay(np.zeros(200) + 1.)
+        fitter.setProfiling(True)
+        fitter.guess = lambda: np.linalg.inv(np.zeros((2, 2)))
+
+        # Act
+        self.assertRaises(np.linalg.LinAlgError, fitter.fit)
+        fitter.setProfiling(False)
+        fitter.fit([1., 20., 0.])
+
+        # Assert
+        self.assertNotIn("profile", fitter.getFitLog())
+
+
+class TestMask(TestCase):
+
+    def test_fit(self):
+        """
+        Test that masked points are excluded from the fit of a model evaluating all points
+        """
+        # Arrange
+        pars = np.array([2., 30., .5])
+        data = ExpDecay(np.zeros(200)).fJexact(pars)[0] * 2. + .5
+        mask = np.zeros(data.shape, dtype=bool)
+        mask[50:60] = True
+        data[mask] = 10.
+        fitter = ExpDecay(data)
+
+        # Act
+        fitter.setMask(mask)
+        result = fitter.fit()
+        errors = fitter.getFitErr()
+
+        # Assert
+        self.assertTrue(np.allclose(result, pars, atol=1e-5),
+                        "Masked fit returned wrong values: %s != %s" % (result, pars))
+        self.assertTrue(np.all(errors < 1e-5))
+        self.assertTrue(np.array_equal(fitter.getMask(), mask))
+
+    def test_invalid_mask(self):
+        fitter = ExpDecay(np.zeros(200))
+        self.assertRaises(ValueError, fitter.setMask, np.zeros(100, dtype=bool))
+        self.assertRaises(ValueError, fitter.setMask, None, np.s_[:2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ import struct
 import unittest
 import numpy as np
 from unittest.case import TestCase
-from qao.fit.gauss import Gauss1D, Gauss2D, Gauss2DRot
+from qao.fit.gauss import Gauss1D, MultiGauss1D, Gauss2D, Gauss2DRot
 
 def gauss1d(x, pars):
     A, x0, sx, off = pars
@@ -117,6 +117,94 @@ class TestGauss1D(TestCase):
                                 ))
 
 
+class TestMultiGauss1D(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        x = np.arange(100000.)
+        self.pars = []
+        for i in range(10):
+            self.pars += [rng.uniform(1, 10), 5000 + i*9500 + rng.uniform(-500, 500), rng.uniform(20, 300)]
+        self.pars = np.array(self.pars + [.3])
+        self.data = sum(gauss1d(x, list(self.pars[3*i:3*i+3]) + [0.]) for i in range(10)) + self.pars[-1]
+
+    def test_fit(self):
+        """
+        Test that the MultiGauss1D is able to guess and fit ten peaks in a long spectrum
+        """
+        # Arrange
+        fitter = MultiGauss1D(self.data, 10)
+
+        # Act
+        result, fit_dict = fitter.fit(return_dict=True)
+
+        # Assert
+        self.assertTrue(fit_dict["success"], "MultiGauss1D fit did not converge")
+        self.assertTrue(np.allclose(result, self.pars, atol=1e-4),
+                        "MultiGauss1D fit returned wrong values: %s != %s" % (result, self.pars))
+        self.assertTrue(np.allclose(fitter.integral(peak=0), np.sqrt(2*np.pi) * self.pars[0] * self.pars[2]))
+
+    def test_eps2_default(self):
+        """
+        Test that single and batched fits use the step size limit of the model
+        """
+        # Arrange
+        data = self.data[:30000]
+        fitter = MultiGauss1D(data, 3)
+        guess = fitter.guess()
+        expected, expected_log = fitter.fit(guess, return_dict=True)
+
+        # Act
+        result_batch, logs_batch = fitter.fitBatch(data[np.newaxis], guess, return_dict=True)
+        result_strict, log_strict = fitter.fit(guess, eps2=1e-6, return_dict=True)
+
+        # Assert
+        self.assertEqual(MultiGauss1D.eps2_default, 1e-10)
+        self.assertEqual(logs_batch[0]["iter"], expected_log["iter"])
+        self.assertTrue(np.allclose(result_batch[0], expected, atol=1e-6))
+        self.assertTrue(log_strict["iter"] < expected_log["iter"], "eps2 argument was ignored")
+
+    def test_resampled_errors(self):
+        """
+        Test that resampled errors pass the number of peaks to the fitters of the samples
+        """
+        # Arrange
+        data = self.data[:30000] + np.random.RandomState(1).normal(0, .1, 30000)
+        fitter = MultiGauss1D(data, 3)
+        fitter.fit()
+        expected = fitter.getFitErr()
+
+        # Act
+        result = fitter.getFitErr("bootstrap", samples = 20, processes = 1, seed = 0)
+
+        # Assert
+        self.assertEqual(result.shape, expected.shape)
+        self.assertTrue(np.all((result > .2*expected) & (result < 5*expected)),
+                        "Bootstrap errors do not match: %s != %s" % (result, expected))
+
+    def test_normal_equations(self):
+        """
+        Test that the normal equations from the peak windows match the ones from the jacobian
+        """
+        # Arrange
+        pars = np.append(self.pars[:9], self.pars[-1])
+        pars[4] = pars[1] + 200.
+        data = self.data[:30000] + np.random.RandomState(1).normal(0, .1, 30000)
+        fitter = MultiGauss1D(data, 3)
+        fitter.fJ(pars)
+        r = fitter._f - data
+        expected = np.inner(fitter._J, fitter._J), np.inner(fitter._J, r)
+
+        # Act
+        fitter.f(pars)
+        result = fitter.JTJ(pars, fitter._f - data)
+
+        # Assert
+        self.assertTrue(np.allclose(fitter._f - data, r), "Wrong function values")
+        self.assertTrue(np.allclose(result[0], expected[0]), "Wrong matrix J*J^T")
+        self.assertTrue(np.allclose(result[1], expected[1]), "Wrong gradient J*r")
+
+
 class TestGauss2D(TestCase):
 
     def test_fit(self):
@@ -146,6 +234,264 @@ class TestGauss2D(TestCase):
                                 key, result[i], expected[key]
                             ))
 
+    def test_guess_moments(self):
+        """
+        Test that the moment guess of a noisy cloud is close to the parameters
+        and does not fall back to the projection fits
+        """
+        # Arrange
+        pars = np.array([1., 180., 32., 165., 30., .2])
+        Y, X = np.mgrid[:300., :400.]
+        data = gauss2d(X, Y, pars) + np.random.RandomState(0).normal(0, .05, X.shape)
+        fitter = Gauss2D(data)
+        fitter.guessProjectionFit = lambda: self.fail("Fallback to projection fits")
+
+        # Act
+        guess = fitter.guess()
+
+        # Assert
+        self.assertTrue(np.allclose(guess, pars, rtol=.05, atol=.01),
+                        "Moment guess returned wrong values: %s" % guess)
+
+    def test_guess_fallback(self):
+        """
+        Test that the projection fits are used if the moment guess misses the signal
+        """
+        # Arrange
+        Y, X = np.mgrid[:300., :400.]
+        data = gauss2d(X, Y, (1., 100., 15., 100., 15., 0.)) + gauss2d(X, Y, (1., 300., 15., 200., 15., 0.))
+        fitter = Gauss2D(data)
+        expected = fitter.guessProjectionFit()
+
+        # Act
+        guess = fitter.guess()
+
+        # Assert
+        self.assertTrue(np.array_equal(guess, expected))
+
+    def test_fit_batch(self):
+        """
+        Test that a stack of images fitted by the batch fit matches the single fits
+        """
+        # Arrange
+        pars = [(1.5, 45, 10, 40., 20, 1.),
+                (1.0, 50, 8, 45., 15, .5),
+                (2.0, 40, 12, 35., 10, 0.)]
+        x = np.arange(100.)
+        y = np.arange(80.)
+        X, Y = np.meshgrid(x, y)
+        stack = np.array([gauss2d(X, Y, p) for p in pars])
+        expected = []
+        for data in stack:
+            fitter = Gauss2D(data)
+            expected.append(fitter.fit(fitter.guess()))
+
+        # Act
+        result, fit_dicts = fitter.fitBatch(stack, return_dict=True)
+
+        # Assert
+        for i in range(len(pars)):
+            self.assertTrue(fit_dicts[i]["success"], "Batch fit %d did not converge" % i)
+            self.assertTrue(np.allclose(result[i], expected[i], atol=1e-4),
+                            "Batch fit returned wrong values: %s != %s" % (result[i], expected[i]))
+            self.assertTrue(np.allclose(result[i], pars[i], atol=1e-4),
+                            "Batch fit returned wrong values: %s != %s" % (result[i], pars[i]))
+
+    def test_fit_batch_marquardt(self):
+        """
+        Test that the batch fit uses the damping selected for the fitter
+        """
+        # Arrange
+        pars = [(1.5, 45, 10, 40., 20, 1.),
+                (2.0, 40, 12, 35., 10, 0.)]
+        X, Y = np.meshgrid(np.arange(100.), np.arange(80.))
+        stack = np.array([gauss2d(X, Y, p) for p in pars])
+        expected = []
+        for data in stack:
+            fitter = Gauss2D(data)
+            fitter.setSolver("marquardt")
+            expected.append(fitter.fit(fitter.guess(), return_dict=True))
+
+        # Act
+        result, fit_dicts = fitter.fitBatch(stack, return_dict=True)
+
+        # Assert
+        for i in range(len(pars)):
+            self.assertEqual(fit_dicts[i]["iter"], expected[i][1]["iter"])
+            self.assertTrue(np.allclose(result[i], expected[i][0], atol=1e-4),
+                            "Batch fit returned wrong values: %s != %s" % (result[i], expected[i][0]))
+
+
+    def test_fit_sequence(self):
+        """
+        Test that a sequence of slowly changing images is fitted from warm starts
+        """
+        # Arrange
+        pars = [(1.5, 45 + .2*i, 10, 40., 20, 1.) for i in range(8)]
+        pars[5] = (1.5, 20, 5, 60., 8, 1.)
+        x = np.arange(100.)
+        y = np.arange(80.)
+        X, Y = np.meshgrid(x, y)
+        noise = np.random.RandomState(0).normal(0, 1e-3, (len(pars), 80, 100))
+        stack = np.array([gauss2d(X, Y, p) for p in pars]) + noise
+        fitter = Gauss2D(stack[0])
+
+        # Act
+        result, report = fitter.fitSequence(stack, return_dict=True)
+
+        # Assert
+        self.assertEqual(report["fits"], len(pars))
+        self.assertEqual(report["fallbacks"], 2)
+        self.assertTrue(all(log["success"] for log in report["fit_logs"]))
+        self.assertTrue(np.allclose(result, pars, atol=1e-2),
+                        "Sequence fit returned wrong values: %s != %s" % (result, pars))
+
+    def test_fit_pyramid(self):
+        """
+        Test that a small gauss in a large image is fitted coarse to fine
+        """
+        # Arrange
+        pars = 1.5, 250.3, 12, 180.6, 8, .5
+        x = np.arange(400.)
+        y = np.arange(300.)
+        X, Y = np.meshgrid(x, y)
+        fitter = Gauss2D(gauss2d(X, Y, pars))
+
+        # Act
+        result_full, fit_dict_full = fitter.fitPyramid(binning=4, return_dict=True)
+        result_roi, fit_dict_roi = fitter.fitPyramid(binning=4, roi=(60, 80), return_dict=True)
+
+        # Assert
+        for result, fit_dict in [(result_full, fit_dict_full), (result_roi, fit_dict_roi)]:
+            self.assertTrue(fit_dict["success"], "Pyramid fit did not converge")
+            self.assertTrue(np.allclose(result, pars, atol=1e-4),
+                            "Pyramid fit returned wrong values: %s != %s" % (result, pars))
+            self.assertTrue(np.allclose(fitter.getFitPars(), pars, atol=1e-4))
+
+    def test_fit_pyramid_sigma(self):
+        """
+        Test that the pyramid fit weights the binned image and the window by the errors
+        """
+        # Arrange
+        pars = 1.5, 45, 10, 40., 20, 1.
+        X, Y = np.meshgrid(np.arange(100.), np.arange(80.))
+        data = gauss2d(X, Y, pars)
+        sigma = np.ones_like(data)
+        data[30:50, 50:60] += 5.
+        sigma[30:50, 50:60] = 1e6
+        fitter = Gauss2D(data)
+        fitter.setSigma(sigma)
+        guess = 1.2, 48, 12, 38., 18, .8
+
+        # Act
+        result_full = fitter.fitPyramid(guess, binning=4)
+        result_roi = fitter.fitPyramid(guess, binning=4, roi=(60, 80))
+
+        # Assert
+        for result in [result_full, result_roi]:
+            self.assertTrue(np.allclose(result, pars, atol=1e-2),
+                            "Pyramid fit returned wrong values: %s != %s" % (result, pars))
+
+    def test_fit_rejected_steps(self):
+        """
+        Test that steps are accepted only if they reduce the residuals of the current parameters
+        """
+        # Arrange
+        pars = 1.5, 45, 10, 40., 20, 1.
+        X, Y = np.meshgrid(np.arange(100.), np.arange(80.))
+        data = gauss2d(X, Y, pars)
+        sigma = np.ones_like(data)
+        data[30:50, 50:60] += 5.
+        sigma[30:50, 50:60] = 1e6
+        data = data.reshape(20, 4, 25, 4).mean(axis=3).mean(axis=1)
+        sigma = np.sqrt(np.square(sigma).reshape(20, 4, 25, 4).sum(axis=3).sum(axis=1)) / 16
+        fitter = Gauss2D(data)
+        fitter.setSigma(sigma)
+        guess = np.array([1.2, 11.6, 3, 9.1, 4.5, .8])
+        errsq_guess = np.sum(((fitter.getFitData(guess) - data) / sigma)**2)
+
+        # Act
+        result, fit_dict = fitter.fit(guess, return_dict=True)
+
+        # Assert
+        self.assertTrue(fit_dict["errsq"] < errsq_guess,
+                        "Fit increased the residuals: %g > %g" % (fit_dict["errsq"], errsq_guess))
+        self.assertTrue(np.allclose(result[[1, 3]], [10.875, 9.625], atol=.5),
+                        "Fit returned wrong position: %s" % result)
+
+    def test_fit_float32(self):
+        """
+        Test that the single precision fit matches the double precision fit
+        """
+        # Arrange
+        pars = 1.5, 45, 10, 40., 20, 1.
+        x = np.arange(100.)
+        y = np.arange(80.)
+        X, Y = np.meshgrid(x, y)
+        data = gauss2d(X, Y, pars)
+        fitter = Gauss2D(data, dtype=np.float32)
+
+        # Act
+        result = fitter.fit()
+        errors = fitter.getFitErr()
+
+        # Assert
+        self.assertEqual(fitter.getFitData().dtype, np.float32)
+        self.assertEqual(result.dtype, np.float64)
+        self.assertEqual(errors.dtype, np.float64)
+        self.assertTrue(np.allclose(result, pars, atol=1e-3),
+                        "Single precision fit returned wrong values: %s != %s" % (result, pars))
+
+    def test_normal_equations(self):
+        """
+        Test that the matrix-free normal equations match the ones from the jacobian
+        """
+        # Arrange
+        pars = np.array([1.5, 45, 10, 40., 20, 1.])
+        data = np.random.rand(80, 100)
+        fitter = Gauss2D(data)
+        fitter.fJ(pars)
+        r = fitter._f - data.ravel()
+        expected = np.inner(fitter._J, fitter._J), np.inner(fitter._J, r)
+
+        # Act
+        fitter.f(pars)
+        result = fitter.JTJ(pars, fitter._f - data.ravel())
+
+        # Assert
+        self.assertTrue(np.allclose(result[0], expected[0]), "Wrong matrix J*J^T")
+        self.assertTrue(np.allclose(result[1], expected[1]), "Wrong gradient J*r")
+
+    def test_fit_mask(self):
+        """
+        Test that corrupted pixels are excluded from the fit by a mask and a region of interest
+        """
+        # Arrange
+        pars = 1.5, 45, 10, 40., 20, 1.
+        x = np.arange(100.)
+        y = np.arange(80.)
+        X, Y = np.meshgrid(x, y)
+        data = gauss2d(X, Y, pars)
+        expected_data = data.copy()
+        rng = np.random.RandomState(0)
+        mask = rng.rand(80, 100) < .05
+        data[mask] = 100.
+        data[:, 90:] = -10.
+        fitter = Gauss2D(data)
+
+        # Act
+        fitter.setMask(mask, roi=np.s_[:, :90])
+        result = fitter.fit((1., 50, 8, 45, 15, 0.))
+        fit_data = fitter.getFitData()
+
+        # Assert
+        self.assertEqual(fitter._f.size, (~mask[:, :90]).sum())
+        self.assertEqual(fit_data.shape, data.shape)
+        self.assertTrue(np.allclose(fit_data, expected_data))
+        self.assertTrue(np.allclose(result, pars, atol=1e-4),
+                        "Masked fit returned wrong values: %s != %s" % (result, pars))
+        self.assertTrue(np.isfinite(fitter.getFitErr()).all())
+
 
 class TestGauss2DRot(TestCase):
 
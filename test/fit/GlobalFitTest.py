@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+from unittest.case import TestCase
+from qao.fit import Gauss2D, GlobalFit
+
+def gauss2d(x, y, pars):
+    A, x0, sx, y0, sy, off = pars
+    ex = np.exp(-(x-x0)**2 / sx**2 *.5)
+    ey = np.exp(-(y-y0)**2 / sy**2 *.5)
+    return A * ex * ey + off
+
+class TestGlobalFit(TestCase):
+
+    def setUp(self):
+        x = np.arange(60.)
+        y = np.arange(50.)
+        X, Y = np.meshgrid(x, y)
+        self.pars = np.array([(1. + .1*i, 30 + i, 8, 25. - i, 6, .5) for i in range(10)])
+        noise = np.random.RandomState(0).normal(0, .05, (len(self.pars), ) + X.shape)
+        self.stack = np.array([gauss2d(X, Y, p) for p in self.pars]) + noise
+
+    def test_fit(self):
+        """
+        Test that the shared parameters are tied across all datasets
+        """
+        # Arrange
+        fit = GlobalFit(Gauss2D, self.stack, shared = ["s_x", "s_y", "off"])
+        fitter = Gauss2D(self.stack[0])
+        fitter.fit()
+        single_errs = fitter.getFitErr()
+
+        # Act
+        pars, log = fit.fit(return_dict = True)
+        errs = fit.getFitErr()
+
+        # Assert
+        self.assertTrue(log["success"])
+        self.assertTrue(np.all(pars[:, [2, 4, 5]] == pars[0, [2, 4, 5]]), "Shared parameters differ")
+        self.assertTrue(np.all(np.abs(pars - self.pars) < 2 * errs), "Global fit returned wrong values")
+        self.assertTrue(np.all(errs[0, [2, 4, 5]] < .5 * single_errs[[2, 4, 5]]),
+                        "Shared parameters not constrained by all datasets")
+
+    def test_solve(self):
+        """
+        Test that the block-sparse solution equals the solution of the dense normal equations
+        """
+        # Arrange
+        fit = GlobalFit(Gauss2D, self.stack[:4], shared = [2, 4, 5])
+        pars = fit.guess()
+        A, g, errsq = fit._normalEquations(pars)
+        s, l = fit.shared, ~fit.shared
+        n_s, n_l = s.sum(), l.sum()
+        n = n_s + len(A) * n_l
+        A_dense, g_dense = np.zeros([n, n]), np.zeros(n)
+        A_dense[:n_s, :n_s] = A[:, s][:, :, s].sum(axis = 0)
+        g_dense[:n_s] = g[:, s].sum(axis = 0)
+        for i in range(len(A)):
+            j = n_s + i * n_l
+            A_dense[:n_s, j:j+n_l] = A[i][s][:, l]
+            A_dense[j:j+n_l, :n_s] = A[i][l][:, s]
+            A_dense[j:j+n_l, j:j+n_l] = A[i][l][:, l]
+            g_dense[j:j+n_l] = g[i][l]
+        expected = np.linalg.solve(A_dense + np.eye(n), -g_dense)
+
+        # Act
+        d = fit._solve(A, g, 1.)
+
+        # Assert
+        self.assertTrue(np.allclose(d[0, s], expected[:n_s]))
+        self.assertTrue(np.allclose(d[:, l].ravel(), expected[n_s:]))
+
+    def test_invalid_shared(self):
+        self.assertRaises(ValueError, GlobalFit, Gauss2D, self.stack, [])
+        self.assertRaises(ValueError, GlobalFit, Gauss2D, self.stack, ["s"])
+
+if __name__ == '__main__':
+    unittest.main()
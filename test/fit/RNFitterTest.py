@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from scipy.special import j0, j1
+from unittest.case import TestCase
+from qao.fit import RNFitter as RNFitterModule
+from qao.fit.RNFitter import RNFitter, fitBatch
+
+def writeTheory(filename, sMax = 50., sStep = .1, tMax = 60.):
+    # Raman-Nath populations for pulses up to tMax, the pulse area scales with s
+    s = np.arange(1., sMax + .5*sStep, sStep)[:, np.newaxis]
+    t = np.arange(tMax + 1.)
+    area = .02 * s * t
+    f = h5py.File(filename, "w")
+    f.attrs['sMax'], f.attrs['sStep'], f.attrs['tMax'] = sMax, sStep, tMax
+    f['zero'] = j0(area)**2
+    f['first'] = j1(area)**2
+    f.close()
+
+class TestRNFitter(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.theoryFile = os.path.join(self.tmpdir, "theory.h5")
+        writeTheory(self.theoryFile)
+        self.s, self.A = 27.3, 100.
+        self.time = np.arange(0., 70., 2.)
+        area = .02 * self.s * self.time
+        self.zero_order = self.A * j0(area)**2
+        self.first_order = self.A * j1(area)**2
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fit(self):
+        """
+        Test that the lattice depth is fitted from both diffraction orders
+        """
+        # Arrange
+        fitter = RNFitter(self.time, self.zero_order, self.first_order, self.theoryFile, p0=[26, 90])
+
+        # Act
+        results = fitter.fit()
+
+        # Assert
+        self.assertEqual(fitter.time.max(), 60.)
+        for order in [0, 1]:
+            self.assertTrue(np.allclose(results[order][0], [self.s, self.A], rtol=1e-3),
+                            "Order %d fit returned wrong values: %s" % (order, results[order][0]))
+
+    def test_theory_cache(self):
+        """
+        Test that the theory is shared between fitters and reloaded if the file changes
+        """
+        # Arrange
+        fitter = RNFitter(self.time, self.zero_order, self.first_order, self.theoryFile, p0=[26, 90])
+
+        # Act
+        fitter_same = RNFitter(self.time, self.zero_order, self.first_order, self.theoryFile, p0=[26, 90])
+        writeTheory(self.theoryFile, tMax = 50.)
+        os.utime(self.theoryFile, (0, os.path.getmtime(self.theoryFile) + 10))
+        fitter_changed = RNFitter(self.time, self.zero_order, self.first_order, self.theoryFile, p0=[26, 90])
+
+        # Assert
+        self.assertIs(fitter_same.grid['splines'], fitter.grid['splines'])
+        self.assertIsNot(fitter_changed.grid['splines'], fitter.grid['splines'])
+        self.assertEqual(fitter_changed.tMax, 50.)
+
+    def test_theory_cache_eviction(self):
+        """
+        Test that outdated theories and the least recently used interpolators are evicted
+        """
+        # Arrange
+        theory_cache, spline_cache = RNFitterModule._theory_cache, RNFitterModule._spline_cache
+        RNFitter(self.time, self.zero_order, self.first_order, self.theoryFile, p0=[26, 90])
+        key_outdated = (os.path.abspath(self.theoryFile), os.path.getmtime(self.theoryFile))
+
+        # Act
+        os.utime(self.theoryFile, (0, os.path.getmtime(self.theoryFile) + 10))
+        for s in range(5, 5 + RNFitterModule.SPLINE_CACHE_SIZE + 1):
+            fitter = RNFitter(self.time, self.zero_order, self.first_order, self.theoryFile, p0=[s, 90], gridWidth=1)
+
+        # Assert
+        self.assertNotIn(key_outdated, theory_cache)
+        self.assertIn(fitter.theoryKey, theory_cache)
+        self.assertFalse([key for key in spline_cache if key[:2] == key_outdated])
+        self.assertEqual(len(spline_cache), RNFitterModule.SPLINE_CACHE_SIZE)
+        self.assertIs(spline_cache.values()[-1], fitter.grid['splines'])
+
+    def test_fit_joint(self):
+        """
+        Test that both orders are fitted with a common lattice depth
+        """
+        # Arrange
+        fitter = RNFitter(self.time, self.zero_order, .5 * self.first_order, self.theoryFile, p0=[26, 90])
+
+        # Act
+        popt, perr = fitter.fitJoint()
+
+        # Assert
+        self.assertTrue(np.allclose(popt, [self.s, self.A, .5 * self.A], rtol=1e-3),
+                        "Joint fit returned wrong values: %s" % popt)
+        self.assertEqual(perr.shape, (3, ))
+
+    def test_fit_batch(self):
+        """
+        Test that the batch fit returns the results of the single fits in order
+        """
+        # Arrange
+        depths = [25., 26.5, 28., 29.5]
+        datasets = [(self.time, self.A * j0(.02 * s * self.time)**2, self.A * j1(.02 * s * self.time)**2)
+                    for s in depths]
+
+        # Act
+        results = fitBatch(datasets, self.theoryFile, p0=[27, 90], processes=2)
+
+        # Assert
+        self.assertEqual(len(results), len(datasets))
+        for s, result in zip(depths, results):
+            self.assertTrue(np.allclose(result[0][0], s, rtol=1e-3),
+                            "Batch fit returned wrong values: %s != %s" % (result[0][0], s))
+
+if __name__ == '__main__':
+    unittest.main()
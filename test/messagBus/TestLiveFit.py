@@ -0,0 +1,193 @@
+#!/bin/python
+# coding: utf-8
+"""
+Ensure that the live fit server fits the latest frames and publishes
+the results, using a mocking messageBus client.
+"""
+import unittest
+import time
+import numpy as np
+from qao.gui.qt import QtCore
+from qao.io.livefit import LiveFitServer, fitterClass
+from qao.fit import Gauss2D, Gauss2DRot
+
+app = QtCore.QCoreApplication([])
+
+
+class MockMessageBusClient(object):
+    def __init__(self):
+        self.published = []
+
+    def publishEvent(self, topic, data):
+        self.published.append((topic, data))
+
+    def disconnectFromServer(self):
+        pass
+
+
+class MockAsyncResult(object):
+    def __init__(self, ready, successful=True):
+        self._ready = ready
+        self._successful = successful
+
+    def ready(self):
+        return self._ready
+
+    def successful(self):
+        return self._successful
+
+
+class MockPool(object):
+    def __init__(self, results):
+        self.results = list(results)
+
+    def apply_async(self, func, args, callback=None):
+        return self.results.pop(0)
+
+
+def gauss2d(pars, shape=(60, 80)):
+    A, x0, sx, y0, sy, off = pars
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    return A * np.exp(-.5*(x-x0)**2/sx**2 - .5*(y-y0)**2/sy**2) + off
+
+
+class TestLiveFit(unittest.TestCase):
+    def setUp(self):
+        self.server = LiveFitServer("image", "fit", model="Gauss2D", processes=0, queueSize=2)
+        self.server.mbus = MockMessageBusClient()
+
+    def test_fit_frame(self):
+        """
+        Ensure that a frame is fitted and the result is published with its id
+        """
+        # Arrange
+        pars = (1.5, 40., 8., 30., 6., .2)
+
+        # Act
+        self.server.handleFrame({"id": 7, "image": gauss2d(pars)})
+        self.server._dispatch()
+
+        # Assert
+        self.assertEqual(len(self.server.mbus.published), 1)
+        topic, result = self.server.mbus.published[0]
+        self.assertEqual(topic, "fit")
+        self.assertEqual(result["id"], 7)
+        self.assertTrue(result["success"], "Live fit did not converge")
+        self.assertTrue(np.allclose([result["pars"][name] for name in ["A", "x_0", "s_x", "y_0", "s_y", "off"]],
+                                    pars, atol=1e-4))
+        self.assertEqual(set(result["errs"]), set(result["pars"]))
+        self.assertTrue(result["latency"] >= result["fit_time"] > 0)
+
+    def test_latest_frame_wins(self):
+        """
+        Ensure that the oldest frames are dropped if the queue is full
+        """
+        # Arrange
+        frames = [{"id": i, "image": gauss2d((1., 40. + i, 8., 30., 6., 0.))} for i in range(5)]
+
+        # Act
+        for frame in frames:
+            self.server.handleFrame(frame)
+        self.server._dispatch()
+        stats = self.server.getStats()
+
+        # Assert
+        self.assertEqual([result["id"] for topic, result in self.server.mbus.published], [3, 4])
+        self.assertEqual(self.server.mbus.published[-1][1]["dropped"], 3)
+        self.assertEqual(stats["received"], 5)
+        self.assertEqual(stats["fitted"], 2)
+        self.assertEqual(stats["dropped"], 3)
+        self.assertTrue(stats["latency_max"] >= stats["latency_mean"] > 0)
+
+    def test_lost_frames(self):
+        """
+        Ensure that frames failed or lost by a worker are published as failed and release their slot
+        """
+        # Arrange
+        self.server.processes = 2
+        self.server.pool = MockPool([MockAsyncResult(ready=True, successful=False), MockAsyncResult(ready=False)])
+        self.server.timeout = 0.
+        image = gauss2d((1.5, 40., 8., 30., 6., .2))
+
+        # Act
+        for i in range(2):
+            self.server.handleFrame({"id": i, "image": image})
+        self.server._dispatch()
+        self.server.pool = None
+        self.server.handleFrame({"id": 2, "image": image})
+        self.server._dispatch()
+
+        # Assert
+        results = [result for topic, result in self.server.mbus.published]
+        self.assertEqual([result["id"] for result in results], [0, 1, 2])
+        self.assertEqual([result["success"] for result in results], [False, False, True])
+        self.assertEqual([result.get("error") for result in results[:2]], ["worker failed", "worker timed out"])
+        self.assertEqual(self.server.inFlight, 0)
+        self.assertEqual(self.server.getStats()["failed"], 2)
+
+    def test_worker_per_server(self):
+        """
+        Ensure that servers fitting within the event loop keep their own fitters
+        """
+        # Arrange
+        other = LiveFitServer("image", "fit", model="Gauss2DRot", processes=0)
+        other.mbus = MockMessageBusClient()
+        image = gauss2d((1.5, 40., 8., 30., 6., .2))
+
+        # Act
+        for server in [self.server, other]:
+            server.handleFrame(image)
+            server._dispatch()
+
+        # Assert
+        self.assertEqual(self.server.mbus.published[0][1]["model"], "Gauss2D")
+        self.assertEqual(len(self.server.mbus.published[0][1]["pars"]), 6)
+        self.assertEqual(other.mbus.published[0][1]["model"], "Gauss2DRot")
+        self.assertEqual(len(other.mbus.published[0][1]["pars"]), 7)
+
+    def test_fitter_class(self):
+        """
+        Ensure that only fitters are accepted as model
+        """
+        self.assertIs(fitterClass("Gauss2D"), Gauss2D)
+        self.assertIs(fitterClass(Gauss2DRot), Gauss2DRot)
+        for model in ["FitJob", "np", "Unknown", object, None]:
+            self.assertRaises(ValueError, fitterClass, model)
+
+
+class TestLiveFitProcesses(unittest.TestCase):
+    def setUp(self):
+        self.server = LiveFitServer("image", "fit", model="Gauss2D", processes=1, queueSize=2)
+        self.server.mbus = MockMessageBusClient()
+
+    def tearDown(self):
+        self.server.disconnectFromServer()
+
+    def test_fit_frame(self):
+        """
+        Ensure that a frame fitted by a worker process is published from the event loop
+        """
+        # Arrange
+        pars = (1.5, 40., 8., 30., 6., .2)
+        results = []
+        self.server.frameFitted.connect(results.append)
+
+        # Act
+        self.server.handleFrame({"id": 3, "image": gauss2d(pars)})
+        timeout = time.time() + 10.
+        while not results and time.time() < timeout:
+            app.processEvents()
+            time.sleep(.01)
+
+        # Assert
+        self.assertEqual(len(self.server.mbus.published), 1, "Fit result was not published")
+        topic, result = self.server.mbus.published[0]
+        self.assertEqual(result["id"], 3)
+        self.assertTrue(result["success"], "Live fit did not converge")
+        self.assertTrue(np.allclose([result["pars"][name] for name in ["A", "x_0", "s_x", "y_0", "s_y", "off"]],
+                                    pars, atol=1e-4))
+        self.assertEqual(self.server.inFlight, 0)
+        self.assertEqual(self.server.getStats()["fitted"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
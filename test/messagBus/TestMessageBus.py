@@ -6,8 +6,12 @@ messageBusCommunicator which maps Server send to Client read methods.
 """
 import unittest
 import time
+import numpy as np
 from qao.gui.qt import QtCore
-from qao.io.messageBus import MessageBusClient, MessageBusServer
+from qao.io import websocket, jsonEncoder
+from qao.io.messageBus import MessageBusClient, MessageBusServer, ServerClientConnection, TYPE_PUBLISH, \
+    parseEnvelope, TopicIndex, qtSignal, SEND_BUFFER_SIZE, \
+    QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_CONFLATE, QUEUE_DISCONNECT
 
 app = QtCore.QCoreApplication([])
 
@@ -67,5 +71,383 @@ class TestMessageBus(unittest.TestCase):
 
         self.assertTrue(assertion.wasCalled, "Assertion has not been called")
 
+    def testSubscribeWildcard(self):
+        """
+        Ensure that wildcard subscription callbacks are called with the data of matching topics
+        """
+        # Arrange
+        results = []
+
+        # Act
+        self.messageBus.subscribe('camera.*', lambda data: results.append(data))
+        self.process()
+        self.messageBus.publishEvent('camera.image', [1, 2])
+        self.messageBus.publishEvent('camera.image.raw', [3])
+        self.process()
+
+        # Assert
+        self.assertEqual(results, [[1, 2]])
+
+    def testSubscribeWithTopic(self):
+        """
+        Ensure that callbacks subscribed with topic are called with the published topic and data
+        """
+        # Arrange
+        results = []
+
+        # Act
+        self.messageBus.subscribe('camera.#', lambda topic, data: results.append((topic, data)), withTopic=True)
+        self.messageBus.subscribe('camera.image', lambda topic, data: results.append((topic, data)), withTopic=True)
+        self.process()
+        self.messageBus.publishEvent('camera.image', [1, 2])
+        self.messageBus.publishEvent('camera.image.raw', [3])
+        self.process()
+
+        # Assert
+        self.assertEqual(results, [('camera.image', [1, 2]), ('camera.image', [1, 2]), ('camera.image.raw', [3])])
+
+
+def parseFrame(raw):
+    frm = websocket.Frame()
+    pos, nBytes = 0, next(frm.parser)
+    try:
+        while True:
+            nBytes, pos = frm.parser.send(raw[pos:pos + nBytes]), pos + nBytes
+    except StopIteration:
+        pass
+    return frm
+
+
+class MockServerClientConnection(object):
+    def __init__(self, subscriptions, binaryTransport=False):
+        self.subscriptions = set(subscriptions)
+        self.binaryTransport = binaryTransport
+        self.frames = []
+
+    def forwardFrame(self, frame, topic=None):
+        self.frames.append(frame)
+
+
+class MockSocket(QtCore.QObject):
+    disconnected = qtSignal()
+    readyRead = qtSignal()
+    bytesWritten = qtSignal(int)
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self.pending = 0
+        self.written = []
+        self.aborted = False
+
+    def bytesToWrite(self):
+        return self.pending
+
+    def abort(self):
+        self.aborted = True
+        self.disconnected.emit()
+
+
+class TestMessageBusServer(unittest.TestCase):
+
+    def addClients(self, server, clients):
+        for client in clients:
+            server.clients.append(client)
+            for topic in client.subscriptions:
+                server._handleSubscribe(topic, client)
+
+    def testPublishFanOut(self):
+        """
+        Ensure that published data is serialized once and the same frame is sent to all subscribers
+        """
+        # Arrange
+        server = MessageBusServer(port=TESTPORT + 1)
+        subscribers = [MockServerClientConnection(['topic']) for i in range(3)]
+        other = MockServerClientConnection(['other'])
+        self.addClients(server, subscribers + [other])
+        data = {"image": list(range(100))}
+        packet = jsonEncoder.dumps([TYPE_PUBLISH, 'topic', data])
+        events = []
+        server.eventPublished.connect(lambda topic, data: events.append((topic, data)))
+
+        # Act
+        server._handlePublish('topic', packet)
+
+        # Assert
+        self.assertEqual(other.frames, [])
+        frame = subscribers[0].frames[0]
+        for client in subscribers:
+            self.assertEqual(len(client.frames), 1)
+            self.assertTrue(client.frames[0] is frame, "Frame was built for each subscriber")
+        self.assertEqual(jsonEncoder.loads(parseFrame(frame).data), [TYPE_PUBLISH, 'topic', data])
+        self.assertEqual(events, [('topic', data)])
+        server.server.close()
+
+    def testPublishTranscode(self):
+        """
+        Ensure that binary packets are forwarded unchanged and transcoded once for clients without binary transport
+        """
+        # Arrange
+        server = MessageBusServer(port=TESTPORT + 1)
+        binaryClients = [MockServerClientConnection(['topic'], binaryTransport=True) for i in range(2)]
+        legacyClients = [MockServerClientConnection(['topic']) for i in range(2)]
+        self.addClients(server, binaryClients + legacyClients)
+        data = {"image": np.arange(100, dtype=np.uint16).reshape(10, 10)}
+        packet = jsonEncoder.dumpsBinary([TYPE_PUBLISH, 'topic', data])
+
+        # Act
+        server._handlePublish('topic', packet)
+
+        # Assert
+        binaryFrame = parseFrame(binaryClients[0].frames[0])
+        legacyFrame = parseFrame(legacyClients[0].frames[0])
+        self.assertTrue(binaryClients[1].frames[0] is binaryClients[0].frames[0])
+        self.assertTrue(legacyClients[1].frames[0] is legacyClients[0].frames[0])
+        self.assertEqual(binaryFrame.opCode, websocket.OPCODE_BINARY)
+        self.assertEqual(binaryFrame.data, packet)
+        self.assertEqual(legacyFrame.opCode, websocket.OPCODE_ASCII)
+        self.assertFalse(jsonEncoder.isBinary(legacyFrame.data))
+        self.assertTrue(np.array_equal(jsonEncoder.loads(legacyFrame.data)[2]["image"], data["image"]))
+        server.server.close()
+
+    def testPublishWildcard(self):
+        """
+        Ensure that events are forwarded once to clients subscribed by topic or wildcard patterns
+        """
+        # Arrange
+        server = MessageBusServer(port=TESTPORT + 1)
+        exact = MockServerClientConnection(['camera.image'])
+        one = MockServerClientConnection(['camera.*'])
+        both = MockServerClientConnection(['camera.image', '#'])
+        other = MockServerClientConnection(['camera.*.raw', 'camera', 'daLog.#'])
+        self.addClients(server, [exact, one, both, other])
+        packet = jsonEncoder.dumps([TYPE_PUBLISH, 'camera.image', 1])
+
+        # Act
+        server._handlePublish('camera.image', packet)
+
+        # Assert
+        self.assertEqual([len(client.frames) for client in [exact, one, both, other]], [1, 1, 1, 0])
+        server.server.close()
+
+    def testDecodeEvents(self):
+        """
+        Ensure that the server emits the serialized packets only if decoding is disabled
+        """
+        # Arrange
+        server = MessageBusServer(port=TESTPORT + 1, decodeEvents=False)
+        packet = jsonEncoder.dumps([TYPE_PUBLISH, 'topic', [1, 2., {"a": "b"}]])
+        events, packets = [], []
+        server.eventPublished.connect(lambda topic, data: events.append((topic, data)))
+        server.packetPublished.connect(lambda topic, packet: packets.append((topic, packet)))
+
+        # Act
+        server._handlePublish('topic', packet)
+
+        # Assert
+        self.assertEqual(events, [])
+        self.assertEqual(packets, [('topic', packet)])
+        server.server.close()
+
+    def testDecodeOnDemand(self):
+        """
+        Ensure that the server decodes published data only while eventPublished is connected
+        """
+        # Arrange
+        server = MessageBusServer(port=TESTPORT + 1)
+        packet = jsonEncoder.dumps([TYPE_PUBLISH, 'topic', [1, 2., {"a": "b"}]])
+        loads, decoded, events = jsonEncoder.loads, [], []
+        jsonEncoder.loads = lambda data: decoded.append(data) or loads(data)
+
+        # Act
+        try:
+            server._handlePublish('topic', packet)
+            server.eventPublished.connect(lambda topic, data: events.append((topic, data)))
+            server._handlePublish('topic', packet)
+        finally:
+            jsonEncoder.loads = loads
+
+        # Assert
+        self.assertEqual(decoded, [packet])
+        self.assertEqual(events, [('topic', [1, 2., {"a": "b"}])])
+        server.server.close()
+
+
+class TestServerClientConnection(unittest.TestCase):
+
+    def createConnection(self, policy, maxBytes=1000, maxMessages=3):
+        self.socket = MockSocket()
+        client = ServerClientConnection(self.socket, policy, maxBytes, maxMessages)
+        client._send = lambda frame, blocking=False: self.socket.written.append(frame)
+        return client
+
+    def forward(self, client, events):
+        for topic, frame in events:
+            client.forwardFrame(frame, topic)
+
+    def drain(self, client):
+        self.socket.pending = 0
+        self.socket.bytesWritten.emit(0)
+
+    def testDirectSend(self):
+        """
+        Ensure that events are written directly while the client keeps up
+        """
+        # Arrange
+        client = self.createConnection(QUEUE_DROP_OLDEST)
+
+        # Act
+        self.forward(client, [('a', 'x' * 10), ('a', 'y' * 10)])
+
+        # Assert
+        self.assertEqual(self.socket.written, ['x' * 10, 'y' * 10])
+        self.assertEqual(len(client.queue), 0)
+
+    def testDropOldest(self):
+        """
+        Ensure that the oldest events are dropped and the queue is drained when bytes are written
+        """
+        # Arrange
+        client = self.createConnection(QUEUE_DROP_OLDEST)
+        self.socket.pending = SEND_BUFFER_SIZE
+
+        # Act
+        self.forward(client, [('a', str(i)) for i in range(5)])
+        self.drain(client)
+
+        # Assert
+        self.assertEqual(self.socket.written, ['2', '3', '4'])
+        self.assertEqual((client.droppedMessages, client.droppedBytes), (2, 2))
+        self.assertEqual((len(client.queue), client.queuedBytes), (0, 0))
+
+    def testDropNewest(self):
+        """
+        Ensure that new events are dropped if the queue is full, also by the byte limit
+        """
+        # Arrange
+        client = self.createConnection(QUEUE_DROP_NEWEST, maxBytes=25)
+        self.socket.pending = SEND_BUFFER_SIZE
+
+        # Act
+        self.forward(client, [('a', '0'), ('a', '1'), ('b', 'x' * 30), ('a', '2'), ('a', '3')])
+        self.drain(client)
+
+        # Assert
+        self.assertEqual(self.socket.written, ['0', '1', '2'])
+        self.assertEqual((client.droppedMessages, client.droppedBytes), (2, 31))
+
+    def testConflate(self):
+        """
+        Ensure that queued events are replaced by the latest event of their topic
+        """
+        # Arrange
+        client = self.createConnection(QUEUE_CONFLATE)
+        self.socket.pending = SEND_BUFFER_SIZE
+
+        # Act
+        self.forward(client, [('a', 'a0'), ('b', 'b0'), ('a', 'a1'), ('c', 'c0'), ('a', 'a2'), ('d', 'd0')])
+        self.drain(client)
+
+        # Assert
+        self.assertEqual(self.socket.written, ['b0', 'c0', 'd0'])
+        self.assertEqual(client.droppedMessages, 3)
+        self.assertEqual(client.queuedTopics, {})
+
+    def testDisconnect(self):
+        """
+        Ensure that a client exceeding the queue is disconnected
+        """
+        # Arrange
+        client = self.createConnection(QUEUE_DISCONNECT)
+        disconnected = []
+        client.disconnected.connect(lambda: disconnected.append(True))
+        self.socket.pending = SEND_BUFFER_SIZE
+
+        # Act
+        self.forward(client, [('a', str(i)) for i in range(4)])
+
+        # Assert
+        self.assertTrue(self.socket.aborted)
+        self.assertEqual(disconnected, [True])
+        self.assertEqual(client.droppedMessages, 4)
+        self.assertEqual(len(client.queue), 0)
+
+
+class TestTopicIndex(unittest.TestCase):
+
+    def testMatch(self):
+        """
+        Ensure that topics are matched by plain topics and wildcard patterns
+        """
+        # Arrange
+        index = TopicIndex()
+        patterns = ['camera.image', 'camera.*', '*.image', 'camera.#', 'daLog.#', '#', 'camera.*.raw']
+        for pattern in patterns:
+            index.add(pattern, pattern)
+        expected = {'camera.image': set(['camera.image', 'camera.*', '*.image', 'camera.#', '#']),
+                    'camera': set(['camera.#', '#']),
+                    'camera.image.raw': set(['camera.#', '#', 'camera.*.raw']),
+                    'daLog.lab.temperature': set(['daLog.#', '#']),
+                    'other': set(['#'])}
+
+        for topic, subscribers in expected.items():
+            # Act
+            result = index.match(topic)
+
+            # Assert
+            self.assertEqual(result, subscribers, "Unexpected subscribers for %s: %s" % (topic, result))
+
+    def testRemove(self):
+        """
+        Ensure that removed subscribers no longer match and empty branches are pruned
+        """
+        # Arrange
+        index = TopicIndex()
+        index.add('camera.*', 1)
+        index.add('camera.*', 2)
+        index.add('camera.image', 1)
+
+        # Act
+        index.remove('camera.*', 1)
+        index.remove('camera.image', 1)
+        result = index.match('camera.image')
+        index.remove('camera.*', 2)
+
+        # Assert
+        self.assertEqual(result, set([2]))
+        self.assertEqual(index.match('camera.image'), set())
+        self.assertEqual(index.root.children, {})
+        self.assertEqual(index.topics, {})
+        self.assertRaises(KeyError, index.remove, 'camera.*', 2)
+        self.assertRaises(ValueError, index.add, 'camera.#.raw', 1)
+
+
+class TestEnvelope(unittest.TestCase):
+
+    def testParseEnvelope(self):
+        """
+        Ensure that type, topic and the serialized data are read from a packet
+        """
+        # Arrange
+        data = {"list": [1, "]", ","], "text": "a \\\"quoted\\\" ]"}
+        packets = [jsonEncoder.dumps(["publish", "a.b", data], separators=(',', ':')),
+                   ' [ "publish" ,\n"a.b",  %s ] \n' % jsonEncoder.dumps(data)]
+
+        for packet in packets:
+            # Act
+            pkgType, topic, offset = parseEnvelope(packet)
+
+            # Assert
+            self.assertEqual((pkgType, topic), ("publish", "a.b"))
+            self.assertEqual(jsonEncoder.loads(packet[offset:packet.rindex(']')]), data)
+
+    def testParseEnvelopeWithoutData(self):
+        """
+        Ensure that packets without data and invalid packets are recognized
+        """
+        # Assert
+        self.assertEqual(parseEnvelope('["subscribe","topic"]'), ("subscribe", "topic", None))
+        for packet in ['["subscribe"]', '{"a": 1}', '["publish" "topic", 1]', '[1']:
+            self.assertRaises(ValueError, parseEnvelope, packet)
+
 if __name__ == '__main__':
     unittest.main()
@@ -58,6 +58,27 @@ class TestHttpHeader(unittest.TestCase):
         # Assert
         self.assertIsNotNone(header, "A Reply cannot by None")
         self.assertIsInstance(header, HTTPHeader, "Reply should be a HttpHeader")
+    def test_buildServerReply_protocol(self):
+        """
+        Ensure that the offered subprotocols are read and the selected one is replied
+        """
+        # Arrange
+        default = DefaultHTTPClientHeader()
+        default.attr['Sec-WebSocket-Protocol'] = 'qao.binary, chat'
+        received = HTTPHeader()
+        received.parser.send('GET /chat HTTP/1.1')
+        received.parser.send('Sec-WebSocket-Protocol: chat')
+        other = HTTPHeader()
+
+        # Act
+        protocols = default.protocols()
+        header = default.buildServerReply('qao.binary')
+
+        # Assert
+        self.assertEqual(protocols, ['qao.binary', 'chat'])
+        self.assertEqual(header.protocols(), ['qao.binary'])
+        self.assertEqual(received.protocols(), ['chat'])
+        self.assertEqual(other.protocols(), [], "Header attributes are shared between instances")
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,7 +2,7 @@ import unittest
 from unittest.case import TestCase
 
 import numpy as np
-from qao.io.jsonEncoder import dumps, loads
+from qao.io.jsonEncoder import dumps, loads, dumpsBinary, isBinary, BINARY_ALIGN
 
 
 class JSonDumpsNdArray(TestCase):
@@ -54,6 +54,40 @@ class JSonDumpsNdArray(TestCase):
             self.assertEqual(expected_array.shape, result_array.shape, "Shape mismatch")
             self.assertEqual(expected_array.dtype, result_array.dtype, "Type mismatch %s != %s" % (expected_array.dtype, result_array.dtype))
             self.assertTrue(np.allclose(expected_array, result_array), "Value mismatch")
-    
+
+    def test_binary_ndarray(self):
+        # Arrange
+        expected = {'image': np.arange(35, dtype=np.uint16).reshape(5, 7),
+                    'slice': np.arange(20.).reshape(4, 5)[:, ::2],
+                    'empty': np.zeros((0, 3)),
+                    'scalar': np.array(2.5, dtype=np.float32),
+                    'text': u'abc'}
+
+        # Act
+        dumped = dumpsBinary(expected)
+        result = loads(dumped)
+
+        # Assert
+        self.assertTrue(isBinary(dumped), "Expected a binary message")
+        self.assertLess(len(dumped), len(dumps(expected)) + 3 * BINARY_ALIGN, "Binary message too large")
+        self.assertEqual(result['text'], expected['text'])
+        for key in ['image', 'slice', 'empty', 'scalar']:
+            self.assertEqual(expected[key].shape, result[key].shape, "Shape mismatch")
+            self.assertEqual(expected[key].dtype, result[key].dtype, "Type mismatch %s != %s" % (expected[key].dtype, result[key].dtype))
+            self.assertTrue(np.array_equal(expected[key], result[key]), "Value mismatch")
+            self.assertFalse(result[key].flags.owndata, "Array was copied")
+
+    def test_binary_without_ndarray(self):
+        # Arrange
+        expected = ['publish', 'topic', {'a': [1, 2.5]}]
+
+        # Act
+        dumped = dumpsBinary(expected)
+
+        # Assert
+        self.assertFalse(isBinary(dumped), "Expected json text")
+        self.assertEqual(dumped, dumps(expected))
+        self.assertEqual(loads(dumped), expected)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file